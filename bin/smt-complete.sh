@@ -23,7 +23,7 @@ _smt_completion() {
     local cur prev1 want_labels labels
     cur="${COMP_WORDS[COMP_CWORD]}"
     prev1="${COMP_WORDS[COMP_CWORD-1]}"
-    labels=$(cat .smt/labels)
+    labels=$(cat .smt/labels 2>/dev/null)
     case "${prev1}" in
 	comment|delete|diff|migrate|repeat|run|tag)
 	    crp2=( $(compgen -W "${labels}" -- ${cur}) )
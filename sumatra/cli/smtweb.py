@@ -5,6 +5,7 @@ Web interface to the Sumatra computational experiment management tool.
 
 import sys
 import os
+import tempfile
 from optparse import OptionParser
 from textwrap import dedent
 import time
@@ -53,20 +54,29 @@ def main(argv):
                       help="set read-only mode")
     parser.add_option('-s', '--serverside', default=False, action="store_true",
                       help="load website faster, recommended for large dataset")
+    parser.add_option('-t', '--thumbnails', metavar='DIR',
+                      help="cache thumbnails of images in DIR. Defaults to .smt/thumbnails in the project directory")
+    parser.add_option('--thumbnail-cache-size', metavar='MB', type="int", default=200,
+                      help="the maximum total size of the cached thumbnails, in megabytes")
     (options, args) = parser.parse_args(argv)
 
     if not have_django:
         print("smtweb requires Django to be installed")
         return 1
 
+    thumbnail_dir = options.thumbnails
     if args:
         recordstore = DjangoRecordStore(db_file=args[0])
+        if thumbnail_dir is None:
+            thumbnail_dir = os.path.join(tempfile.gettempdir(), "sumatra-thumbnails")
     else:
         project = load_project()
         if not isinstance(project.record_store, DjangoRecordStore):
             # should make the web interface independent of the record store, if possible
             print("This project cannot be accessed using the web interface (record store is not of type DjangoRecordStore).")
             return 1
+        if thumbnail_dir is None:
+            thumbnail_dir = project.thumbnail_directory
         del project
 
     root_dir = os.path.dirname(sumatra_web)
@@ -87,6 +97,8 @@ def main(argv):
         MIDDLEWARE_CLASSES=tuple(),
         READ_ONLY = options.read_only,
         SERVERSIDE = options.serverside,
+        THUMBNAIL_CACHE = os.path.abspath(thumbnail_dir),
+        THUMBNAIL_CACHE_SIZE = options.thumbnail_cache_size * 1024 * 1024,
     )
 
     db_config.configure()
@@ -8,6 +8,7 @@ Each command corresponds to a function in this module.
 :license: BSD 2-clause, see LICENSE for details.
 """
 
+import re
 import os.path
 import sys
 from argparse import ArgumentParser
@@ -18,13 +19,15 @@ import datetime
 import sumatra
 
 from sumatra.programs import get_executable
-from sumatra.datastore import get_data_store
+from sumatra.datastore import get_data_store, ARCHIVE_FORMATS
 from sumatra.projects import Project, load_project
 from sumatra.launch import get_launch_mode
 from sumatra.parameters import build_parameters
 from sumatra.recordstore import get_record_store
 from sumatra.versioncontrol import get_working_copy, get_repository, UncommittedModificationsError
 from sumatra.formatting import get_diff_formatter, get_formatter
+from sumatra.formatting.columnar import COLUMNAR_FORMATS
+from sumatra.web.thumbnails import THUMBNAIL_SIZES, DEFAULT_THUMBNAIL_SIZE
 from sumatra.records import MissingInformationError
 from sumatra.core import TIMESTAMP_FORMAT, STATUS_FORMAT, STATUS_PATTERN
 
@@ -38,7 +41,7 @@ logger.debug("STARTING")
 
 modes = ("init", "configure", "info", "run", "list", "delete", "comment", "tag",
          "repeat", "diff", "help", "export", "upgrade", "sync", "migrate", "version",
-         "view")
+         "view", "digest", "thumbnails")
 
 store_arg_help = (
     "The argument can take the following forms: "
@@ -75,6 +78,24 @@ def _convertStr(s):
     return ret
 
 
+def _parse_parameter_filters(s):
+    """
+    Parse a comma-separated list of conditions on parameter values, e.g.
+    "a=1,b.c>=0.5", into a list of (name, operator, value) tuples. ":" may be
+    used in place of "=".
+    """
+    predicates = []
+    for condition in s.split(','):
+        match = re.match(r'^\s*([^<>=:\s]+)\s*(<=|>=|<|>|=|:)\s*(.*?)\s*$', condition)
+        if match is None:
+            raise ValueError("Invalid parameter condition '%s'" % condition)
+        name, operator, value = match.groups()
+        if operator == ':':
+            operator = '='
+        predicates.append((name, operator, _convertStr(value)))
+    return predicates
+
+
 def parse_executable_str(exec_str):
     """
     Split the string describing the executable into a path part and an
@@ -167,6 +188,8 @@ def init(argv):
     datastore.add_argument('-W', '--webdav', metavar='URL', help="specify a webdav URL (with username@password: if needed) as the archiving location for data")
     datastore.add_argument('-A', '--archive', metavar='PATH', help="specify a directory in which to archive output datafiles. If not specified, or if 'false', datafiles are not archived.")
     datastore.add_argument('-M', '--mirror', metavar='URL', help="specify a URL at which your datafiles will be mirrored.")
+    datastore.add_argument('--dedup', metavar='PATH', help="specify a directory in which to store output datafiles in deduplicated form, so that files with identical content are stored only once. If 'true', defaults to .smt/blobs.")
+    parser.add_argument('--archive-format', choices=ARCHIVE_FORMATS, default='tar.gz', help="the format of the archives created if the --archive option is used. Defaults to %(default)s. The tar.zst format requires the zstandard package, and compresses using multiple threads.")
 
     args = parser.parse_args(argv)
 
@@ -204,15 +227,22 @@ def init(argv):
 
     if args.webdav:
         # should we care about archive migration??
-        output_datastore = get_data_store("DavFsDataStore", {"root": args.datapath, "dav_url": args.webdav})
+        output_datastore = get_data_store("DavFsDataStore", {"root": args.datapath, "dav_url": args.webdav,
+                                                             "archive_format": args.archive_format})
         args.archive = '.smt/archive'
     elif args.archive and args.archive.lower() != 'false':
         if args.archive.lower() == "true":
             args.archive = ".smt/archive"
         args.archive = os.path.abspath(args.archive)
-        output_datastore = get_data_store("ArchivingFileSystemDataStore", {"root": args.datapath, "archive": args.archive})
+        output_datastore = get_data_store("ArchivingFileSystemDataStore", {"root": args.datapath, "archive": args.archive,
+                                                                           "archive_format": args.archive_format})
     elif args.mirror:
         output_datastore = get_data_store("MirroredFileSystemDataStore", {"root": args.datapath, "mirror_base_url": args.mirror})
+    elif args.dedup:
+        if args.dedup.lower() == "true":
+            args.dedup = ".smt/blobs"
+        output_datastore = get_data_store("ContentAddressedDataStore", {"root": args.datapath,
+                                                                        "blobs": os.path.abspath(args.dedup)})
     else:
         output_datastore = get_data_store("FileSystemDataStore", {"root": args.datapath})
     input_datastore = get_data_store("FileSystemDataStore", {"root": args.input})
@@ -234,8 +264,7 @@ def init(argv):
                       label_generator=args.labelgenerator,
                       timestamp_format=args.timestamp_format)
     if os.path.exists('.smt') and project.record_store.has_project(project.name):
-        with open('.smt/labels', 'w') as f:
-            f.write('\n'.join(project.get_labels()))
+        project.rebuild_label_cache()
     project.save()
 
 
@@ -262,11 +291,15 @@ def configure(argv):
     parser.add_argument('--ignore-parameters', dest='ignore_parameters', action='store_true', help="do not attempt to parse any parameter files.")
     parser.add_argument('--parse-parameters', dest='ignore_parameters', action='store_false', help="parse parameter files if found. This is the default.")
     parser.add_argument('-s', '--store', help="Change the record store to the specified path, URL or URI (must be specified). {0}".format(store_arg_help))
+    parser.add_argument('--lazy-digests', dest='lazy_digests', action='store_true', default=None, help="do not calculate the digests of output data files when a computation finishes, so that 'smt run' returns sooner. The digests should then be calculated later using 'smt digest'.")
+    parser.add_argument('--eager-digests', dest='lazy_digests', action='store_false', help="calculate the digests of output data files when a computation finishes. This is the default.")
 
     datastore = parser.add_mutually_exclusive_group()
     datastore.add_argument('-W', '--webdav', metavar='URL', help="specify a webdav URL (with username@password: if needed) as the archiving location for data")
     datastore.add_argument('-A', '--archive', metavar='PATH', help="specify a directory in which to archive output datafiles. If not specified, or if 'false', datafiles are not archived.")
     datastore.add_argument('-M', '--mirror', metavar='URL', help="specify a URL at which your datafiles will be mirrored.")
+    datastore.add_argument('--dedup', metavar='PATH', help="specify a directory in which to store output datafiles in deduplicated form, so that files with identical content are stored only once. If 'true', defaults to .smt/blobs.")
+    parser.add_argument('--archive-format', choices=ARCHIVE_FORMATS, help="the format of the archives created by an archiving data store. The tar.zst format requires the zstandard package, and compresses using multiple threads.")
 
     parser.add_argument('--add-plugin', help="name of a Python module containing one or more plug-ins.")
     parser.add_argument('--remove-plugin', help="name of a plug-in module to remove from the project.")
@@ -291,7 +324,8 @@ def configure(argv):
         else:  # current data store is not archiving
             if args.archive.lower() != 'false':
                 project.data_store = get_data_store("ArchivingFileSystemDataStore",
-                                                    {"root": project.data_store.root, "archive": args.archive})
+                                                    {"root": project.data_store.root, "archive": args.archive,
+                                                     "archive_format": args.archive_format or "tar.gz"})
     elif args.mirror:
         project.data_store = get_data_store("MirroredFileSystemDataStore",
                                             {"root": project.data_store.root, "mirror_base_url": args.mirror})
@@ -300,6 +334,16 @@ def configure(argv):
         project.data_store = get_data_store("DavFsDataStore",
                                             {"root": project.data_store.root, "dav_url": args.webdav})
         project.data_store.archive_store = '.smt/archive'
+    elif args.dedup:
+        if args.dedup.lower() == "true":
+            args.dedup = ".smt/blobs"
+        project.data_store = get_data_store("ContentAddressedDataStore",
+                                            {"root": project.data_store.root, "blobs": os.path.abspath(args.dedup)})
+    if args.archive_format:
+        if hasattr(project.data_store, 'archive_format'):
+            project.data_store.archive_format = args.archive_format
+        else:
+            parser.error("--archive-format can only be used with an archiving data store.")
     if args.input:
         project.input_datastore.root = args.input
     if args.repository:
@@ -333,6 +377,8 @@ def configure(argv):
         project.allow_command_line_parameters = not args.plain
     if args.ignore_parameters is not None:
         project.ignore_parameters = args.ignore_parameters
+    if args.lazy_digests is not None:
+        project.lazy_digests = args.lazy_digests
     if args.add_plugin:
         project.load_plugins(args.add_plugin)
     if args.remove_plugin:
@@ -435,9 +481,6 @@ def run(argv):
         sys.exit(1)
     if args.tag:
         project.add_tag(run_label, args.tag)
-    if os.path.exists('.smt'):
-        with open('.smt/labels', 'w') as f:
-            f.write('\n'.join(project.get_labels()))
 
 
 def list(argv):  # add 'report' and 'log' as aliases
@@ -464,14 +507,11 @@ def list(argv):  # add 'report' and 'log' as aliases
                         dest="mode", help="list output files from records.")
     parser.add_argument('-P', '--parameter_table', action="store_const", const="parameter_table",
                         dest="mode", help="list records with parameter values")
-    parser.add_argument('-p', '--parameters', metavar='parameters', default=None, help="filter records by parameter values, separated by comma")
+    parser.add_argument('-p', '--parameters', metavar='parameters', default=None, help="filter records by parameter values, e.g. 'a=1,b.c>=0.5'. The operators =, <, <=, > and >= are supported.")
     parser.add_argument('-d', '--date', dest='timestamp', help="filter records by the date (today or YYYYMMDD)")
     args = parser.parse_args(argv)
 
     project = load_project()
-    if os.path.exists('.smt'):
-        with open('.smt/labels', 'w') as f:
-            f.write('\n'.join(project.get_labels()))
 
     kwargs = {'tags':args.tags, 'mode':args.mode, 'format':args.format, 'reverse':args.reverse}
 
@@ -483,14 +523,11 @@ def list(argv):  # add 'report' and 'log' as aliases
         kwargs['timestamp__range'] = [date, date+datetime.timedelta(1)]
     if args.main_file is not None: kwargs['main_file__startswith'] = args.main_file
     if args.parameters:
-        parameters = {}
-        for pp in args.parameters.split(','):
-            for operator in ['=',':']:
-                if operator in pp:
-                    pkey,pval = pp.split(operator)
-                    parameters.update({pkey:_convertStr(pval)})
-        kwargs.update({'parameters':parameters})
-    print(project.format_records(**kwargs))
+        try:
+            kwargs['parameters'] = _parse_parameter_filters(args.parameters)
+        except ValueError as err:
+            parser.error(str(err))
+    project.write_records(sys.stdout, **kwargs)
 
 
 def delete(argv):
@@ -509,25 +546,24 @@ def delete(argv):
                         help="interpret LIST as containing tags. Records with any of these tags will be deleted.")
     parser.add_argument('-d', '--data', action='store_true',
                         help="also delete any data associated with the record(s).")
+    parser.add_argument('--no-digest-check', action='store_true',
+                        help="with --data, delete data files without checking that their content matches the digests stored in the records (faster for large files).")
     args = parser.parse_args(argv)
 
     project = load_project()
 
     if args.tag:
         for tag in args.labels:
-            n = project.delete_by_tag(tag, delete_data=args.data)
+            n = project.delete_by_tag(tag, delete_data=args.data, verify_digests=not args.no_digest_check)
             print("%s records deleted." % n)
     else:
-        for label in args.labels:
-            if label == 'last':
-                label = project.most_recent().label
-            try:
-                project.delete_record(label, delete_data=args.data)
-            except Exception:  # could be KeyError or DoesNotExist: should create standard NoSuchRecord or RecordDoesNotExist exception
+        labels = [label == 'last' and project.most_recent().label or label
+                  for label in args.labels]
+        deleted = project.delete_records(labels, delete_data=args.data,
+                                         verify_digests=not args.no_digest_check)
+        for label in labels:
+            if label not in deleted:
                 warnings.warn("Could not delete record '%s' because it does not exist" % label)
-    if os.path.exists('.smt'):
-        with open('.smt/labels', 'w') as f:
-            f.write('\n'.join(project.get_labels()))
 
 def comment(argv):
     """Add a comment to an existing record."""
@@ -695,25 +731,44 @@ def upgrade(argv):
     project.save()
     # upgrade the record store
     project.record_store.clear()
-    filename = "%s/records_export.json" % backup_dir
-    if os.path.exists(filename):
-        with open(filename) as f:
-            project.record_store.import_(project.name, f.read())
+    ndjson_filename = "%s/records_export.ndjson" % backup_dir
+    if os.path.exists(ndjson_filename):
+        with open(ndjson_filename) as f:
+            project.record_store.import_ndjson(project.name, f)
     else:
-        print("Record file not found")
-        sys.exit(1)
+        for filename, mode in (("%s/records_export.json" % backup_dir, 'r'),
+                               ("%s/records_export.msgpack" % backup_dir, 'rb')):
+            if os.path.exists(filename):
+                with open(filename, mode) as f:
+                    project.record_store.import_(project.name, f.read())
+                break
+        else:
+            print("Record file not found")
+            sys.exit(1)
+    project.rebuild_label_cache()
     print("Project successfully upgraded to Sumatra version {0}.".format(project.sumatra_version))
 
 
 def export(argv):
-    usage = "%(prog)s export"
+    usage = "%(prog)s export [options]"
     description = dedent("""\
-        Export a Sumatra project and its records to JSON. This is needed before running upgrade.""")
+        Export a Sumatra project and its records to JSON. This is needed before running upgrade.
+        The records may also be exported as tables, for analysis with other tools, in Parquet,
+        Arrow IPC or HDF5 format.""")
     parser = ArgumentParser(usage=usage,
                             description=description)
+    parser.add_argument('-f', '--format', choices=('ndjson', 'json', 'msgpack') + COLUMNAR_FORMATS, default='ndjson',
+                        help="the format in which to export the records. The default, 'ndjson', writes one JSON record per line, and uses little memory even for very large projects. The msgpack format is more compact, but requires the msgpack package. The 'parquet', 'arrow' and 'hdf5' formats write tables of records, parameters and data files, and require the pyarrow or h5py package.")
+    parser.add_argument('-o', '--output', metavar='PATH',
+                        help="where to write tables in the 'parquet', 'arrow' or 'hdf5' formats: a directory for 'parquet' and 'arrow', a file for 'hdf5'. Defaults to records_export.FORMAT in the current directory.")
+    parser.add_argument('-t', '--tags', metavar='TAGS', nargs='*', help="with the 'parquet', 'arrow' or 'hdf5' formats, export only the records tagged with these tags.")
     args = parser.parse_args(argv)
     project = load_project()
-    project.export()
+    if args.format in COLUMNAR_FORMATS:
+        project.export_columnar(args.output or "records_export.%s" % args.format,
+                                format=args.format, tags=args.tags)
+    else:
+        project.export(format=args.format)
 
 
 def sync(argv):
@@ -739,6 +794,7 @@ def sync(argv):
         project = load_project()
         store2 = project.record_store
         collisions = store1.sync(store2, project.name)
+        project.rebuild_label_cache()
 
     if collisions:
         print("Synchronization incomplete: there are two records with the same name for the following: %s" % ", ".join(collisions))
@@ -804,6 +860,48 @@ def view(argv):
     # todo: use `formatting` module, rather than print statements
 
 
+def digest(argv):
+    """Calculate pending digests of output data files."""
+    usage = "%(prog)s digest [LABELS]"
+    description = dedent("""\
+        If the project is configured with the --lazy-digests option, the
+        digests of output data files are not calculated when a computation
+        finishes. This command calculates them, for the records with the given
+        labels or, if no labels are given, for all records. It may be run in
+        the background.""")
+    parser = ArgumentParser(usage=usage,
+                            description=description)
+    parser.add_argument('labels', metavar='LABELS', nargs='*', help="labels of the records whose digests should be calculated")
+    args = parser.parse_args(argv)
+    project = load_project()
+    n = project.calculate_digests(args.labels or None)
+    print("Calculated %d digest%s." % (n, n != 1 and "s" or ""))
+
+
+def thumbnails(argv):
+    """Create thumbnails of output images, for the web interface."""
+    usage = "%(prog)s thumbnails [options] [LABELS]"
+    description = dedent("""\
+        The image views of the web interface show downscaled versions of
+        images, which are created when first shown and then cached in
+        .smt/thumbnails. This command creates them in advance, for the images
+        in the output data of the records with the given labels or, if no
+        labels are given, of all records. Requires the Pillow package.""")
+    parser = ArgumentParser(usage=usage,
+                            description=description)
+    parser.add_argument('labels', metavar='LABELS', nargs='*', help="labels of the records whose thumbnails should be created")
+    parser.add_argument('-s', '--size', type=int, action='append', choices=THUMBNAIL_SIZES,
+                        help="the maximum width and height of the thumbnails, in pixels. Defaults to %d. To create thumbnails of several sizes, use the -s option multiple times." % DEFAULT_THUMBNAIL_SIZE)
+    args = parser.parse_args(argv)
+    project = load_project()
+    try:
+        n = project.generate_thumbnails(args.labels or None, args.size)
+    except ImportError as err:
+        print(err)
+        sys.exit(1)
+    print("Created %d thumbnail%s." % (n, n != 1 and "s" or ""))
+
+
 def version(argv):
     usage = "%(prog)s version"
     description = "Print the Sumatra version."
@@ -14,6 +14,9 @@ ArchivingFileSystemDataStore - provides methods for accessing files written to
                       a local file system then archived as .tar.gz.
 MirroredFileSystemDataStore - provides methods for accessing files written to
                       a local file system then mirrored to a web server
+ContentAddressedDataStore - provides methods for accessing files written to
+                      a local file system then moved to a deduplicating,
+                      content-addressed store
 
 Functions
 ---------
@@ -28,12 +31,10 @@ get_data_store() - return a DataStore object based on a class name and
 
 from .base import DataStore, DataKey, IGNORE_DIGEST
 from .filesystem import FileSystemDataStore
-from .archivingfs import ArchivingFileSystemDataStore
+from .archivingfs import ArchivingFileSystemDataStore, ARCHIVE_FORMATS
 from .mirroredfs import MirroredFileSystemDataStore
-try:
-    from .davfs import DavFsDataStore
-except ImportError:
-    pass
+from .contentaddressed import ContentAddressedDataStore
+from .davfs import DavFsDataStore
 from ..core import get_registered_components
 
 
@@ -1,6 +1,10 @@
 """
-Datastore based on files written to the local filesystem, archived in gzipped
-tar files, then retrieved from the tar files.
+Datastore based on files written to the local filesystem, archived in tar
+files (by default gzipped) or zip files, then retrieved from the archives.
+
+Each archive is accompanied by a sidecar index (a JSON file) giving the
+offset, size, modification time and SHA1 digest of every file it contains,
+so that individual files can be found and read without scanning the archive.
 
 
 :copyright: Copyright 2006-2020, 2024 by the Sumatra team, see doc/authors.txt
@@ -8,53 +12,260 @@ tar files, then retrieved from the tar files.
 """
 
 import os
+import bz2
+import gzip
+import hashlib
+import json
 import tarfile
+import tempfile
+import zipfile
 import shutil
 import logging
 import mimetypes
 import datetime
-from contextlib import closing
 from sumatra.core import TIMESTAMP_FORMAT, component
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 
-from .base import DataItem
+from .base import DataItem, DataKey
 from .filesystem import FileSystemDataStore
 
+ARCHIVE_FORMATS = ("tar.gz", "tar.bz2", "tar.zst", "tar", "zip")
+
+
+def _require_zstandard():
+    if zstandard is None:
+        raise ImportError("The 'zstandard' package is needed for the tar.zst archive format.")
+    return zstandard
+
+
+def _compressing_writer(fileobj, archive_format):
+    """Return a file object that compresses data before writing it to `fileobj`."""
+    if archive_format == "tar.gz":
+        # a fixed mtime makes the output reproducible
+        return gzip.GzipFile(filename="", fileobj=fileobj, mode='wb', mtime=0)
+    elif archive_format == "tar.bz2":
+        return bz2.BZ2File(fileobj, mode='wb')
+    elif archive_format == "tar.zst":
+        # use as many threads as there are CPU cores
+        return _require_zstandard().ZstdCompressor(threads=-1).stream_writer(fileobj, closefd=False)
+    elif archive_format == "tar":
+        return fileobj
+    raise ValueError("Unsupported tar archive format: %s" % archive_format)
+
+
+def _decompressing_reader(fileobj, archive_format):
+    """
+    Return a file object that decompresses data read from `fileobj`, and
+    which supports (at least forward) seeking.
+    """
+    if archive_format == "tar.gz":
+        return gzip.GzipFile(fileobj=fileobj, mode='rb')
+    elif archive_format == "tar.bz2":
+        return bz2.BZ2File(fileobj, mode='rb')
+    elif archive_format == "tar.zst":
+        return _require_zstandard().ZstdDecompressor().stream_reader(fileobj, closefd=False)
+    elif archive_format == "tar":
+        return fileobj
+    raise ValueError("Unsupported tar archive format: %s" % archive_format)
+
+
+class ArchiveMemberFile(object):
+    """
+    Read-only file-like object wrapping a member of an open archive, which
+    closes the archive (and any other given resources) when it is itself closed.
+    """
+
+    def __init__(self, member, *resources):
+        self._member = member
+        self._resources = resources
+
+    def read(self, size=-1):
+        return self._member.read(size)
+
+    def close(self):
+        self._member.close()
+        for resource in self._resources:
+            resource.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class ArchiveSlice(object):
+    """
+    Read-only file-like object giving access to `size` bytes starting at
+    `offset` within a seekable file.
+    """
+
+    def __init__(self, fileobj, offset, size):
+        fileobj.seek(offset)
+        self._fileobj = fileobj
+        self._remaining = size
+
+    def read(self, size=-1):
+        if size is None or size < 0 or size > self._remaining:
+            size = self._remaining
+        data = self._fileobj.read(size)
+        self._remaining -= len(data)
+        return data
+
+    def close(self):
+        pass
+
+
+class HashingReader(object):
+    """Wraps a file object, calculating the SHA1 digest of the data as it is read."""
+
+    def __init__(self, fileobj):
+        self._fileobj = fileobj
+        self.sha1 = hashlib.sha1()
+
+    def read(self, size=-1):
+        data = self._fileobj.read(size)
+        self.sha1.update(data)
+        return data
+
+    def hexdigest(self):
+        return self.sha1.hexdigest()
+
 
 class ArchivedDataFile(DataItem):
-    """A file-like object, that represents a file inside a tar archive"""
+    """A file-like object, that represents a file inside a tar or zip archive"""
     # current implementation just for real files
 
     def __init__(self, path, store, creation=None):
         self.path = path
+        self.store = store
         archive_label = self.path.split(os.path.sep)[0]
-        self.tarfile_path = os.path.join(store.archive_store, archive_label + ".tar.gz")
-        info = self._get_info()
-        self.size = info.size
-        self.creation = creation or datetime.datetime.fromtimestamp(info.mtime).replace(microsecond=0)
+        index = store._get_archive_index(archive_label)
+        # without an index (or with one written before the format was recorded),
+        # the format is found from the extension of the archive file
+        self.archive_format = index.get("format") or store._find_archive_format(archive_label)
+        self.tarfile_path = os.path.join(store.archive_store,
+                                         "%s.%s" % (archive_label, self.archive_format))
+        self._index_entry = index.get("members", {}).get(self.path)
+        if self._index_entry:
+            self.size = self._index_entry["size"]
+            mtime = self._index_entry["mtime"]
+        else:  # archive created by an older version of Sumatra, without an index
+            self.size, mtime = self._get_info()
+        self.creation = creation or datetime.datetime.fromtimestamp(mtime).replace(microsecond=0)
         self.name = os.path.basename(self.path)
         self.extension = os.path.splitext(self.name)
         self.mimetype, self.encoding = mimetypes.guess_type(self.path)
 
+    def _open_archive(self):
+        """
+        Open an archive that has no index, using the decompressor for its
+        format. Return the archive, as a TarFile or ZipFile, and the list of
+        objects to be closed after it.
+        """
+        raw = self.store._open_archive_file(self.tarfile_path)
+        try:
+            if self.archive_format == "zip":
+                return zipfile.ZipFile(raw, 'r'), [raw]
+            elif self.archive_format == "tar.zst":
+                # zstd streams cannot seek backwards, so the archive is read in stream mode
+                stream = _decompressing_reader(raw, self.archive_format)
+                return tarfile.open(fileobj=stream, mode='r|'), [stream, raw]
+            else:
+                return tarfile.open(fileobj=raw, mode='r'), [raw]
+        except Exception:
+            raw.close()
+            raise
+
+    def _get_member(self, archive):
+        """Return the TarInfo or ZipInfo of the file, in an archive opened by _open_archive()."""
+        if isinstance(archive, zipfile.ZipFile):
+            return archive.getinfo(self.path)
+        for info in archive:  # unlike getmember(), this also works in stream mode
+            if info.name == self.path:
+                return info
+        raise KeyError("%s not found in %s" % (self.path, self.tarfile_path))
+
     def _get_info(self):
-        with closing(tarfile.open(self.tarfile_path, 'r')) as data_archive:
-            info = data_archive.getmember(self.path)
-        return info
+        """Return the size and modification time of the file, from an archive without an index."""
+        archive, resources = self._open_archive()
+        try:
+            info = self._get_member(archive)
+        finally:
+            for resource in [archive] + resources:
+                resource.close()
+        if isinstance(info, zipfile.ZipInfo):
+            mtime = datetime.datetime(*info.date_time).timestamp()
+            return info.file_size, mtime
+        return info.size, info.mtime
+
+    @property
+    def indexed_digest(self):
+        """
+        SHA1 digest of the file as recorded in the archive index when the file
+        was archived, or None for archives without an index.
+
+        The index is only used to locate files within the archive and to
+        generate keys for newly archived files. The :attr:`digest` property is
+        always calculated from the archived content, so that a corrupted or
+        replaced archive is detected when a data item is retrieved.
+        """
+        return self._index_entry and self._index_entry["digest"] or None
+
+    def generate_key(self, digest=True):
+        if digest and self.indexed_digest:
+            # calculated from the original file while the archive was written
+            return DataKey(self.path, self.indexed_digest, self.creation, mimetype=self.mimetype,
+                           encoding=self.encoding, size=self.size)
+        return super(ArchivedDataFile, self).generate_key(digest)
 
     def get_content(self, max_length=None):
-        with closing(tarfile.open(self.tarfile_path, 'r')) as data_archive:
-            f = data_archive.extractfile(self.path)
+        with self.open() as f:
             if max_length:
                 content = f.read(max_length)
             else:
                 content = f.read()
-            f.close()
-            return content
+        return content
     content = property(fget=get_content)
 
-    @property
-    def sorted_content(self):
-        raise NotImplementedError
+    def open(self):
+        """
+        Return a file-like object from which the archived file can be read
+        without extracting it. The archive is closed along with the file object.
+
+        If the archive has an index, only the data up to the end of the
+        requested file are decompressed (nothing else for uncompressed tar
+        and zip archives), and tar headers are not parsed.
+        """
+        if self._index_entry:
+            raw = self.store._open_archive_file(self.tarfile_path)
+            try:
+                if self.archive_format == "zip":
+                    stream = zipfile.ZipFile(raw, 'r')
+                    member = stream.open(self.path)
+                else:
+                    stream = _decompressing_reader(raw, self.archive_format)
+                    member = ArchiveSlice(stream, self._index_entry["offset"], self.size)
+            except Exception:
+                raw.close()
+                raise
+            return ArchiveMemberFile(member, stream, raw)
+        archive, resources = self._open_archive()
+        try:
+            info = self._get_member(archive)
+            if isinstance(archive, zipfile.ZipFile):
+                member = archive.open(info)
+            else:
+                member = archive.extractfile(info)
+        except Exception:
+            for resource in [archive] + resources:
+                resource.close()
+            raise
+        return ArchiveMemberFile(member, archive, *resources)
 
 
 @component
@@ -66,16 +277,31 @@ class ArchivingFileSystemDataStore(FileSystemDataStore):
     """
     data_item_class = ArchivedDataFile
 
-    def __init__(self, root, archive=".smt/archive"):
+    def __init__(self, root, archive=".smt/archive", archive_format="tar.gz"):
         super(ArchivingFileSystemDataStore, self).__init__(root)
         self.archive_store = archive
-        # should allow specification of archive format, e.g. tar.gz or zip
+        self.archive_format = archive_format
+        self._archive_indexes = {}
 
     def __str__(self):
         return "{0} (archiving to {1})".format(self.root, self.archive_store)
 
     def __getstate__(self):
-        return {'root': self.root, 'archive': self.archive_store}
+        state = {'root': self.root, 'archive': self.archive_store}
+        # the default is omitted, so that the state of existing data stores,
+        # which may be stored in records, is unchanged
+        if self.archive_format != "tar.gz":
+            state['archive_format'] = self.archive_format
+        return state
+
+    def __get_archive_format(self):
+        return self._archive_format
+
+    def __set_archive_format(self, value):
+        if value not in ARCHIVE_FORMATS:
+            raise ValueError("Archive format must be one of %s" % ", ".join(ARCHIVE_FORMATS))
+        self._archive_format = value
+    archive_format = property(fget=__get_archive_format, fset=__set_archive_format)
 
     def find_new_data(self, timestamp):
         """Finds newly created/changed data items"""
@@ -85,24 +311,30 @@ class ArchivingFileSystemDataStore(FileSystemDataStore):
         return [ArchivedDataFile(path, self).generate_key()
                 for path in archive_paths]
 
+    def find_new_data_deferred(self, timestamp):
+        # the digests are calculated as the files are archived, at little extra cost
+        return self.find_new_data(timestamp)
+
     def _archive(self, label, files, delete_originals=True):
         """
         Archives files and, by default, deletes the originals.
         """
         if not os.path.exists(self.archive_store):
             os.mkdir(self.archive_store)
-        tf = tarfile.open(label + ".tar.gz",'w:gz')
-        logging.info("Archiving data to file %s" % tf.name)
-        # Add data files
-        archive_paths = []
-        for file_path in files:
-            archive_path = os.path.join(label, file_path)
-            tf.add(os.path.join(self.root, file_path), archive_path)
-            archive_paths.append(archive_path)
-        tf.close()
-        # Move the archive to self.archive_store
-        shutil.copy(tf.name, self.archive_store) # shutil.move() doesn't work as expected if dataroot is a symbolic link
-        os.remove(tf.name)
+        archive_file = os.path.join(self.archive_store, "%s.%s" % (label, self.archive_format))
+        logging.info("Archiving data to file %s" % archive_file)
+        # Write the archive directly into self.archive_store under a temporary
+        # name, then rename it, so a partially-written archive is never visible
+        tmp = tempfile.NamedTemporaryFile(dir=self.archive_store, prefix=".%s-" % label,
+                                          suffix=".partial", delete=False)
+        try:
+            with tmp:
+                archive_paths, index = self._write_archive(tmp, label, files)
+            os.replace(tmp.name, archive_file)
+        except BaseException:
+            os.remove(tmp.name)
+            raise
+        self._write_archive_index(label, index)
         # Delete original files.
         if delete_originals:
             for file_path in files:
@@ -110,7 +342,128 @@ class ArchivingFileSystemDataStore(FileSystemDataStore):
         self._last_label = label # useful for testing
         return archive_paths
 
-    def delete(self, *keys):
+    def _write_archive(self, fileobj, label, files):
+        """
+        Write an archive in the format given by self.archive_format to an open
+        file object.
+
+        Return the list of paths within the archive and an index giving the
+        offset, size, modification time and digest of each regular file.
+        """
+        if self.archive_format == "zip":
+            with zipfile.ZipFile(fileobj, 'w', zipfile.ZIP_DEFLATED) as zf:
+                return self._add_to_zip_archive(zf, label, files)
+        writer = _compressing_writer(fileobj, self.archive_format)
+        try:
+            with tarfile.open(fileobj=writer, mode='w|') as tf:
+                return self._add_to_archive(tf, label, files)
+        finally:
+            if writer is not fileobj:
+                writer.close()
+
+    def _add_to_zip_archive(self, zf, label, files):
+        """
+        Add files to an open zip archive, under the directory `label`.
+
+        Return the list of paths within the archive and an index giving the
+        size, modification time and digest of each file.
+        """
+        archive_paths = []
+        index = {}
+        for file_path in files:
+            archive_path = os.path.join(label, file_path)
+            full_path = os.path.join(self.root, file_path)
+            info = zipfile.ZipInfo.from_file(full_path, archive_path)
+            info.compress_type = zipfile.ZIP_DEFLATED
+            with open(full_path, 'rb') as fp, zf.open(info, 'w') as member:
+                reader = HashingReader(fp)
+                shutil.copyfileobj(reader, member)
+            index[archive_path] = {"offset": info.header_offset,
+                                   "size": info.file_size,
+                                   "mtime": os.stat(full_path).st_mtime,
+                                   "digest": reader.hexdigest()}
+            archive_paths.append(archive_path)
+        return archive_paths, index
+
+    def _add_to_archive(self, tf, label, files):
+        """
+        Add files to an open tar archive, under the directory `label`.
+
+        Return the list of paths within the archive and an index giving the
+        offset, size, modification time and digest of each regular file.
+        """
+        archive_paths = []
+        index = {}
+        for file_path in files:
+            archive_path = os.path.join(label, file_path)
+            full_path = os.path.join(self.root, file_path)
+            info = tf.gettarinfo(full_path, archive_path)
+            if info.isreg():
+                with open(full_path, 'rb') as fp:
+                    reader = HashingReader(fp)
+                    tf.addfile(info, reader)
+                padded_size = -(-info.size // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+                index[archive_path] = {"offset": tf.offset - padded_size,
+                                       "size": info.size,
+                                       "mtime": info.mtime,
+                                       "digest": reader.hexdigest()}
+            else:
+                tf.add(full_path, archive_path)
+            archive_paths.append(archive_path)
+        return archive_paths, index
+
+    def _index_path(self, label):
+        return os.path.join(self.archive_store, label + ".index.json")
+
+    def _write_archive_index(self, label, members):
+        index = {"format": self.archive_format, "members": members}
+        index_path = self._index_path(label)
+        with open(index_path + ".partial", 'w') as fp:
+            json.dump(index, fp)
+        os.replace(index_path + ".partial", index_path)
+        self._archive_indexes[label] = index
+
+    def _read_archive_index(self, label):
+        """Return the contents of the index file for an archive, or None."""
+        index_path = self._index_path(label)
+        if not os.path.exists(index_path):
+            return None
+        with open(index_path) as fp:
+            return json.load(fp)
+
+    def _get_archive_index(self, label):
+        """
+        Return the index of the archive with the given label: a dict containing
+        the archive format and a dict mapping archive paths to the offset,
+        size etc. of each file. Indexes are cached, since archives are never
+        modified once written.
+        """
+        if label not in self._archive_indexes:
+            index = self._read_archive_index(label)
+            if index is None:
+                return {}  # not cached, in case the archive is created later
+            self._archive_indexes[label] = index
+        return self._archive_indexes[label]
+
+    def _open_archive_file(self, path):
+        return open(path, 'rb')
+
+    def _archive_file_exists(self, path):
+        return os.path.exists(path)
+
+    def _find_archive_format(self, label):
+        """
+        Return the format of the archive with the given label, from the
+        extension of the archive file. Archives written by versions of Sumatra
+        that did not record the format were all .tar.gz.
+        """
+        for archive_format in ARCHIVE_FORMATS:
+            if self._archive_file_exists(os.path.join(self.archive_store,
+                                                      "%s.%s" % (label, archive_format))):
+                return archive_format
+        return "tar.gz"
+
+    def delete(self, *keys, verify_digests=True):
         """Delete the files corresponding to the given keys."""
         raise NotImplementedError("Deletion of individual files not supported.")
 
@@ -6,10 +6,17 @@
 """
 
 import hashlib
+import heapq
+import io
 import os.path
+import shutil
+import tempfile
+import warnings
 from ..core import component_type
 
 IGNORE_DIGEST = "0"*40
+DEFAULT_CHUNK_SIZE = 64 * 1024
+DEFAULT_SORT_BUFFER_SIZE = 16 * 1024 * 1024
 
 
 @component_type
@@ -32,6 +39,49 @@ class DataStore(object):
         """Finds newly created/changed data items"""
         raise NotImplementedError
 
+    def find_new_data_deferred(self, timestamp):
+        """
+        Finds newly created/changed data items, if possible without
+        calculating their digests, which may take a long time for large
+        files. The digests of the returned keys may be calculated later
+        using :meth:`calculate_digests`.
+
+        By default, this is the same as :meth:`find_new_data`, for data stores
+        that must in any case read the data in order to store them.
+        """
+        return self.find_new_data(timestamp)
+
+    def calculate_digests(self, *keys):
+        """
+        Calculate the digests of those keys returned by
+        :meth:`find_new_data_deferred` whose digests are still pending.
+
+        The keys are updated in place. Keys for data that have changed or been
+        deleted since the keys were generated are left unchanged. Returns the
+        list of keys whose digests were calculated.
+        """
+        completed = []
+        for key in keys:
+            if not key.digest_pending:
+                continue
+            try:
+                data_item = self.get_data_item(key)
+            except KeyError:
+                warnings.warn("Cannot calculate the digest of %s, as it no longer exists." % key.path)
+                continue
+            if self._has_changed(key, data_item):
+                warnings.warn("Cannot calculate the digest of %s, as it has changed since it was created." % key.path)
+                continue
+            key.digest = data_item.digest
+            del key.metadata["digest_pending"]
+            key.metadata.pop("mtime", None)
+            completed.append(key)
+        return completed
+
+    def _has_changed(self, key, data_item):
+        """Has the data item changed since the given (digest-pending) key was generated?"""
+        return "size" in key.metadata and key.metadata["size"] != data_item.size
+
     def get_data_item(self, key):
         """
         Return the file that matches the given key.
@@ -46,9 +96,12 @@ class DataStore(object):
         """
         return self.get_data_item(key).get_content(max_length)
 
-    def delete(self, *keys):
+    def delete(self, *keys, verify_digests=True):
         """
-        Delete the files corresponding to the given keys.
+        Delete the files corresponding to the given keys. Unless
+        `verify_digests` is False, only files whose content matches the
+        digest in the key are deleted; skipping this check is much faster
+        when deleting many large files.
         """
         raise NotImplementedError
 
@@ -86,6 +139,15 @@ class DataKey(object):
     def __repr__(self):
         return "%s(%s [%s])" % (self.path, self.digest, self.creation)
 
+    @property
+    def digest_pending(self):
+        """
+        True if the digest of the data item has not yet been calculated (see
+        :meth:`DataStore.find_new_data_deferred`). Until it is, the digest is
+        IGNORE_DIGEST, so the key matches the data item whatever its content.
+        """
+        return bool(self.metadata.get("digest_pending", False))
+
     def __eq__(self, other):
         return (self.path == other.path and
                 (self.digest == other.digest or IGNORE_DIGEST in (self.digest, other.digest)) and
@@ -95,6 +157,33 @@ class DataKey(object):
         return not self.__eq__(other)
 
 
+def _iter_lines(chunks):
+    """
+    Split an iterable of byte strings into lines, each terminated by a newline
+    (one is added to the last line if necessary).
+    """
+    pending = b""
+    for chunk in chunks:
+        lines = (pending + chunk).split(b"\n")
+        pending = lines.pop()
+        for line in lines:
+            yield line + b"\n"
+    if pending:
+        yield pending + b"\n"
+
+
+def _write_sorted_run(lines):
+    """
+    Sort the given lines and write them to an anonymous temporary file. Return
+    the file, positioned at its start.
+    """
+    run_file = tempfile.TemporaryFile()
+    lines.sort()
+    run_file.writelines(lines)
+    run_file.seek(0)
+    return run_file
+
+
 class DataItem(object):
     """Base class for data item classes, that may represent files or database records."""
 
@@ -103,24 +192,57 @@ class DataItem(object):
 
     @property
     def digest(self):
-        """docstring"""
-        return hashlib.sha1(self.content).hexdigest()
+        """SHA1 digest of the contents of the data item."""
+        sha1 = hashlib.sha1()
+        for chunk in self.iter_chunks():
+            sha1.update(chunk)
+        return sha1.hexdigest()
+
+    @property
+    def unordered_digest(self):
+        """
+        A digest of the contents of the data item that does not depend on the
+        order of the lines, i.e. two data items whose contents differ only in
+        line order have the same unordered digest.
+
+        This is calculated in a single pass over the data, with constant
+        memory use.
+        """
+        total = 0
+        for line in _iter_lines(self.iter_chunks()):
+            total += int(hashlib.sha1(line).hexdigest(), 16)
+        return "%040x" % (total % 2**160)
 
     def __eq__(self, other):
+        """
+        Data items are equal if they have the same content, or if their
+        contents differ only in line order. Items of different sizes are never
+        equal, so a file that differs from another only by a final newline is
+        not equal to it.
+        """
         if self.size != other.size:
             return False
-        elif self.content == other.content: # use digest here?
+        elif self.digest == other.digest:
             return True
         else:
-            return self.sorted_content == other.sorted_content
+            return self.unordered_digest == other.unordered_digest
 
     def __ne__(self, other):
         return not self.__eq__(other)
 
-    def generate_key(self):
-        """Generate a :class:`DataKey` uniquely identifying this data item."""
-        return DataKey(self.path, self.digest, self.creation, mimetype=self.mimetype,
-                       encoding=self.encoding, size=self.size)
+    def generate_key(self, digest=True):
+        """
+        Generate a :class:`DataKey` uniquely identifying this data item.
+
+        If *digest* is False, the digest is not calculated, and the key is
+        marked as digest-pending.
+        """
+        if digest:
+            return DataKey(self.path, self.digest, self.creation, mimetype=self.mimetype,
+                           encoding=self.encoding, size=self.size)
+        else:
+            return DataKey(self.path, IGNORE_DIGEST, self.creation, mimetype=self.mimetype,
+                           encoding=self.encoding, size=self.size, digest_pending=True)
 
     def get_content(self, max_length=None):
         """
@@ -131,9 +253,64 @@ class DataItem(object):
         """
         raise NotImplementedError
 
+    def open(self):
+        """
+        Return a binary, read-only file-like object giving access to the
+        contents of the data item.
+
+        Subclasses should override this to avoid reading the entire content
+        into memory.
+        """
+        return io.BytesIO(self.get_content())
+
+    def iter_chunks(self, chunk_size=DEFAULT_CHUNK_SIZE):
+        """
+        Iterate over the contents of the data item in chunks of at most
+        *chunk_size* bytes.
+        """
+        with self.open() as fp:
+            while True:
+                chunk = fp.read(chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+
+    def iter_sorted_lines(self, buffer_size=DEFAULT_SORT_BUFFER_SIZE):
+        """
+        Iterate over the lines of the data item in sorted order. Each line is
+        terminated by a newline, even if the last line of the data is not.
+
+        Data larger than *buffer_size* bytes are sorted in runs, which are
+        written to anonymous temporary files and then merged, so memory use
+        is bounded.
+        """
+        runs = []
+        try:
+            run = []
+            run_size = 0
+            for line in _iter_lines(self.iter_chunks()):
+                run.append(line)
+                run_size += len(line)
+                if run_size >= buffer_size:
+                    runs.append(_write_sorted_run(run))
+                    run = []
+                    run_size = 0
+            run.sort()
+            if not runs:
+                for line in run:
+                    yield line
+            else:
+                for line in heapq.merge(run, *runs):
+                    yield line
+        finally:
+            for run_file in runs:
+                run_file.close()
+
+    @property
     def sorted_content(self):
         """Return the contents of the data item, sorted by line."""
-        raise NotImplementedError
+        content = b"".join(self.iter_sorted_lines())
+        return content[:self.size]  # remove the newline added if the data did not end with one
 
     def save_copy(self, path):
         """
@@ -145,13 +322,18 @@ class DataItem(object):
 
         Return the full path of the final file.
         """
+        full_path = self._copy_destination(path)
+        with self.open() as src, open(full_path, "wb") as dst:
+            shutil.copyfileobj(src, dst, DEFAULT_CHUNK_SIZE)
+        return full_path
+
+    def _copy_destination(self, path):
+        """Determine the full path for save_copy(), creating directories as needed."""
         if os.path.isdir(path):
             full_path = os.path.join(path, self.path)
         else:
             full_path = path
         dir = os.path.dirname(full_path)
-        if not os.path.exists(dir):
+        if dir and not os.path.exists(dir):
             os.makedirs(dir)
-        with open(full_path, "w") as fp:
-            fp.write(self.content)
         return full_path
@@ -0,0 +1,132 @@
+"""
+A bounded, on-disk cache for the contents of data items held remotely, shared
+by the datastores that retrieve data over the network.
+
+Cached copies are identified by the URL of the data and by its SHA1 digest,
+and are checked against the digest when they are downloaded. When the total
+size of the cache exceeds its limit, the least recently used copies are
+removed.
+
+The location and size of the cache may be set with the environment variables
+SMT_CACHE_DIR (default ~/.cache/sumatra) and SMT_CACHE_SIZE (in bytes, default
+1 GiB). Setting SMT_CACHE_SIZE to 0 disables caching.
+
+
+:copyright: Copyright 2006-2020, 2024 by the Sumatra team, see doc/authors.txt
+:license: BSD 2-clause, see LICENSE for details.
+"""
+
+import os
+import hashlib
+import tempfile
+from contextlib import closing
+from .base import IGNORE_DIGEST, DEFAULT_CHUNK_SIZE
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "sumatra")
+DEFAULT_CACHE_SIZE = 1024 ** 3
+
+
+class DataCache(object):
+    """An on-disk cache of data items, with least-recently-used eviction."""
+
+    def __init__(self, path, max_size=DEFAULT_CACHE_SIZE):
+        self.path = path
+        self.max_size = max_size
+
+    def __str__(self):
+        return self.path
+
+    def _entry_path(self, url, digest):
+        key = hashlib.sha1(("%s\n%s" % (url, digest)).encode("utf-8")).hexdigest()
+        return os.path.join(self.path, key)
+
+    def get(self, url, digest):
+        """
+        Return the path of the cached copy of the data at `url` with the given
+        digest, or None if it is not in the cache.
+        """
+        if digest in (None, IGNORE_DIGEST):  # never cached
+            return None
+        entry_path = self._entry_path(url, digest)
+        try:
+            os.utime(entry_path)  # record the access, for LRU eviction
+        except OSError:
+            return None
+        return entry_path
+
+    def fetch(self, url, digest, opener):
+        """
+        Return the path of a cached copy of the data at `url`. If it is not
+        already cached, `opener()` is called to obtain a file-like object from
+        which the data are read.
+
+        Raises KeyError if the downloaded data do not match `digest`, and
+        ValueError if the digest is not known, since data that cannot be
+        checked are not cached.
+        """
+        if digest in (None, IGNORE_DIGEST):
+            raise ValueError("Data can only be cached under a known digest.")
+        cached_path = self.get(url, digest)
+        if cached_path:
+            return cached_path
+        entry_path = self._entry_path(url, digest)
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+        fd, tmp_path = tempfile.mkstemp(dir=self.path, suffix=".partial")
+        sha1 = hashlib.sha1()
+        try:
+            with os.fdopen(fd, 'wb') as dst, closing(opener()) as src:
+                for chunk in iter(lambda: src.read(DEFAULT_CHUNK_SIZE), b""):
+                    sha1.update(chunk)
+                    dst.write(chunk)
+            if sha1.hexdigest() != digest:
+                raise KeyError("Digests do not match.")
+            os.replace(tmp_path, entry_path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        self._evict(keep=entry_path)
+        return entry_path
+
+    def size(self):
+        """Return the total size in bytes of the cached data."""
+        return sum(size for mtime, size, path in self._entries())
+
+    def _entries(self):
+        entries = []
+        for file_name in os.listdir(self.path):
+            if file_name.endswith(".partial"):
+                continue
+            entry_path = os.path.join(self.path, file_name)
+            try:
+                stats = os.stat(entry_path)
+            except OSError:  # removed by another process
+                continue
+            entries.append((stats.st_mtime, stats.st_size, entry_path))
+        return entries
+
+    def _evict(self, keep=None):
+        """Remove the least recently used entries until the cache fits within max_size."""
+        entries = sorted(self._entries())
+        total = sum(size for mtime, size, path in entries)
+        for mtime, size, entry_path in entries:
+            if total <= self.max_size:
+                break
+            if entry_path == keep:
+                continue
+            try:
+                os.remove(entry_path)
+            except OSError:
+                pass
+            total -= size
+
+
+def get_cache():
+    """
+    Return the cache configured by the SMT_CACHE_DIR and SMT_CACHE_SIZE
+    environment variables, or None if caching is disabled.
+    """
+    max_size = int(os.environ.get("SMT_CACHE_SIZE", DEFAULT_CACHE_SIZE))
+    if max_size <= 0:
+        return None
+    return DataCache(os.environ.get("SMT_CACHE_DIR", DEFAULT_CACHE_DIR), max_size)
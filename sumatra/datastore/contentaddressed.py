@@ -0,0 +1,264 @@
+"""
+Datastore based on files written to the local filesystem, which are then moved
+into a content-addressed store, in which each distinct file content is stored
+only once, under its SHA1 digest.
+
+For each computation, a manifest (a JSON file) maps the paths of the output
+files to their digests. For each stored content, a directory contains one
+empty file per path referring to it, so that the content can be deleted once
+it is no longer referred to, without reading every manifest.
+
+
+:copyright: Copyright 2006-2020, 2024 by the Sumatra team, see doc/authors.txt
+:license: BSD 2-clause, see LICENSE for details.
+"""
+
+import os
+import errno
+import hashlib
+import json
+import logging
+import mimetypes
+import shutil
+import stat
+import tempfile
+import warnings
+from datetime import datetime, timezone
+from urllib.parse import quote
+from ..core import TIMESTAMP_FORMAT, component
+from .base import DEFAULT_CHUNK_SIZE, DataKey
+from .filesystem import DataFile, FileSystemDataStore
+
+
+def file_digest(path):
+    """Return the SHA1 digest of the file at the given path."""
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(DEFAULT_CHUNK_SIZE), b""):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+class ContentAddressedDataFile(DataFile):
+    """
+    A file-like object, that represents a file in a content-addressed store.
+
+    The digest recorded in the manifest (:attr:`manifest_digest`) is used
+    only to locate the stored content. The :attr:`digest` property is
+    calculated from the content, so that a corrupted or truncated file is
+    detected when a data item is retrieved.
+    """
+
+    def __init__(self, path, store, creation=None):
+        self.path = path
+        label = self.path.split(os.path.sep)[0]
+        entry = store._get_manifest(label).get(self.path)
+        if entry is None:
+            raise IOError("File %s does not exist" % self.path)
+        self.manifest_digest = entry["digest"]
+        self.full_path = store._blob_path(self.manifest_digest)
+        if not os.path.exists(self.full_path):
+            raise IOError("File %s does not exist" % self.full_path)
+        self.size = entry["size"]
+        self.creation = creation or datetime.fromtimestamp(entry["mtime"], tz=timezone.utc).replace(microsecond=0)
+        self.name = os.path.basename(self.path)
+        self.extension = os.path.splitext(self.name)
+        self.mimetype, self.encoding = mimetypes.guess_type(self.path)
+
+    def generate_key(self, digest=True):
+        if digest:
+            # the manifest digest was calculated from the file as it was stored
+            return DataKey(self.path, self.manifest_digest, self.creation, mimetype=self.mimetype,
+                           encoding=self.encoding, size=self.size)
+        return super(ContentAddressedDataFile, self).generate_key(digest)
+
+
+@component
+class ContentAddressedDataStore(FileSystemDataStore):
+    """
+    Represents a locally-mounted filesystem from which any new files created
+    in it are moved into a content-addressed store, so that files with
+    identical content, e.g. from different computations in a parameter sweep,
+    are stored only once.
+
+    Where possible, files are moved into the store using hard links, so that
+    no data are copied.
+    """
+    data_item_class = ContentAddressedDataFile
+
+    def __init__(self, root, blobs=".smt/blobs"):
+        super(ContentAddressedDataStore, self).__init__(root)
+        self.blob_store = blobs
+        self._manifests = {}
+
+    def __str__(self):
+        return "{0} (content-addressed store in {1})".format(self.root, self.blob_store)
+
+    def __getstate__(self):
+        return {'root': self.root, 'blobs': self.blob_store}
+
+    def find_new_data(self, timestamp):
+        """Finds newly created/changed data items"""
+        new_files = self._find_new_data_files(timestamp)
+        label = timestamp.strftime(TIMESTAMP_FORMAT)
+        paths = self._store(label, new_files)
+        return [ContentAddressedDataFile(path, self).generate_key()
+                for path in paths]
+
+    def find_new_data_deferred(self, timestamp):
+        # the digests are needed to store the files
+        return self.find_new_data(timestamp)
+
+    def _blob_path(self, digest):
+        return os.path.join(self.blob_store, "objects", digest[:2], digest[2:])
+
+    def _manifest_path(self, label):
+        return os.path.join(self.blob_store, "manifests", label + ".json")
+
+    def _references_dir(self, digest):
+        return os.path.join(self.blob_store, "refs", digest[:2], digest[2:])
+
+    def _reference_path(self, digest, path):
+        return os.path.join(self._references_dir(digest), quote(path, safe=""))
+
+    def _store(self, label, files):
+        """
+        Move files into the content-addressed store, and write a manifest
+        mapping their paths to their digests.
+        """
+        logging.info("Storing data in %s" % self.blob_store)
+        self._check_references()
+        manifest = {}
+        for file_path in files:
+            full_path = os.path.join(self.root, file_path)
+            path = os.path.join(label, file_path)
+            digest = file_digest(full_path)
+            stats = os.stat(full_path)
+            # the reference is added first, so that the content cannot be
+            # deleted in the meantime
+            self._add_reference(digest, path)
+            self._add_blob(full_path, digest)
+            os.remove(full_path)
+            manifest[path] = {"digest": digest,
+                              "size": stats.st_size,
+                              "mtime": stats.st_mtime}
+        self._write_manifest(label, manifest)
+        self._last_label = label  # useful for testing
+        return sorted(manifest)
+
+    def _add_blob(self, full_path, digest):
+        """
+        Add the file at `full_path` to the store, unless a file with the same
+        content is already there.
+        """
+        blob_path = self._blob_path(digest)
+        if os.path.exists(blob_path):
+            return
+        blob_dir = os.path.dirname(blob_path)
+        if not os.path.exists(blob_dir):
+            os.makedirs(blob_dir)
+        try:
+            os.link(full_path, blob_path)
+        except FileExistsError:  # another process stored the same content
+            return
+        except OSError as err:
+            if err.errno not in (errno.EXDEV, errno.EPERM, errno.ENOTSUP, errno.EMLINK):
+                raise
+            # hard links not possible, e.g. store is on a different filesystem
+            fd, tmp_path = tempfile.mkstemp(dir=blob_dir, suffix=".partial")
+            os.close(fd)
+            shutil.copyfile(full_path, tmp_path)
+            os.replace(tmp_path, blob_path)
+        # blobs may be shared between records, so must not be modified
+        os.chmod(blob_path, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+
+    def _write_manifest(self, label, manifest):
+        manifest_path = self._manifest_path(label)
+        manifest_dir = os.path.dirname(manifest_path)
+        if not os.path.exists(manifest_dir):
+            os.makedirs(manifest_dir)
+        with open(manifest_path + ".partial", 'w') as fp:
+            json.dump(manifest, fp)
+        os.replace(manifest_path + ".partial", manifest_path)
+        self._manifests[label] = manifest
+
+    def _get_manifest(self, label):
+        """
+        Return a dict mapping paths to the digest, size and modification time
+        of each file stored for the given label.
+        """
+        if label not in self._manifests:
+            manifest_path = self._manifest_path(label)
+            if not os.path.exists(manifest_path):
+                return {}
+            with open(manifest_path) as fp:
+                self._manifests[label] = json.load(fp)
+        return self._manifests[label]
+
+    def _add_reference(self, digest, path):
+        """Record that the file at `path` has the content with the given digest."""
+        os.makedirs(self._references_dir(digest), exist_ok=True)
+        open(self._reference_path(digest, path), 'w').close()
+
+    def _remove_reference(self, digest, path):
+        """
+        Remove the reference from `path` to the content with the given digest.
+        Return True if no references to the content remain.
+        """
+        try:
+            os.remove(self._reference_path(digest, path))
+        except FileNotFoundError:
+            pass
+        try:
+            os.rmdir(self._references_dir(digest))  # fails unless empty
+        except FileNotFoundError:
+            return True
+        except OSError:
+            return False
+        return True
+
+    def _check_references(self):
+        """
+        Stores created by earlier versions of Sumatra have manifests but no
+        references: create the references from the manifests, once.
+        """
+        refs_dir = os.path.join(self.blob_store, "refs")
+        if os.path.exists(refs_dir):
+            return
+        manifest_dir = os.path.join(self.blob_store, "manifests")
+        if os.path.exists(manifest_dir):
+            for file_name in os.listdir(manifest_dir):
+                if file_name.endswith(".json"):
+                    manifest = self._get_manifest(file_name[:-len(".json")])
+                    for path, entry in manifest.items():
+                        self._add_reference(entry["digest"], path)
+        os.makedirs(refs_dir, exist_ok=True)
+
+    def delete(self, *keys, verify_digests=True):
+        """
+        Delete the files corresponding to the given keys. The stored content
+        is deleted only once no other file refers to it. Since the content is
+        identified by its digest, `verify_digests` has no effect.
+        """
+        self._check_references()
+        for key in keys:
+            label = key.path.split(os.path.sep)[0]
+            manifest = self._get_manifest(label)
+            if key.path not in manifest:
+                warnings.warn("Tried to delete %s, but it did not exist." % key)
+                continue
+            digest = manifest.pop(key.path)["digest"]
+            if manifest:
+                self._write_manifest(label, manifest)
+            else:
+                os.remove(self._manifest_path(label))
+                del self._manifests[label]
+            if self._remove_reference(digest, key.path):
+                try:
+                    os.remove(self._blob_path(digest))
+                except FileNotFoundError:
+                    pass
+
+    def contains_path(self, path):
+        label = path.split(os.path.sep)[0]
+        return path in self._get_manifest(label)
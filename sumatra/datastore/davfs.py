@@ -1,63 +1,127 @@
 '''
 Datastore via remote webdav connection
+
+Archives are built locally, then uploaded in segments, several at a time
+(see :mod:`sumatra.datastore.segmented`). An archive whose upload fails is
+kept locally, and the upload is resumed later.
 '''
 
 import os
-import tarfile
+import json
 import logging
-from fs.contrib.davfs import DAVFS
+import warnings
 from urllib.parse import urlparse
-from contextlib import closing
+try:
+    from fs.contrib.davfs import DAVFS
+    from fs.errors import FSError
+    have_davfs = True
+except ImportError:
+    FSError = IOError
+    have_davfs = False
 
 from sumatra.core import component
 from .archivingfs import ArchivingFileSystemDataStore, ArchivedDataFile, TIMESTAMP_FORMAT
+from .base import IGNORE_DIGEST
+from .cache import get_cache
+from .segmented import (SegmentedUploader, SegmentedFile, read_manifest, manifest_path,
+                        DEFAULT_SEGMENT_SIZE)
 
 
 class DavFsDataItem(ArchivedDataFile):
-    """Base class for data item classes, that may represent files or database records."""
+    """
+    A file-like object, that represents a file inside an archive stored on a
+    WebDAV server. Files read from the server are kept in a local cache.
+    """
+
+    @property
+    def url(self):
+        return "%s/%s#%s" % (self.store.dav_url.rstrip("/"), self.tarfile_path, self.path)
 
-    def __init__(self, path, store):
-        # needs to be first cause _get_info is called in Base __init__
-        self.store = store
-        super(DavFsDataItem, self).__init__(path, store)
+    def _cached_path(self):
+        """
+        Return the path of a cached copy of the file, downloading it if
+        necessary, or None if it cannot be cached, e.g. because the archive
+        has no index giving the digest of the file.
+        """
+        cache = get_cache()
+        if cache is None or self.indexed_digest in (None, IGNORE_DIGEST):
+            return None
+        return cache.fetch(self.url, self.indexed_digest, super(DavFsDataItem, self).open)
+
+    def open(self):
+        cached_path = self._cached_path()
+        if cached_path is None:
+            return super(DavFsDataItem, self).open()
+        return open(cached_path, 'rb')
+
+    @property
+    def digest(self):
+        if self._cached_path():
+            # the cache checks the downloaded content against the digest
+            return self.indexed_digest
+        return super(DavFsDataItem, self).digest
+
+    def is_available_locally(self):
+        """Is the file available from the cache, without downloading it?"""
+        cache = get_cache()
+        return bool(cache and self.indexed_digest not in (None, IGNORE_DIGEST)
+                    and cache.get(self.url, self.indexed_digest))
 
     def get_content(self, max_length=None):
-        obj = self.store.dav_fs.open(self.tarfile_path, 'rb')
-        with closing(tarfile.open(fileobj=obj)) as data_archive:
-            f = data_archive.extractfile(self.path)
-            if max_length:
-                content = f.read(max_length)
-            else:
-                content = f.read()
-            f.close()
-            return content
-
-    # mandatory repeat
+        if max_length and not self.is_available_locally():
+            # read only the start of the archive member, rather than
+            # downloading all of it into the cache
+            with super(DavFsDataItem, self).open() as f:
+                return f.read(max_length)
+        return super(DavFsDataItem, self).get_content(max_length)
     content = property(fget=get_content)
 
-    def _get_info(self):
-        obj = self.store.dav_fs.open(self.tarfile_path, 'rb')
-        with closing(tarfile.open(fileobj=obj)) as data_archive:
-            return data_archive.getmember(self.path)
-        return tarfile.TarInfo()
-
 
 @component
 class DavFsDataStore(ArchivingFileSystemDataStore):
-    """ArchivingFileSystemDataStore that archives to webdav storage"""
+    """
+    ArchivingFileSystemDataStore that archives to webdav storage.
+
+    Archives are uploaded in segments of `segment_size` bytes, using
+    `upload_threads` parallel connections. A segment whose upload fails is
+    retried up to `max_retries` times, with exponentially increasing delays
+    starting from `retry_delay` seconds. If set, `progress_callback` is called
+    with the number of bytes uploaded so far and the total number of bytes.
+
+    Archives are written to the local directory `pending_dir` before being
+    uploaded, and remain there until the upload is complete. If an upload
+    fails, a warning is emitted, the data remain readable from the local copy,
+    and the upload is resumed, skipping the segments already uploaded, the
+    next time data are archived or when :meth:`upload_pending` is called.
+    """
 
     data_item_class = DavFsDataItem
-
-    def __init__(self, root, dav_url, dav_user=None, dav_pw=None):
-        super(DavFsDataStore, self).__init__(root)
+    segment_size = DEFAULT_SEGMENT_SIZE
+    upload_threads = 4
+    max_retries = 3
+    retry_delay = 1.0
+    progress_callback = None
+    pending_dir = ".smt/pending_uploads"
+
+    def __init__(self, root, dav_url, dav_user=None, dav_pw=None, archive_format="tar.gz"):
+        super(DavFsDataStore, self).__init__(root, archive_format=archive_format)
         parsed = urlparse(dav_url)
         self.dav_user = dav_user or parsed.username
         self.dav_pw = dav_pw or parsed.password
         self.dav_url = parsed.geturl()
-        self.dav_fs = DAVFS(url=self.dav_url, credentials={'username': self.dav_user, 'password': self.dav_pw})
+        self.dav_fs = self._connect()
+
+    def _connect(self):
+        if not have_davfs:
+            raise ImportError("Please install the fs package to use a WebDAV data store.")
+        return DAVFS(url=self.dav_url, credentials={'username': self.dav_user, 'password': self.dav_pw})
 
     def __getstate__(self):
-        return {'root': self.root, 'dav_url': self.dav_url, 'dav_user': self.dav_user, 'dav_pw': self.dav_pw}
+        state = {'root': self.root, 'dav_url': self.dav_url, 'dav_user': self.dav_user, 'dav_pw': self.dav_pw}
+        # as for ArchivingFileSystemDataStore, the default is omitted
+        if self.archive_format != "tar.gz":
+            state['archive_format'] = self.archive_format
+        return state
 
     def find_new_data(self, timestamp):
         """Finds newly created/changed data items"""
@@ -69,26 +133,113 @@ class DavFsDataStore(ArchivingFileSystemDataStore):
 
     def _archive(self, label, files, delete_originals=True):
         """
-        Archives files and, by default, deletes the originals.
+        Archives files and, by default, deletes the originals, then uploads
+        the archive.
         """
-        fs = self.dav_fs
-        if not fs.isdir(self.archive_store):
-            fs.makedir(self.archive_store, recursive=True)
-        tf_obj = fs.open(os.path.join(self.archive_store, label + ".tar.gz"), mode='wb')
-        with tarfile.open(fileobj=tf_obj, mode='w:gz') as tf:
-            logging.info("Archiving data to file %s" % tf.name)
-            # Add data files
-            archive_paths = []
-            for file_path in files:
-                archive_path = os.path.join(label, file_path)
-                tf.add(os.path.join(self.root, file_path), archive_path)
-                archive_paths.append(archive_path)
-            tf.close()
-        tf_obj.close()
+        if not os.path.exists(self.pending_dir):
+            os.makedirs(self.pending_dir)
+        local_path = os.path.join(self.pending_dir, "%s.%s" % (label, self.archive_format))
+        logging.info("Archiving data to file %s" % local_path)
+        try:
+            with open(local_path + ".partial", 'wb') as tf_obj:
+                archive_paths, members = self._write_archive(tf_obj, label, files)
+            os.replace(local_path + ".partial", local_path)
+        except BaseException:
+            os.remove(local_path + ".partial")
+            raise
+        index = {"format": self.archive_format, "members": members}
+        with open(self._pending_index_path(label), 'w') as fp:
+            json.dump(index, fp)
+        self._archive_indexes[label] = index
 
         # Delete original files.
         if delete_originals:
             for file_path in files:
                 os.remove(os.path.join(self.root, file_path))
         self._last_label = label # useful for testing
+        self.upload_pending()
         return archive_paths
+
+    def _pending_index_path(self, label):
+        return os.path.join(self.pending_dir, label + ".index.json")
+
+    def upload_pending(self):
+        """
+        Upload the archives in `pending_dir`, resuming interrupted uploads.
+        Archives are removed from `pending_dir` once they have been uploaded.
+        Return the labels of the archives that could not be uploaded.
+        """
+        if not os.path.isdir(self.pending_dir):
+            return []
+        failed = []
+        for name in sorted(os.listdir(self.pending_dir)):
+            if not name.endswith(".index.json"):
+                continue
+            label = name[:-len(".index.json")]
+            with open(self._pending_index_path(label)) as fp:
+                index = json.load(fp)
+            archive_name = "%s.%s" % (label, index["format"])
+            local_path = os.path.join(self.pending_dir, archive_name)
+            try:
+                fs = self.dav_fs
+                if not fs.isdir(self.archive_store):
+                    fs.makedir(self.archive_store, recursive=True)
+                uploader = SegmentedUploader(self._connect, segment_size=self.segment_size,
+                                             threads=self.upload_threads, max_retries=self.max_retries,
+                                             retry_delay=self.retry_delay, retry_exceptions=(IOError, FSError),
+                                             progress_callback=self.progress_callback)
+                uploader.upload(local_path, os.path.join(self.archive_store, archive_name))
+                self._write_archive_index(label, index["members"], index["format"])
+            except (IOError, FSError) as err:
+                warnings.warn("Upload of %s failed (%s). It will be retried the next time data "
+                              "are archived." % (local_path, err))
+                failed.append(label)
+                continue
+            os.remove(local_path)
+            os.remove(self._pending_index_path(label))
+        return failed
+
+    def get_content(self, key, max_length=None):
+        """
+        Return the contents of a file identified by a key.
+
+        If `max_length` is given, the return value will be truncated. In this
+        case, if the file is not in the local cache, only the beginning of the
+        file is downloaded, and the digest is not checked.
+        """
+        if max_length:
+            data_item = self.data_item_class(key.path, self, key.creation)
+            if not data_item.is_available_locally():
+                return data_item.get_content(max_length)
+        return super(DavFsDataStore, self).get_content(key, max_length)
+
+    def _write_archive_index(self, label, members, archive_format=None):
+        index = {"format": archive_format or self.archive_format, "members": members}
+        with self.dav_fs.open(self._index_path(label), mode='w') as fp:
+            json.dump(index, fp)
+        self._archive_indexes[label] = index
+
+    def _read_archive_index(self, label):
+        pending_index_path = self._pending_index_path(label)
+        if os.path.exists(pending_index_path):  # not yet uploaded
+            with open(pending_index_path) as fp:
+                return json.load(fp)
+        index_path = self._index_path(label)
+        if not self.dav_fs.exists(index_path):
+            return None
+        with self.dav_fs.open(index_path) as fp:
+            return json.load(fp)
+
+    def _archive_file_exists(self, path):
+        local_path = os.path.join(self.pending_dir, os.path.basename(path))
+        return (os.path.exists(local_path) or self.dav_fs.exists(manifest_path(path))
+                or self.dav_fs.exists(path))
+
+    def _open_archive_file(self, path):
+        local_path = os.path.join(self.pending_dir, os.path.basename(path))
+        if os.path.exists(local_path):  # not yet uploaded
+            return open(local_path, 'rb')
+        manifest = read_manifest(self.dav_fs, path)
+        if manifest:
+            return SegmentedFile(self.dav_fs, path, manifest)
+        return self.dav_fs.open(path, 'rb')
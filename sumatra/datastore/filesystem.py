@@ -9,7 +9,7 @@ Datastore based on files written to and retrieved from a local filesystem.
 import os
 from datetime import datetime, timezone
 import mimetypes
-from subprocess import Popen
+import shutil
 import warnings
 from pathlib import Path
 from ..core import component
@@ -43,22 +43,19 @@ class DataFile(DataItem):
         return content
     content = property(fget=get_content)
 
-    @property
-    def sorted_content(self):
-        sorted_path = "%s,sorted" % self.full_path
-        if not os.path.exists(sorted_path):
-            cmd = "sort %s > %s" % (self.full_path, sorted_path)
-            job = Popen(cmd, shell=True)
-            job.wait()
-        with open(sorted_path, 'rb') as f:
-            content = f.read()
-        if len(content) != self.size:  # sort adds a \n if the file does not end with one
-            assert len(content) == self.size + 1
-            content = content[:-1]
-        return content
+    def open(self):
+        return open(self.full_path, 'rb')
 
-    # should probably override save_copy() from base class,
-    # as a filesystem copy will be much faster
+    def save_copy(self, path):
+        """
+        Save a copy of the file to a local path (see :meth:`DataItem.save_copy`).
+
+        This is a filesystem copy, which does not pass the data through Python
+        where the platform supports it (e.g. ``sendfile()`` on Linux).
+        """
+        full_path = self._copy_destination(path)
+        shutil.copyfile(self.full_path, full_path)
+        return full_path
 
 
 @component
@@ -124,6 +121,26 @@ class FileSystemDataStore(DataStore):
         return [DataFile(path, self).generate_key()
                 for path in self._find_new_data_files(timestamp)]
 
+    def find_new_data_deferred(self, timestamp):
+        """
+        Finds newly created/changed data items, without calculating their
+        digests. The keys record the size and modification time of each file,
+        so that changes made before the digests are calculated can be detected.
+        """
+        keys = []
+        for path in self._find_new_data_files(timestamp):
+            data_item = self.data_item_class(path, self)
+            key = data_item.generate_key(digest=False)
+            key.metadata["mtime"] = os.path.getmtime(data_item.full_path)
+            keys.append(key)
+        return keys
+
+    def _has_changed(self, key, data_item):
+        if super(FileSystemDataStore, self)._has_changed(key, data_item):
+            return True
+        return ("mtime" in key.metadata and os.path.exists(data_item.full_path)
+                and key.metadata["mtime"] != os.path.getmtime(data_item.full_path))
+
     def get_data_item(self, key):
         """
         Return the file that matches the given key.
@@ -136,19 +153,28 @@ class FileSystemDataStore(DataStore):
             raise KeyError("Digests do not match.")  # add info about file sizes?
         return df
 
-    def delete(self, *keys):
+    def delete(self, *keys, verify_digests=True):
         """
-        Delete the files corresponding to the given keys.
+        Delete the files corresponding to the given keys. Unless
+        `verify_digests` is False, only files whose content matches the
+        digest in the key are deleted.
         """
         for key in keys:
-            try:
-                data_item = self.get_data_item(key)
-            except KeyError:
+            if verify_digests:
+                try:
+                    full_path = self.get_data_item(key).full_path
+                except KeyError:
+                    full_path = None
+            else:
+                full_path = os.path.join(self.root, key.path)
+                if not os.path.isfile(full_path):
+                    full_path = None
+            if full_path is None:
                 warnings.warn("Tried to delete %s, but it did not exist." % key)
             else:
-                os.remove(data_item.full_path)
-                if len(os.listdir(self.root)) == 0:
-                    os.rmdir(self.root)
+                os.remove(full_path)
+        if keys and os.path.isdir(self.root) and len(os.listdir(self.root)) == 0:
+            os.rmdir(self.root)
 
     def contains_path(self, path):
         return os.path.isfile(os.path.join(self.root, path))
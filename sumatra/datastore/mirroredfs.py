@@ -5,6 +5,9 @@ available at some URL.
 The datastore itself does not take care of the mirroring, it is up to the
 user to take care of this.
 
+Files downloaded from the mirror are kept in a local cache (see
+:mod:`sumatra.datastore.cache`).
+
 
 :copyright: Copyright 2006-2020, 2024 by the Sumatra team, see doc/authors.txt
 :license: BSD 2-clause, see LICENSE for details.
@@ -13,9 +16,10 @@ user to take care of this.
 import datetime
 import os
 import mimetypes
-from urllib.request import urlopen
+from urllib.request import Request, urlopen
 from ..core import component
-from .base import DataItem
+from .base import DataItem, IGNORE_DIGEST
+from .cache import get_cache
 from .filesystem import FileSystemDataStore
 
 
@@ -25,8 +29,9 @@ class MirroredDataFile(DataItem):
     file system and on a webserver.
     """
 
-    def __init__(self, path, store, creation=None):
+    def __init__(self, path, store, creation=None, expected_digest=None):
         self.path = path
+        self.expected_digest = expected_digest
         self.full_path = os.path.join(store.root, path)
         if os.path.exists(self.full_path):
             stats = os.stat(self.full_path)
@@ -40,22 +45,59 @@ class MirroredDataFile(DataItem):
         self.mimetype, self.encoding = mimetypes.guess_type(self.full_path)
         self.url = store.mirror_base_url + self.path
 
-    def get_content(self, max_length=None):
+    def _cached_path(self):
+        """
+        Return the path of a cached copy of the mirrored file, downloading it
+        if necessary, or None if it cannot be cached. Files whose digest is
+        not known (e.g. digest-pending keys) are not cached, since a cached
+        copy could not be checked against the mirrored file.
+        """
+        cache = get_cache()
+        if cache is None or self.expected_digest in (None, IGNORE_DIGEST):
+            return None
+        return cache.fetch(self.url, self.expected_digest, lambda: urlopen(self.url))
+
+    def is_available_locally(self):
+        """
+        Is the file available without downloading it, either from the local
+        filesystem or from the cache?
+        """
+        if os.path.exists(self.full_path):
+            return True
+        cache = get_cache()
+        return bool(cache and self.expected_digest not in (None, IGNORE_DIGEST)
+                    and cache.get(self.url, self.expected_digest))
+
+    def open(self):
         if os.path.exists(self.full_path):  # first try to access local version
-            f = open(self.full_path, 'rb')
+            return open(self.full_path, 'rb')
+        cached_path = self._cached_path()
+        if cached_path:
+            return open(cached_path, 'rb')
         else:  # otherwise try the mirrored version
-            f = urlopen(self.url)
-        if max_length:
-            content = f.read(max_length)
-        else:
-            content = f.read()
-        f.close()
-        return content
-    content = property(fget=get_content)
+            return urlopen(self.url)
 
     @property
-    def sorted_content(self):
-        raise NotImplementedError
+    def digest(self):
+        if not os.path.exists(self.full_path) and self._cached_path():
+            return self.expected_digest  # the cache checks the digest on download
+        return super(MirroredDataFile, self).digest
+
+    def get_content(self, max_length=None):
+        if max_length and not self.is_available_locally():
+            # download only the start of the file. Servers that do not
+            # support Range requests send the whole file, of which we read
+            # only what is needed
+            request = Request(self.url, headers={"Range": "bytes=0-%d" % (max_length - 1)})
+            with urlopen(request) as f:
+                return f.read(max_length)
+        with self.open() as f:
+            if max_length:
+                content = f.read(max_length)
+            else:
+                content = f.read()
+        return content
+    content = property(fget=get_content)
 
 
 @component
@@ -87,7 +129,30 @@ class MirroredFileSystemDataStore(FileSystemDataStore):
         return [MirroredDataFile(path, self).generate_key()
                 for path in new_files]
 
-    def delete(self, *keys):
+    def get_data_item(self, key):
+        """
+        Return the file that matches the given key.
+        """
+        df = self.data_item_class(key.path, self, key.creation, expected_digest=key.digest)
+        if key.digest != IGNORE_DIGEST and df.digest != key.digest:
+            raise KeyError("Digests do not match.")
+        return df
+
+    def get_content(self, key, max_length=None):
+        """
+        Return the contents of a file identified by a key.
+
+        If `max_length` is given, the return value will be truncated. In this
+        case, if the file is available only from the mirror, only the
+        beginning of the file is downloaded, and the digest is not checked.
+        """
+        if max_length:
+            df = self.data_item_class(key.path, self, key.creation, expected_digest=key.digest)
+            if not df.is_available_locally():
+                return df.get_content(max_length)
+        return super(MirroredFileSystemDataStore, self).get_content(key, max_length)
+
+    def delete(self, *keys, verify_digests=True):
         """Delete the files corresponding to the given keys."""
         raise NotImplementedError("Deletion of individual files not supported.")
 
@@ -0,0 +1,244 @@
+"""
+Upload of large files to a remote filesystem as a number of segments, which
+are uploaded in parallel and retried on failure, and reading back of such
+segmented files.
+
+A segmented file is described by a manifest (a JSON file named after the
+file, with the extension ".segments.json") listing the name, size and SHA1
+digest of each segment. The manifest is written before the segments, and
+marked complete once they have all been uploaded; if an upload is
+interrupted, repeating it uploads only the segments that are missing or
+differ.
+
+The remote filesystem may be any object with the ``open()``, ``exists()``
+and ``getsize()`` methods of a PyFilesystem filesystem.
+
+
+:copyright: Copyright 2006-2020, 2024 by the Sumatra team, see doc/authors.txt
+:license: BSD 2-clause, see LICENSE for details.
+"""
+
+import os
+import json
+import hashlib
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from .base import DEFAULT_CHUNK_SIZE
+
+DEFAULT_SEGMENT_SIZE = 64 * 1024 * 1024
+
+logger = logging.getLogger("Sumatra")
+
+
+def manifest_path(remote_path):
+    return remote_path + ".segments.json"
+
+
+def read_manifest(fs, remote_path):
+    """
+    Return the manifest of a segmented file, or None if the file at
+    `remote_path` is not segmented.
+    """
+    path = manifest_path(remote_path)
+    if not fs.exists(path):
+        return None
+    with fs.open(path, 'r') as fp:
+        return json.load(fp)
+
+
+class SegmentedUploader(object):
+    """
+    Uploads a local file to a remote filesystem in segments, using several
+    threads.
+
+    `fs_factory` is a function returning a new connection to the remote
+    filesystem; each thread uses its own connection. If given,
+    `progress_callback` is called with the number of bytes uploaded so far
+    and the total size, each time a segment has been uploaded.
+    """
+
+    def __init__(self, fs_factory, segment_size=DEFAULT_SEGMENT_SIZE, threads=4,
+                 max_retries=3, retry_delay=1.0, retry_exceptions=(IOError,),
+                 progress_callback=None):
+        self.fs_factory = fs_factory
+        self.segment_size = segment_size
+        self.threads = threads
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.retry_exceptions = retry_exceptions
+        self.progress_callback = progress_callback
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def _fs(self):
+        if not hasattr(self._local, "fs"):
+            self._local.fs = self.fs_factory()
+        return self._local.fs
+
+    def _describe_segments(self, local_path):
+        segments = []
+        with open(local_path, 'rb') as fp:
+            while True:
+                sha1 = hashlib.sha1()
+                size = 0
+                while size < self.segment_size:
+                    chunk = fp.read(min(DEFAULT_CHUNK_SIZE, self.segment_size - size))
+                    if not chunk:
+                        break
+                    sha1.update(chunk)
+                    size += len(chunk)
+                if size == 0 and segments:
+                    break
+                segments.append({"name": "part%05d" % len(segments),
+                                 "offset": len(segments) * self.segment_size,
+                                 "size": size,
+                                 "sha1": sha1.hexdigest()})
+                if size < self.segment_size:
+                    break
+        return segments
+
+    def _is_uploaded(self, remote_path, segment, previous):
+        """Was the segment already uploaded by an interrupted upload of the same data?"""
+        if previous is None:
+            return False
+        previous_digests = dict((s["name"], s["sha1"]) for s in previous["segments"])
+        if previous_digests.get(segment["name"]) != segment["sha1"]:
+            return False
+        segment_path = "%s.%s" % (remote_path, segment["name"])
+        fs = self._fs()
+        return fs.exists(segment_path) and fs.getsize(segment_path) == segment["size"]
+
+    def _write_manifest(self, remote_path, segments, complete):
+        manifest = {"size": sum(s["size"] for s in segments),
+                    "segment_size": self.segment_size,
+                    "segments": segments,
+                    "complete": complete}
+        with self._fs().open(manifest_path(remote_path), 'w') as fp:
+            fp.write(json.dumps(manifest))
+
+    def _upload_segment(self, local_path, remote_path, segment):
+        segment_path = "%s.%s" % (remote_path, segment["name"])
+        for attempt in range(self.max_retries + 1):
+            try:
+                with open(local_path, 'rb') as src, self._fs().open(segment_path, 'wb') as dst:
+                    src.seek(segment["offset"])
+                    remaining = segment["size"]
+                    while remaining > 0:
+                        chunk = src.read(min(DEFAULT_CHUNK_SIZE, remaining))
+                        dst.write(chunk)
+                        remaining -= len(chunk)
+                break
+            except self.retry_exceptions as err:
+                if attempt == self.max_retries:
+                    raise
+                delay = self.retry_delay * 2 ** attempt
+                logger.warning("Upload of %s failed (%s), retrying in %g s", segment_path, err, delay)
+                if hasattr(self._local, "fs"):
+                    del self._local.fs  # reconnect
+                time.sleep(delay)
+        self._report_progress(segment["size"])
+
+    def _report_progress(self, size):
+        with self._lock:
+            self._uploaded += size
+            if self.progress_callback:
+                self.progress_callback(self._uploaded, self._total)
+
+    def upload(self, local_path, remote_path):
+        """
+        Upload the file at `local_path` to `remote_path` on the remote
+        filesystem, as a set of segments plus a manifest.
+        """
+        segments = self._describe_segments(local_path)
+        previous = read_manifest(self._fs(), remote_path)
+        to_upload = [s for s in segments if not self._is_uploaded(remote_path, s, previous)]
+        self._total = sum(s["size"] for s in segments)
+        self._uploaded = 0
+        self._report_progress(self._total - sum(s["size"] for s in to_upload))
+        self._write_manifest(remote_path, segments, complete=False)
+        with ThreadPoolExecutor(max_workers=self.threads) as executor:
+            futures = [executor.submit(self._upload_segment, local_path, remote_path, segment)
+                       for segment in to_upload]
+            for future in futures:
+                future.result()  # re-raises any exception from the upload
+        self._write_manifest(remote_path, segments, complete=True)
+
+
+class SegmentedFile(object):
+    """Read-only, seekable file-like object giving access to a segmented file."""
+
+    def __init__(self, fs, remote_path, manifest):
+        if not manifest.get("complete"):
+            raise IOError("Upload of %s is incomplete" % remote_path)
+        self._fs = fs
+        self._remote_path = remote_path
+        self._segments = manifest["segments"]
+        self._size = manifest["size"]
+        self._position = 0
+        self._index = None  # index of the segment currently open
+        self._current = None
+
+    def _open_segment(self, index):
+        if self._current is not None:
+            self._current.close()
+        segment = self._segments[index]
+        self._current = self._fs.open("%s.%s" % (self._remote_path, segment["name"]), 'rb')
+        self._index = index
+        offset = self._position - segment["offset"]
+        if offset:
+            self._current.seek(offset)
+
+    def _segment_at(self, position):
+        for index, segment in enumerate(self._segments):
+            if position < segment["offset"] + segment["size"]:
+                return index
+        return None
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self._size - self._position
+        parts = []
+        while size > 0 and self._position < self._size:
+            index = self._segment_at(self._position)
+            if index != self._index:
+                self._open_segment(index)
+            segment = self._segments[index]
+            data = self._current.read(min(size, segment["offset"] + segment["size"] - self._position))
+            if not data:
+                raise IOError("Segment %s of %s is truncated" % (segment["name"], self._remote_path))
+            parts.append(data)
+            self._position += len(data)
+            size -= len(data)
+        return b"".join(parts)
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self._position
+        elif whence == os.SEEK_END:
+            offset += self._size
+        if offset != self._position:
+            self._position = offset
+            if self._current is not None:
+                self._current.close()
+            self._current = None
+            self._index = None
+        return self._position
+
+    def tell(self):
+        return self._position
+
+    def seekable(self):
+        return True
+
+    def close(self):
+        if self._current is not None:
+            self._current.close()
+            self._current = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
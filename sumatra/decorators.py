@@ -101,7 +101,10 @@ def capture(main):
         record.add_tag(STATUS_FORMAT % (status + "..."))
         project.save_record(record)
         record.duration = time.time() - start_time
-        record.output_data = record.datastore.find_new_data(record.timestamp)
+        if project.lazy_digests:
+            record.output_data = record.datastore.find_new_data_deferred(record.timestamp)
+        else:
+            record.output_data = record.datastore.find_new_data(record.timestamp)
         record.add_tag(STATUS_FORMAT % status)
         project.save_record(record)
         project.save()
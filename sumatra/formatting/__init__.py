@@ -13,8 +13,10 @@ import textwrap
 import html
 import re
 from ..core import component, component_type, get_registered_components
-import parameters
+from .columnar import parameter_rows
 from functools import reduce
+from itertools import islice, chain
+from io import StringIO
 import os
 
 
@@ -23,6 +25,8 @@ fields = ['label', 'timestamp', 'reason', 'outcome', 'duration', 'repository',
           'parameters', 'input_data', 'launch_mode', 'output_data',
           'user', 'tags', 'repeats']
 
+TABLE_SAMPLE_SIZE = 100  # number of rows used to calculate column widths when writing tables to a stream
+
 
 @component_type
 class Formatter(object):
@@ -40,6 +44,11 @@ class Formatter(object):
         """
         return getattr(self, mode)()
 
+    def write(self, stream, mode='short'):
+        """Write the formatted records to a file-like object."""
+        stream.write(self.format(mode))
+        stream.write("\n")
+
 
 def record2dict(record, with_timezones=True):
     """Convert a Sumatra record to nested dicts"""
@@ -199,155 +208,163 @@ class TextFormatter(Formatter):
         Return information about a list of records as text, in a simple
         tabular format.
         """
-        tt = TextTable(fields, self.records)
-        return str(tt)
+        return str(self._table('table'))
 
     def output_table(self):
         """Return a list of output files, one per line."""
-        dt = DataTable(self.records, max_column_width=20, seperator='|')
-        return str(dt)
+        return str(self._table('output_table'))
 
     def parameter_table(self):
         """ Return parameter information about a list of records as text, in a simple tabular format."""
-        pt = ParamsTable(self.records, max_column_width=13, seperator='|')
-        return str(pt)
+        return str(self._table('parameter_table'))
+
+    def _table(self, mode, sample_size=None):
+        if mode == 'table':
+            return TextTable(fields, self.records, sample_size=sample_size)
+        elif mode == 'output_table':
+            return DataTable(self.records, max_column_width=20, seperator='|', sample_size=sample_size)
+        else:
+            return ParamsTable(self.records, max_column_width=13, seperator='|', sample_size=sample_size)
 
+    def write(self, stream, mode='short'):
+        """
+        Write the formatted records to a file-like object. Tables are written
+        one row at a time, with column widths calculated from the first
+        TABLE_SAMPLE_SIZE rows.
+        """
+        if mode in ('table', 'output_table', 'parameter_table'):
+            self._table(mode, sample_size=TABLE_SAMPLE_SIZE).write(stream)
+        else:
+            super(TextFormatter, self).write(stream, mode)
 
-class TextTable(object):
+
+class Table(object):
     """
-    Very primitive implementation of a text table. There are more sophisticated
-    implementations around, e.g. http://pypi.python.org/pypi/texttable/0.6.0/
-    but for now I'd like to avoid too many dependencies.
+    Base class for simple text tables, which are written one row at a time.
+
+    Column widths are calculated from the first `sample_size` rows (from all
+    rows, if `sample_size` is None), up to `max_column_width`. If
+    `sample_size` is 0, all columns have the maximum width. Cells wider than
+    their column are truncated.
     """
+    seperator = '|'
 
-    def __init__(self, headers, rows, max_column_width=20):
+    def __init__(self, headers, rows, max_column_width=20, sample_size=None):
         self.headers = headers
         self.rows = rows
         self.max_column_width = max_column_width
-
-    def calculate_column_widths(self):
-        column_widths = []
-        for header in self.headers:
-            column_width = max([len(header)] + [len(str(getattr(row, header))) for row in self.rows])
-            column_widths.append(min(self.max_column_width, column_width))
-        return column_widths
+        self.sample_size = sample_size
+
+    def header_cells(self):
+        return [h[:self.max_column_width] for h in self.headers]
+
+    def iter_rows(self):
+        """Iterate over the rows of the table, each a tuple of strings."""
+        raise NotImplementedError
+
+    def calculate_column_widths(self, rows=None):
+        if rows is None:
+            rows = self.iter_rows()
+        column_widths = [len(header) for header in self.headers]
+        for row in rows:
+            for i, cell in enumerate(row):
+                if len(cell) > column_widths[i]:
+                    column_widths[i] = len(cell)
+        return [min(self.max_column_width, width) for width in column_widths]
+
+    def write(self, stream):
+        """Write the table to a file-like object."""
+        rows = iter(self.iter_rows())
+        if self.sample_size == 0:
+            sample = []
+            column_widths = [self.max_column_width] * len(self.headers)
+        else:
+            sample = list(islice(rows, self.sample_size))
+            column_widths = self.calculate_column_widths(sample)
+        if self.seperator == '|':
+            format = "| " + " | ".join("%%-%ds" % w for w in column_widths) + " |\n"
+        else:
+            format = self.seperator.join(len(column_widths)*["%s"]) + "\n"
+            column_widths = [self.max_column_width] * len(column_widths)
+        stream.write(format % tuple(self.header_cells()))
+        for row in chain(sample, rows):
+            stream.write(format % tuple(cell[:width] for cell, width in zip(row, column_widths)))
 
     def __str__(self):
-        column_widths = self.calculate_column_widths()
-        format = "| " + " | ".join("%%-%ds" % w for w in column_widths) + " |\n"
-        assert len(column_widths) == len(self.headers)
-        output = format % tuple(h.title() for h in self.headers)
+        output = StringIO()
+        self.write(output)
+        return output.getvalue()
+
+
+class TextTable(Table):
+    """
+    Very primitive implementation of a text table. There are more sophisticated
+    implementations around, e.g. http://pypi.python.org/pypi/texttable/0.6.0/
+    but for now I'd like to avoid too many dependencies.
+    """
+
+    def header_cells(self):
+        return [h.title() for h in self.headers]
+
+    def iter_rows(self):
         for row in self.rows:
-            output += format % tuple(str(getattr(row, header))[:self.max_column_width] for header in self.headers)
-        return output
+            yield tuple(str(getattr(row, header)) for header in self.headers)
 
 
-class DataTable(object):
+class DataTable(Table):
 
-    def __init__(self, rows, max_column_width=20, seperator='|'):
-        self.rows = rows
-        self.headers = self.get_headers()
-        self.max_column_width = max_column_width
+    def __init__(self, rows, max_column_width=20, seperator='|', sample_size=None):
+        super(DataTable, self).__init__(self.get_headers(), rows, max_column_width, sample_size)
         self.seperator = seperator
 
     def get_headers(self):
         return ['output_from_record', 'directory', 'filename', 'digest', 'creation', 'size', 'mimetype']
 
-    def calculate_column_widths(self):
-        column_widths = []
-        for header in self.headers:
-            column_val_width = []
-            for row in self.rows:
-                for output_file in row.output_data:
-                    if header == 'output_from_record':
-                        column_val_width.append(len(str(row.label)))
-                    if header == 'directory':
-                        column_val_width.append(len(str(os.path.dirname(output_file.path))))
-                    if header == 'filename':
-                        column_val_width.append(len(str(os.path.basename(output_file.path))))
-                    if header in output_file.__dict__:
-                        column_val_width.append(len(str(output_file.__dict__[header])))
-                    elif header in output_file.__dict__['metadata']:
-                        column_val_width.append(len(str(output_file.__dict__['metadata'][header])))
-            column_width = max([len(header)] + column_val_width)
-            column_widths.append(min(self.max_column_width, column_width))
-        return column_widths
-
-    def __str__(self):
-        column_widths = self.calculate_column_widths()
-        if self.seperator == '|':
-            format = "| " + " | ".join("%%-%ds" % w for w in column_widths) + " |\n"
-        else:
-            format = self.seperator.join(len(column_widths)*["%s"]) + "\n"
-        assert len(column_widths) == len(self.headers)
-        output = format % tuple(h[:self.max_column_width] for h in self.headers)
+    def iter_rows(self):
         for row in self.rows:
             for output_file in row.output_data:
-                output += format % tuple(
-                    [str(row.label[:self.max_column_width])]
-                    +[str(os.path.dirname(output_file.path)[:self.max_column_width])]
-                    +[str(os.path.basename(output_file.path)[:self.max_column_width])]
-                    +[str(getattr(output_file, header))[:self.max_column_width] for header in self.headers[3:5]]
-                    +[str(output_file.metadata[header])[:self.max_column_width] for header in self.headers[5:]])
-        return output
+                yield (str(row.label),
+                       os.path.dirname(output_file.path),
+                       os.path.basename(output_file.path),
+                       str(output_file.digest),
+                       str(output_file.creation),
+                       str(output_file.metadata.get('size')),
+                       str(output_file.metadata.get('mimetype')))
 
 
-class ParamsTable(object):
+class ParamsTable(Table):
+    """
+    Table of the parameter values of records, with one column per (flattened)
+    parameter name.
+
+    All the parameter names must be known before the header can be written,
+    so `rows` is read once, when the table is created. The label, version and
+    main file of each record, and its flattened parameters, are kept until
+    the table is written; the records themselves are not, so records
+    retrieved from a record store one at a time are loaded only once.
+    """
 
-    def __init__(self, rows, max_column_width=20, seperator='|'):
-        self.rows = rows
-        self.headers = self.get_headers()
-        self.max_column_width = max_column_width
+    def __init__(self, rows, max_column_width=20, seperator='|', sample_size=None):
+        record_info = []
+
+        def parameter_sets():
+            for row in rows:
+                record_info.append((str(row.label), str(row.version), str(row.main_file)))
+                yield row.parameters
+
+        self.parameter_names, parameter_values = parameter_rows(parameter_sets())
+        super(ParamsTable, self).__init__(self.get_headers(), list(zip(record_info, parameter_values)),
+                                          max_column_width, sample_size)
         self.seperator = seperator
 
     def get_headers(self):
-        headers = [u'label',u'version',u'main_file']
-        param_headers = []
-        for row in self.rows:
-            parameter_set = row.parameters
-            if hasattr(parameter_set, 'as_dict'):
-                parameter_set = parameter_set.as_dict()
-            parameter_set = parameters.nesteddictflatten(parameter_set)
-            for key in parameter_set.keys():
-                if key not in param_headers:
-                    param_headers.append(key)
-        param_headers.sort()
-        return headers + param_headers
-
-    def calculate_column_widths(self):
-        column_widths = []
-        for header in self.headers:
-            if header in [u'label',u'version',u'main_file']:
-                column_width = max([len(header)] + [len(str(getattr(row, header))) for row in self.rows])
-            else:
-                column_val_width = []
-                for row in self.rows:
-                    parameter_set = row.parameters
-                    if hasattr(parameter_set, 'as_dict'):
-                        parameter_set = parameter_set.as_dict()
-                    parameter_set = parameters.nesteddictflatten(parameter_set)
-                    column_val_width.append(len(str(parameter_set.get(header))))
-                column_width = max([len(header)] + column_val_width)
-            column_widths.append(min(self.max_column_width, column_width))
-        return column_widths
+        return [u'label', u'version', u'main_file'] + self.parameter_names
 
-    def __str__(self):
-        column_widths = self.calculate_column_widths()
-        if self.seperator == '|':
-            format = "| " + " | ".join("%%-%ds" % w for w in column_widths) + " |\n"
-        else:
-            format = self.seperator.join(len(column_widths)*["%s"]) + "\n"
-        assert len(column_widths) == len(self.headers)
-        output = format % tuple(h[:self.max_column_width] for h in self.headers)
-        for row in self.rows:
-            parameter_set = row.parameters
-            if hasattr(parameter_set, 'as_dict'):
-                parameter_set = parameter_set.as_dict()
-            parameter_set = parameters.nesteddictflatten(parameter_set)
-            output += format % tuple(
-                [str(getattr(row, header))[:self.max_column_width] for header in self.headers[:3]]
-               +[str(parameter_set.get(header,''))[:self.max_column_width] for header in self.headers[3:]])
-        return output
+    def iter_rows(self):
+        for record_info, flat_parameters in self.rows:
+            values = [flat_parameters.get(name) for name in self.parameter_names]
+            yield tuple(list(record_info)
+                        + ['' if value is None else str(value) for value in values])
 
 
 @component
@@ -0,0 +1,207 @@
+"""
+Export of simulation/analysis records as columnar tables, for loading into
+data-analysis tools such as pandas.
+
+Three tables are produced:
+
+records
+    one row per record, with the label, timestamp, reason, outcome, etc.
+parameters
+    one row per record, with the label and one column per (flattened)
+    parameter name, prefixed by "parameters." so that a parameter called
+    "label" does not clash with the label column. Each parameter column has a
+    single type, chosen to accommodate all the values in it.
+data
+    one row per input or output data key.
+
+The tables may be written in Parquet or Arrow IPC (Feather) format, which
+require the pyarrow package, or in HDF5 format, which requires h5py.
+
+
+:copyright: Copyright 2006-2020, 2024 by the Sumatra team, see doc/authors.txt
+:license: BSD 2-clause, see LICENSE for details.
+"""
+
+import os
+import math
+from ..parameters import flatten
+
+COLUMNAR_FORMATS = ("parquet", "arrow", "hdf5")
+
+PARAMETER_COLUMN_PREFIX = "parameters."
+
+TABLE_NAMES = ("records", "parameters", "data")
+
+
+def column_type(values):
+    """
+    Return the type ("bool", "int64", "float64" or "string") able to hold all
+    the given values. None represents a missing value.
+    """
+    types = set(type(value) for value in values if value is not None)
+    if not types:
+        return "string"
+    elif types == {bool}:
+        return "bool"
+    elif types == {int}:
+        return "int64"
+    elif types <= {int, float}:
+        return "float64"
+    else:
+        return "string"
+
+
+def _convert(values, dtype):
+    if dtype == "float64":
+        return [None if value is None else float(value) for value in values]
+    elif dtype == "string":
+        return [None if value is None else str(value) for value in values]
+    else:
+        return list(values)
+
+
+def records_table(records):
+    """
+    Return the table of general information about the records, as a list of
+    (name, type, values) tuples, one per column.
+    """
+    return [
+        ("label", "string", [r.label for r in records]),
+        ("timestamp", "timestamp", [r.timestamp for r in records]),
+        ("reason", "string", [r.reason for r in records]),
+        ("outcome", "string", [r.outcome for r in records]),
+        ("duration", "float64", [r.duration for r in records]),
+        ("main_file", "string", [r.main_file for r in records]),
+        ("version", "string", [r.version for r in records]),
+        ("script_arguments", "string", [r.script_arguments for r in records]),
+        ("executable", "string", [r.executable.name for r in records]),
+        ("executable_version", "string", [r.executable.version for r in records]),
+        ("repository", "string", [r.repository.url for r in records]),
+        ("user", "string", [r.user for r in records]),
+        ("tags", "string", [",".join(sorted(r.tags)) for r in records]),
+        ("repeats", "string", [r.repeats for r in records]),
+    ]
+
+
+def parameter_rows(parameter_sets):
+    """
+    Flatten each of the given parameter sets once, in a single pass over them,
+    and return the sorted list of (flattened) parameter names together with a
+    list of dicts, one per parameter set, mapping the names of the parameters
+    it contains to their values.
+
+    This is used for all tables of parameter values: the parameters table
+    exported here, the text table of :class:`sumatra.formatting.ParamsTable`
+    and the parameter list of the web interface.
+    """
+    names = set()
+    rows = []
+    for parameter_set in parameter_sets:
+        flat_parameters = flatten(parameter_set)
+        names.update(flat_parameters)
+        rows.append(flat_parameters)
+    return sorted(names), rows
+
+
+def parameters_table(records):
+    """
+    Return the table of parameter values, as a list of (name, type, values)
+    tuples, one per column. The parameter columns are named with
+    PARAMETER_COLUMN_PREFIX. Parameters not used by a record are missing values.
+    """
+    names, rows = parameter_rows(record.parameters for record in records)
+    columns = [("label", "string", [r.label for r in records])]
+    for name in names:
+        values = [row.get(name) for row in rows]
+        dtype = column_type(values)
+        columns.append((PARAMETER_COLUMN_PREFIX + name, dtype, _convert(values, dtype)))
+    return columns
+
+
+def data_table(records):
+    """
+    Return the table of input and output data keys, as a list of
+    (name, type, values) tuples, one per column.
+    """
+    rows = []
+    for record in records:
+        for direction, keys in (("input", record.input_data), ("output", record.output_data)):
+            for key in keys:
+                rows.append((record.label, direction, key.path, key.digest, key.creation,
+                             key.metadata.get("size"), key.metadata.get("mimetype")))
+    names = ("label", "direction", "path", "digest", "creation", "size", "mimetype")
+    types = ("string", "string", "string", "string", "timestamp", "int64", "string")
+    return [(name, dtype, [row[i] for row in rows])
+            for i, (name, dtype) in enumerate(zip(names, types))]
+
+
+def build_tables(records):
+    """Return a dict containing the records, parameters and data tables."""
+    records = list(records)
+    return {"records": records_table(records),
+            "parameters": parameters_table(records),
+            "data": data_table(records)}
+
+
+def _arrow_table(columns):
+    import pyarrow as pa
+    arrow_types = {"bool": pa.bool_(), "int64": pa.int64(), "float64": pa.float64(),
+                   "string": pa.string(), "timestamp": pa.timestamp("s", tz="UTC")}
+    return pa.table({name: pa.array(values, type=arrow_types[dtype])
+                     for name, dtype, values in columns})
+
+
+def _hdf5_column(values, dtype):
+    """HDF5 has no missing values: use NaN for numbers and empty strings for text."""
+    import h5py
+    if dtype == "timestamp":
+        return [value.isoformat() if value is not None else "" for value in values], h5py.string_dtype()
+    elif dtype == "string":
+        return ["" if value is None else value for value in values], h5py.string_dtype()
+    elif None in values or (dtype == "int64" and not values):
+        return [math.nan if value is None else float(value) for value in values], "float64"
+    else:
+        return values, {"bool": "bool", "int64": "int64", "float64": "float64"}[dtype]
+
+
+def write_tables(tables, path, format):
+    """
+    Write the tables to `path`. For the Parquet and Arrow formats, `path` is a
+    directory, which will contain one file per table. For HDF5, `path` is a
+    single file, containing one group per table.
+    """
+    if format not in COLUMNAR_FORMATS:
+        raise ValueError("Format must be one of %s" % ", ".join(COLUMNAR_FORMATS))
+    try:
+        if format == "hdf5":
+            import h5py
+        else:
+            import pyarrow
+    except ImportError:
+        raise ImportError("The %s package is needed to export records in %s format."
+                          % (format == "hdf5" and "h5py" or "pyarrow", format))
+    if format == "hdf5":
+        with h5py.File(path, "w") as f:
+            for table_name in TABLE_NAMES:
+                group = f.create_group(table_name)
+                for name, dtype, values in tables[table_name]:
+                    data, h5_dtype = _hdf5_column(values, dtype)
+                    group.create_dataset(name.replace("/", "_"), data=data, dtype=h5_dtype)
+    else:
+        if not os.path.exists(path):
+            os.makedirs(path)
+        for table_name in TABLE_NAMES:
+            table = _arrow_table(tables[table_name])
+            file_path = os.path.join(path, "%s.%s" % (table_name, format))
+            if format == "parquet":
+                import pyarrow.parquet
+                pyarrow.parquet.write_table(table, file_path)
+            else:
+                # uncompressed, so that the file can be memory-mapped
+                import pyarrow.feather
+                pyarrow.feather.write_feather(table, file_path, compression="uncompressed")
+
+
+def export_records(records, path, format="parquet"):
+    """Write the given records to `path` as columnar tables (see :func:`write_tables`)."""
+    write_tables(build_tables(records), path, format)
@@ -585,3 +585,15 @@ def build_parameters(filename):
             except (SyntaxError, NameError, UnicodeDecodeError):
                 pass
     return parameters
+
+
+def flatten(parameter_set, separator="."):
+    """
+    Return the values of a parameter set as a flat dict, in which the names of
+    nested parameters are joined using `separator`, e.g. {"a.b": 1}.
+    """
+    if hasattr(parameter_set, "as_dict"):
+        parameter_set = parameter_set.as_dict()
+    if not isinstance(parameter_set, dict):
+        return {}
+    return parameters.nesteddictflatten(parameter_set, separator)
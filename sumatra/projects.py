@@ -27,14 +27,8 @@ import importlib
 import pickle
 from copy import deepcopy
 import uuid
+import sys
 import sumatra
-try:
-    import django.db.utils
-except ImportError:
-    class DjangoDatabaseError:  # If django can't be imported, a django..DatabaseError
-        pass                    # cannot be raised, so a mock exception is all we need
-else:
-     DjangoDatabaseError = django.db.utils.DatabaseError
 import sqlite3
 import time
 import shutil
@@ -43,7 +37,7 @@ from datetime import datetime, timezone
 from importlib import import_module
 from sumatra.records import Record
 from sumatra import programs, datastore
-from sumatra.formatting import get_formatter, get_diff_formatter
+from sumatra.formatting import get_formatter, get_diff_formatter, columnar
 from sumatra.recordstore import DefaultRecordStore
 from sumatra.versioncontrol import UncommittedModificationsError, get_working_copy, VersionControlError
 from sumatra.core import TIMESTAMP_FORMAT
@@ -70,8 +64,75 @@ def _get_project_file(path):
     return os.path.join(path, ".smt", DEFAULT_PROJECT_FILE)
 
 
+def _database_errors():
+    """
+    Return the exceptions raised when a record cannot be saved because the
+    database is busy. Django is not imported here, as that is slow: if it has
+    not been imported, a Django DatabaseError cannot have been raised.
+    """
+    errors = (sqlite3.OperationalError,)
+    django_db_utils = sys.modules.get('django.db.utils')
+    if django_db_utils is not None:
+        errors += (django_db_utils.DatabaseError,)
+    return errors
+
+
+class LabelCache(object):
+    """
+    A list of the labels of the records in a project, one per line, kept in a
+    file for use by shell completion (see bin/smt-complete.sh). Labels are
+    appended as records are added, and the file is rewritten atomically when
+    records are deleted.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def labels(self):
+        with open(self.path) as fp:
+            return [line.strip() for line in fp if line.strip()]
+
+    def write(self, labels):
+        tmp_path = self.path + ".partial"
+        with open(tmp_path, 'w') as fp:
+            fp.write("".join(label + "\n" for label in labels))
+        os.replace(tmp_path, self.path)
+
+    def add(self, label):
+        with open(self.path, 'rb+') as fp:
+            fp.seek(0, os.SEEK_END)
+            if fp.tell() > 0:
+                fp.seek(-1, os.SEEK_END)
+                if fp.read(1) != b"\n":  # files written by older versions lack the final newline
+                    fp.write(b"\n")
+            fp.write(label.encode("utf-8") + b"\n")
+
+    def remove(self, *labels):
+        labels = set(labels)
+        self.write(label for label in self.labels() if label not in labels)
+
+
+class _StoredRecords(object):
+    """
+    The records of a project, retrieved from the record store one at a time
+    each time they are iterated over.
+    """
+
+    def __init__(self, record_store, project_name, tags=None):
+        self.record_store = record_store
+        self.project_name = project_name
+        self.tags = tags
+
+    def __iter__(self):
+        return iter(self.record_store.iter_records(self.project_name, tags=self.tags))
+
+
 class Project(object):
     valid_name_pattern = r'(?P<project>\w+[\w\- ]*)'
+    lazy_digests = False  # for projects created with earlier versions
 
     def __init__(self, name, default_executable=None, default_repository=None,
                  default_main_file=None, default_launch_mode=None,
@@ -80,7 +141,7 @@ class Project(object):
                  input_datastore=None, label_generator='timestamp',
                  timestamp_format=TIMESTAMP_FORMAT,
                  allow_command_line_parameters=True,
-                 ignore_parameters=False, plugins=[]):
+                 ignore_parameters=False, plugins=[], lazy_digests=False):
         self.path = os.getcwd()
         if not os.path.exists(".smt"):
             os.mkdir(".smt")
@@ -109,6 +170,7 @@ class Project(object):
         self.sumatra_version = sumatra.__version__
         self.allow_command_line_parameters = allow_command_line_parameters
         self.ignore_parameters = ignore_parameters
+        self.lazy_digests = lazy_digests
         self._most_recent = None
         self.plugins = []
         self.load_plugins(*plugins)
@@ -132,7 +194,7 @@ class Project(object):
                      'data_label', '_most_recent', 'input_datastore',
                      'label_generator', 'timestamp_format', 'sumatra_version',
                      'allow_command_line_parameters', 'ignore_parameters',
-                     'plugins'):
+                     'plugins', 'lazy_digests'):
             try:
                 attr = getattr(self, name)
             except:
@@ -174,10 +236,11 @@ class Project(object):
         Append label to     : %(_data_label)s
         Label generator     : %(label_generator)s
         Timestamp format    : %(timestamp_format)s
+        Lazy digests        : %(lazy_digests)s
         Plug-ins            : %(plugins)s
         Sumatra version     : %(sumatra_version)s
         """
-        return _remove_left_margin(template % self.__dict__)
+        return _remove_left_margin(template % dict(self.__dict__, lazy_digests=self.lazy_digests))
 
     def new_record(self, parameters={}, input_data=[], script_args="",
                    executable='default', repository='default',
@@ -271,8 +334,9 @@ class Project(object):
                 self.save_record(record)
                 success = True
                 self._most_recent = record.label
+                self._update_label_cache(added=[record.label])
                 logger.debug("Created record: %s" % self.most_recent())
-            except (DjangoDatabaseError, sqlite3.OperationalError):
+            except _database_errors():
                 print("Failed to save record due to database error. Trying again in {0} seconds. (Attempt {1}/{2})".format(sleep_seconds, cnt, max_tries))
                 time.sleep(sleep_seconds)
                 cnt += 1
@@ -294,16 +358,76 @@ class Project(object):
             self.get_record(label).delete_data()
         self.record_store.delete(self.name, label)
         self._most_recent = self.record_store.most_recent(self.name)
+        self._update_label_cache(removed=[label])
+
+    def delete_records(self, labels, delete_data=False, verify_digests=True):
+        """
+        Delete the records with the given labels, in a single transaction if
+        the record store supports it. Return the labels of the records that
+        were deleted; labels for which there is no record are ignored.
+
+        If `delete_data` is True, the output data of the records are also
+        deleted, with one call to each datastore. If `verify_digests` is False,
+        data files are deleted without checking that their content matches
+        the digests stored in the records, which is much faster for large files.
+        """
+        labels = list(labels)
+        if delete_data:
+            records = []
+            for label in labels:
+                try:
+                    records.append(self.get_record(label))
+                except Exception:  # could be KeyError or DoesNotExist
+                    continue
+            self._delete_data(records, verify_digests)
+        deleted = self.record_store.delete_records(self.name, labels)
+        if deleted:
+            self._most_recent = self.record_store.most_recent(self.name)
+            self._update_label_cache(removed=deleted)
+        return deleted
 
-    def delete_by_tag(self, tag, delete_data=False):
+    def _delete_data(self, records, verify_digests=True):
+        """Delete the output data of the given records, grouped by datastore."""
+        groups = {}
+        for record in records:
+            if record.output_data:
+                datastore = record.datastore
+                group_key = (datastore.__class__, json.dumps(datastore.__getstate__(), sort_keys=True, default=str))
+                groups.setdefault(group_key, (datastore, []))[1].extend(record.output_data)
+        for datastore, keys in groups.values():
+            datastore.delete(*keys, verify_digests=verify_digests)
+
+    def delete_by_tag(self, tag, delete_data=False, verify_digests=True):
         """Delete all records with a given tag. Return the number of records deleted."""
         if delete_data:
-            for record in self.record_store.list(self.name, tag):
-                record.delete_data()
+            self._delete_data(self.record_store.list(self.name, tag), verify_digests)
+        labels = self.record_store.labels(self.name, [tag])
         n = self.record_store.delete_by_tag(self.name, tag)
         self._most_recent = self.record_store.most_recent(self.name)
+        self._update_label_cache(removed=labels)
         return n
 
+    @property
+    def label_cache(self):
+        """The cache of record labels, in .smt/labels"""
+        return LabelCache(os.path.join(os.path.dirname(_get_project_file(self.path)), "labels"))
+
+    def rebuild_label_cache(self):
+        """Write the labels of all records to the label cache."""
+        self.label_cache.write(self.get_labels())
+
+    def _update_label_cache(self, added=(), removed=()):
+        cache = self.label_cache
+        if not os.path.isdir(os.path.dirname(cache.path)):
+            return
+        if not cache.exists():
+            self.rebuild_label_cache()
+            return
+        for label in added:
+            cache.add(label)
+        if removed:
+            cache.remove(*removed)
+
     def get_labels(self, tags=None, reverse=False, *args, **kwargs):
         labels = self.record_store.labels(self.name, tags=tags, *args, **kwargs)
         if reverse:
@@ -311,13 +435,65 @@ class Project(object):
         return labels
 
     def find_records(self, tags=None, reverse=False, parameters=None, *args, **kwargs):
-        records = self.record_store.list(self.name, tags=tags, *args, **kwargs)
+        """
+        Return the records of this project, optionally filtered by tag and by
+        parameter values. `parameters` may be a dict of parameter values, or a
+        list of (name, operator, value) tuples, e.g. [("a.b", ">=", 0.5)].
+        """
+        if parameters is None:
+            records = self.record_store.list(self.name, tags=tags, *args, **kwargs)
+        else:
+            records = self.record_store.list_by_parameters(self.name, parameters, tags=tags, *args, **kwargs)
         if reverse:
             records.reverse()
-        if parameters is not None:
-            records = [rec for rec in records if len(rec.parameters.diff(parameters)[-1]) == 0]
         return records
 
+    def calculate_digests(self, labels=None):
+        """
+        Calculate any pending digests of the output data of the records with
+        the given labels (by default, all records), and save the updated
+        records. Return the number of digests calculated.
+        """
+        if labels is None:
+            records = self.find_records()
+        else:
+            records = [self.get_record(label) for label in labels]
+        n = 0
+        for record in records:
+            if any(key.digest_pending for key in record.output_data):
+                completed = record.datastore.calculate_digests(*record.output_data)
+                if completed:
+                    self.save_record(record)
+                    n += len(completed)
+        return n
+
+    @property
+    def thumbnail_directory(self):
+        """The directory in which the web interface caches thumbnails of images, .smt/thumbnails"""
+        return os.path.join(os.path.dirname(_get_project_file(self.path)), "thumbnails")
+
+    def generate_thumbnails(self, labels=None, sizes=None):
+        """
+        Create the thumbnails shown by the web interface for the images in the
+        output data of the records with the given labels (by default, all
+        records), unless they already exist. Return the number of thumbnails
+        created. Requires the Pillow package.
+        """
+        from .web.thumbnails import ThumbnailCache, generate_thumbnails, DEFAULT_THUMBNAIL_SIZE
+        cache = ThumbnailCache(self.thumbnail_directory)
+        if labels is None:
+            records = self.record_store.iter_records(self.name)
+        else:
+            records = [self.get_record(label) for label in labels]
+        n = 0
+        for record in records:
+            images = [key for key in record.output_data
+                      if (key.metadata.get("mimetype") or "").startswith("image/")]
+            if images:
+                n += generate_thumbnails(cache, record.datastore, images,
+                                         sizes or (DEFAULT_THUMBNAIL_SIZE,))
+        return n
+
     def find_input_data(self, *args, **kwargs):
         records = self.find_records(*args, **kwargs)
         if len(records) == 0: return []
@@ -349,6 +525,20 @@ class Project(object):
             formatter = get_formatter(format)(records, project=self, tags=tags)
             return formatter.format(mode)
 
+    def write_records(self, stream, format='text', mode='short', tags=None, reverse=False, *args, **kwargs):
+        """
+        Write the formatted records to a file-like object. Where possible,
+        i.e. for text tables of records that are not otherwise filtered or
+        reordered, the records are written as they are retrieved from the
+        record store, rather than being loaded all at once.
+        """
+        if format == 'text' and mode in ('table', 'output_table', 'parameter_table') and not (reverse or args or kwargs):
+            records = _StoredRecords(self.record_store, self.name, tags)
+            get_formatter(format)(records, project=self, tags=tags).write(stream, mode)
+        else:
+            stream.write(self.format_records(format, mode, tags, reverse, *args, **kwargs))
+            stream.write("\n")
+
     def most_recent(self):
         try:
             return self.get_record(self._most_recent)
@@ -387,12 +577,25 @@ class Project(object):
         formatter = get_diff_formatter()(diff)
         return formatter.format(mode)
 
-    def export(self):
+    def export(self, format="ndjson"):
         # copy the project data
         shutil.copy(".smt/project", ".smt/project_export.json")
         # export the record data
-        with open(".smt/records_export.json", 'w') as f:
-            f.write(self.record_store.export(self.name))
+        if format == "ndjson":  # written incrementally, one record per line
+            with open(".smt/records_export.ndjson", 'w') as f:
+                self.record_store.export_ndjson(self.name, f)
+        else:
+            content = self.record_store.export(self.name, format=format)
+            with open(".smt/records_export.%s" % format, isinstance(content, bytes) and 'wb' or 'w') as f:
+                f.write(content)
+
+    def export_columnar(self, path, format="parquet", tags=None):
+        """
+        Export the records, their parameters and their input and output data
+        keys as columnar tables, in Parquet, Arrow IPC or HDF5 format (see
+        :mod:`sumatra.formatting.columnar`).
+        """
+        columnar.export_records(self.record_store.iter_records(self.name, tags=tags), path, format)
 
     def repeat(self, original_label, new_label=None):
         if original_label == 'last':
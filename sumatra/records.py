@@ -203,7 +203,11 @@ class Record(object):
         # Run post-processing scripts
         # pass # skip this if there is an error
         # Search for newly-created datafiles
-        self.output_data = self.datastore.find_new_data(self.timestamp)
+        if project and project.lazy_digests:
+            # digests are calculated later, by "smt digest"
+            self.output_data = self.datastore.find_new_data_deferred(self.timestamp)
+        else:
+            self.output_data = self.datastore.find_new_data(self.timestamp)
         print("Record label for this run: '%s'" % self.label)
         if self.output_data:
             print("Data keys are %s" % self.output_data)
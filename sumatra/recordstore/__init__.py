@@ -18,12 +18,9 @@ http_store   - provides the HttpRecordStore class
 from . import serialization
 from .base import RecordStore
 from .shelve_store import ShelveRecordStore
-try:
-    import django
+from .django_store import have_django
+if have_django:
     from .django_store import DjangoRecordStore
-    have_django = True
-except ImportError:
-    have_django = False
 try:
     import httplib2
     from .http_store import HttpRecordStore
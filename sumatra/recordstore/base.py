@@ -9,6 +9,56 @@ Provides base RecordStore class.
 from sumatra.recordstore import serialization
 from sumatra.formatting import get_formatter
 from ..core import component_type
+from ..parameters import flatten
+
+PARAMETER_OPERATORS = ("=", "<", "<=", ">", ">=")
+
+
+def parameter_predicates(parameters):
+    """
+    Return a list of (name, operator, value) tuples from a specification of
+    the parameter values that records should have. This may be either a
+    (possibly nested) dict of values, which must all be equal, or a list of
+    (name, operator, value) tuples, in which nested names are separated by
+    dots, e.g. ("a.b", ">=", 0.5).
+    """
+    if isinstance(parameters, dict):
+        return [(name, "=", value) for name, value in sorted(flatten(parameters).items())]
+    predicates = []
+    for name, operator, value in parameters:
+        if operator not in PARAMETER_OPERATORS:
+            raise ValueError("Invalid operator '%s'. Valid operators are %s"
+                             % (operator, ", ".join(PARAMETER_OPERATORS)))
+        predicates.append((name, operator, value))
+    return predicates
+
+
+def match_parameters(flat_parameters, predicates):
+    """
+    Do the flattened parameter values satisfy all the given (name, operator,
+    value) predicates? Parameters that are missing, or whose values cannot be
+    compared with the given value, never match.
+    """
+    for name, operator, value in predicates:
+        if name not in flat_parameters:
+            return False
+        actual = flat_parameters[name]
+        try:
+            if operator == "=":
+                matched = actual == value
+            elif operator == "<":
+                matched = actual < value
+            elif operator == "<=":
+                matched = actual <= value
+            elif operator == ">":
+                matched = actual > value
+            else:
+                matched = actual >= value
+        except TypeError:
+            matched = False
+        if not matched:
+            return False
+    return True
 
 
 @component_type
@@ -40,6 +90,20 @@ class RecordStore(object):
         """
         raise NotImplementedError
 
+    def list_by_tags(self, project_name, tags, require_all=False):
+        """
+        Return a list of records for the given project that have been tagged
+        with any of the given tags or, if `require_all` is True, with all of
+        them. Tag names must match exactly.
+
+        Subclasses should override this if they maintain an index of tags.
+        """
+        if isinstance(tags, str):
+            tags = [tags]
+        match = require_all and all or any
+        return [record for record in self.list(project_name)
+                if match(tag in record.tags for tag in tags)]
+
     def labels(self, project_name, tags=None):
         """
         Return the labels of all records in the given project.
@@ -49,10 +113,38 @@ class RecordStore(object):
         """
         raise NotImplementedError
 
+    def labels_starting_with(self, project_name, prefix):
+        """
+        Return the labels of the records in the given project that start with
+        `prefix`, e.g. for completing partially-typed labels.
+
+        Subclasses should override this if they can query labels without
+        retrieving the records.
+        """
+        return [label for label in self.labels(project_name) if label.startswith(prefix)]
+
     def delete(self, project_name, label):
         """Delete the record with the given label from the given project."""
         raise NotImplementedError
 
+    def delete_records(self, project_name, labels):
+        """
+        Delete the records with the given labels from the given project, and
+        return the labels of the records that were deleted. Labels for which
+        there is no record are ignored.
+
+        Subclasses should override this if they can delete many records at
+        once.
+        """
+        deleted = []
+        for label in labels:
+            try:
+                self.delete(project_name, label)
+            except Exception:  # could be KeyError or DoesNotExist
+                continue
+            deleted.append(label)
+        return deleted
+
     def delete_all(self):
         """Delete all records from the store."""
         raise NotImplementedError
@@ -65,23 +157,95 @@ class RecordStore(object):
         """Return the most recent record from the given project."""
         raise NotImplementedError
 
-    def export_records(self, records, indent=2):
-        """Returns a string with a JSON representation of the given records."""
-        json_formatter = get_formatter('json')(records)
-        return json_formatter.long()
+    def list_by_parameters(self, project_name, parameters, tags=None, *args, **kwargs):
+        """
+        Return a list of records for the given project whose parameter values
+        match `parameters` (see :func:`parameter_predicates`), optionally
+        filtered by tag as in :meth:`list`.
 
-    def export(self, project_name, indent=2):
-        """Returns a string with a JSON representation of the project record store."""
+        Subclasses should override this if they maintain an index of
+        parameter values.
+        """
+        predicates = parameter_predicates(parameters)
+        return [record for record in self.list(project_name, tags, *args, **kwargs)
+                if match_parameters(flatten(record.parameters), predicates)]
+
+    def iter_records(self, project_name, tags=None):
+        """
+        Iterate over the records for the given project (see :meth:`list`).
+
+        Subclasses should override this if they can retrieve records
+        incrementally, rather than all at once.
+        """
+        return iter(self.list(project_name, tags=tags))
+
+    def save_many(self, project_name, records):
+        """
+        Store the given records under the given project.
+
+        Subclasses should override this if they can store several records
+        more efficiently than one at a time.
+        """
+        for record in records:
+            self.save(project_name, record)
+
+    def export_records(self, records, indent=2, format="json"):
+        """
+        Returns a representation of the given records, either a JSON string
+        or, if `format` is "msgpack", bytes.
+        """
+        if format == "json":
+            json_formatter = get_formatter('json')(records)
+            return json_formatter.long()
+        return serialization.encode_records(records, format)
+
+    def export(self, project_name, indent=2, format="json"):
+        """
+        Returns a representation of the project record store, either a JSON
+        string or, if `format` is "msgpack", bytes.
+        """
         records = self.list(project_name)
-        return self.export_records(records, indent=indent)
+        return self.export_records(records, indent=indent, format=format)
+
+    def export_ndjson(self, project_name, fp):
+        """
+        Write the records of the given project to the file `fp` in
+        newline-delimited JSON format (one record per line), one record at a
+        time. Returns the number of records written.
+        """
+        n = 0
+        for record in self.iter_records(project_name):
+            fp.write(serialization.encode_record(record))
+            fp.write("\n")
+            n += 1
+        return n
 
     def import_(self, project_name, content):
-        """Import records in JSON format."""
+        """Import records in JSON or msgpack format."""
         records = serialization.decode_records(content)
         for record in records:
             # need to check for duplicate record labels?
             self.save(project_name, record)
 
+    def import_ndjson(self, project_name, fp, batch_size=500):
+        """
+        Import records in newline-delimited JSON format from the file `fp`,
+        reading and storing at most `batch_size` records at a time. Returns the
+        number of records imported.
+        """
+        n = 0
+        batch = []
+        for record in serialization.iter_decode_ndjson(fp):
+            batch.append(record)
+            if len(batch) >= batch_size:
+                self.save_many(project_name, batch)
+                n += len(batch)
+                batch = []
+        if batch:
+            self.save_many(project_name, batch)
+            n += len(batch)
+        return n
+
     def sync(self, other, project_name):
         """
         Synchronize two record stores so that they contain the same records for
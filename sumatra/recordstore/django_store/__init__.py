@@ -14,24 +14,50 @@ import shutil
 from warnings import warn
 from textwrap import dedent
 import importlib
-try:
-    import django.conf as django_conf
-    from django.core import management
-    import django
-    have_django = True
-except ImportError:
-    have_django = False
-from sumatra.recordstore.base import RecordStore
+import importlib.util
+import pkgutil
+from functools import lru_cache
+from sumatra.recordstore.base import RecordStore, parameter_predicates
 from ...core import component
-from urllib.request import urlparse
+from urllib.parse import urlparse
 from io import StringIO
 
+# Django is imported only when a record store is first used, since importing
+# and setting it up takes a significant fraction of the run time of short
+# commands
+have_django = importlib.util.find_spec("django") is not None
+
 
 def db_id(db):
     """Return a unique identifier for a database, for comparison purposes."""
     return (db['ENGINE'], db['NAME'], db.get('HOST', ''), db.get('PORT', ''))
 
 
+@lru_cache()
+def expected_migrations(apps):
+    """
+    Return the set of (app label, migration name) pairs for the migrations of
+    the given apps, a tuple of (app label, module name) pairs, found by listing
+    the migration modules without importing them. Return None if an app has
+    models but no migrations.
+    """
+    from django.apps import apps as app_registry
+    migrations = set()
+    for label, name in apps:
+        try:
+            spec = importlib.util.find_spec(name + ".migrations")
+        except ImportError:
+            spec = None
+        if spec is None or not spec.submodule_search_locations:
+            if list(app_registry.get_app_config(label).get_models()):
+                return None
+            continue
+        for module in pkgutil.iter_modules(spec.submodule_search_locations):
+            if not module.ispkg and not module.name.startswith(("_", "~")):
+                migrations.add((label, module.name))
+    return frozenset(migrations)
+
+
 class DjangoConfiguration(object):
     """
     To allow multiple DjangoRecordStore instances to exist at the same
@@ -113,16 +139,40 @@ class DjangoConfiguration(object):
         return db_id(db) in existing_dbs
 
     def _create_databases(self):
+        from django.core import management
         for label, db in self._settings['DATABASES'].items():
             if 'sqlite' in db['ENGINE']:
                 db_file = db['NAME']
                 if not os.path.exists(os.path.dirname(db_file)):
                     os.makedirs(os.path.dirname(db_file))
-            management.call_command('migrate', run_syncdb=True, database=label, verbosity=0, interactive=False)
+            if not self.schema_is_current(label):
+                management.call_command('migrate', run_syncdb=True, database=label, verbosity=0, interactive=False)
+
+    def schema_is_current(self, label):
+        """
+        Have all migrations been applied to the given database? This needs a
+        single query, and is much faster than running the 'migrate' command
+        when there is nothing to do.
+        """
+        from django.apps import apps
+        from django.db import connections, DatabaseError
+        expected = expected_migrations(tuple((app_config.label, app_config.name)
+                                             for app_config in apps.get_app_configs()))
+        if expected is None:
+            return False
+        try:
+            with connections[label].cursor() as cursor:
+                cursor.execute("SELECT app, name FROM django_migrations")
+                applied = set(cursor.fetchall())
+        except DatabaseError:  # new database
+            return False
+        return expected.issubset(applied)
 
     def configure(self):
         if not have_django:
             raise ImportError("Please install Django to use this feature.")
+        import django
+        import django.conf as django_conf
         settings = django_conf.settings
         if not settings.configured:
             settings.configure(**self._settings)
@@ -173,6 +223,7 @@ class DjangoRecordStore(RecordStore):
     def _switch_db(self, db_file):
         # for testing
         global db_config
+        import django.conf as django_conf
         settings = django_conf.settings
         settings._wrapped = None
         assert settings.configured is False
@@ -232,6 +283,8 @@ class DjangoRecordStore(RecordStore):
         db_record.datastore = self._get_db_obj('Datastore', record.datastore)
         db_record.input_datastore = self._get_db_obj('Datastore', record.input_datastore)
         db_record.parameters = self._get_db_obj('ParameterSet', record.parameters)
+        if not db_record.parameters.indexed:
+            db_record.parameters.index(record.parameters, using=self._db_label)
         db_record.script_arguments = record.script_arguments
         db_record.user = record.user
         db_record.tags = ",".join(record.tags)
@@ -242,11 +295,18 @@ class DjangoRecordStore(RecordStore):
         for i in range(0, len(record.input_data), chunk_size):
             db_keys = (self._get_db_obj('DataKey', key) for key in record.input_data[i:i + chunk_size])
             db_record.input_data.add(*db_keys)
+        output_pks = []
         for i in range(0, len(record.output_data), chunk_size):
             db_keys = (self._get_db_obj('DataKey', key) for key in record.output_data[i:i + chunk_size])
             for key in db_keys:
                 key.output_from_record = db_record
                 key.save()
+                output_pks.append(key.pk)
+        # detach keys that have been replaced, e.g. once a pending digest has been calculated
+        output_pks = set(output_pks)
+        stale_pks = [pk for pk in db_record.output_data.values_list('pk', flat=True) if pk not in output_pks]
+        for i in range(0, len(stale_pks), chunk_size):
+            db_record.output_data.filter(pk__in=stale_pks[i:i + chunk_size]).update(output_from_record=None)
         if record.dependencies:
             for dep in record.dependencies:
                 # print "Adding dependency %s to db_record" % dep
@@ -256,6 +316,7 @@ class DjangoRecordStore(RecordStore):
         db_record.diff = record.diff
         db_record.repeats = record.repeats
         db_record.save(using=self._db_label)
+        db_record.update_search_index(record.parameters, using=self._db_label)
 
     def get(self, project_name, label):
         models = self._get_models()
@@ -268,10 +329,10 @@ class DjangoRecordStore(RecordStore):
     def list(self, project_name, tags=None, *args, **kwargs):
         db_records = self._manager.filter(project__id=project_name, *args, **kwargs).select_related()
         if tags:
-            if not hasattr(tags, "__len__"):
-                tags = [tags]
-            for tag in tags:
-                db_records = db_records.filter(tags__contains=tag)
+            db_records = self._get_models().filter_by_tags(db_records, tags)
+        return self._to_sumatra(db_records)
+
+    def _to_sumatra(self, db_records):
         try:
             records = [db_record.to_sumatra() for db_record in db_records]
         except Exception as err:
@@ -283,25 +344,103 @@ class DjangoRecordStore(RecordStore):
             raise Exception(errmsg)
         return records
 
-    def labels(self, project_name, tags=None, *args, **kwargs):
+    def list_by_parameters(self, project_name, parameters, tags=None, *args, **kwargs):
+        """
+        Return a list of records for the given project whose parameter values
+        match `parameters`, using the ParameterValue table.
+        """
+        models = self._get_models()
         db_records = self._manager.filter(project__id=project_name, *args, **kwargs).select_related()
+        for name, operator, value in parameter_predicates(parameters):
+            db_records = db_records.filter(**models.ParameterValue.filter_arguments(name, operator, value))
         if tags:
-            if not hasattr(tags, "__len__"):
-                tags = [tags]
-            for tag in tags:
-                db_records = db_records.filter(tags__contains=tag)
-        return [db_record.label for db_record in db_records]
+            db_records = self._get_models().filter_by_tags(db_records, tags)
+        return self._to_sumatra(db_records)
+
+    def iter_records(self, project_name, tags=None, chunk_size=500):
+        """
+        Iterate over the records for the given project, retrieving them from
+        the database `chunk_size` at a time.
+        """
+        db_records = self._manager.filter(project__id=project_name).select_related(
+            'executable', 'repository', 'parameters', 'launch_mode', 'datastore', 'input_datastore'
+        ).prefetch_related('input_data', 'output_data', 'dependencies', 'platforms')
+        if tags:
+            db_records = self._get_models().filter_by_tags(db_records, tags)
+        for db_record in db_records.iterator(chunk_size=chunk_size):
+            yield db_record.to_sumatra()
+
+    def save_many(self, project_name, records):
+        """Store the given records in a single transaction."""
+        from django.db import transaction
+        self._get_models()  # ensures Django is configured before the transaction is opened
+        with transaction.atomic(using=self._db_label):
+            for record in records:
+                self.save(project_name, record)
+
+    def list_by_tags(self, project_name, tags, require_all=False):
+        """
+        Return a list of records for the given project that are tagged with
+        any of the given tags or, if `require_all` is True, with all of them.
+        """
+        db_records = self._manager.filter(project__id=project_name).select_related()
+        return self._to_sumatra(self._get_models().filter_by_tags(db_records, tags, require_all))
+
+    def labels(self, project_name, tags=None, *args, **kwargs):
+        db_records = self._manager.filter(project__id=project_name, *args, **kwargs)
+        if tags:
+            db_records = self._get_models().filter_by_tags(db_records, tags)
+        return list(db_records.values_list('label', flat=True))
+
+    def labels_starting_with(self, project_name, prefix):
+        db_records = self._manager.filter(project__id=project_name, label__startswith=prefix)
+        return list(db_records.values_list('label', flat=True))
 
     def delete(self, project_name, label):
         db_record = self._manager.get(label=label, project__id=project_name)
         db_record.delete()
 
+    def delete_records(self, project_name, labels):
+        from django.db import transaction
+        models = self._get_models()
+        labels = list(labels)
+        deleted = []
+        chunk_size = 900  # keep the number of query parameters within SQLite's limit
+        with transaction.atomic(using=self._db_label):
+            for i in range(0, len(labels), chunk_size):
+                deleted.extend(models.delete_records(
+                    self._manager.filter(project__id=project_name, label__in=labels[i:i + chunk_size])))
+        return deleted
+
     def delete_by_tag(self, project_name, tag):
-        db_records = self._manager.filter(project__id=project_name, tags__contains=tag)
-        n = db_records.count()
-        for db_record in db_records:
-            db_record.delete()
-        return n
+        models = self._get_models()
+        db_records = models.filter_by_tags(self._manager.filter(project__id=project_name), [tag])
+        return len(models.delete_records(db_records))
+
+    def update(self, project_name, field, value, tags=None):
+        """
+        Modify the records for a given project. Datastore attributes, e.g.
+        "datastore.root", are changed with one UPDATE query for each distinct
+        datastore used by the records, rather than by re-saving each record.
+        """
+        parts = field.split(".")
+        if len(parts) != 2 or parts[0] not in ("datastore", "input_datastore"):
+            return super(DjangoRecordStore, self).update(project_name, field, value, tags)
+        from django.db import transaction
+        models = self._get_models()
+        db_records = self._manager.filter(project__id=project_name)
+        if tags:
+            db_records = models.filter_by_tags(db_records, tags)
+        # datastores may be shared with the records of other projects, so rather
+        # than modifying them, we point the records to new datastores
+        with transaction.atomic(using=self._db_label):
+            datastore_ids = set(db_records.values_list(parts[0], flat=True))
+            for db_datastore in models.Datastore.objects.using(self._db_label).filter(id__in=datastore_ids):
+                datastore = db_datastore.to_sumatra()
+                setattr(datastore, parts[1], value)
+                new_db_datastore = self._get_db_obj('Datastore', datastore)
+                if new_db_datastore.pk != db_datastore.pk:
+                    db_records.filter(**{parts[0]: db_datastore}).update(**{parts[0]: new_db_datastore})
 
     def most_recent(self, project_name):
         models = self._get_models()
@@ -309,8 +448,11 @@ class DjangoRecordStore(RecordStore):
 
     def delete_all(self):
         """Delete everything from the database."""
+        from django.core import management
         management.call_command('flush', database=self._db_label,
                                 interactive=False, verbosity=0)
+        from . import search
+        search.clear(using=self._db_label)
 
     def clear(self):
         """
@@ -325,8 +467,10 @@ class DjangoRecordStore(RecordStore):
                              for x in ("record", "record_input_data", "record_dependencies",
                                        "record_platforms", "platforminformation", "datakey", "datastore", "launchmode",
                                        "taggeditem", "tag",
-                                       "parameterset", "repository", "dependency", "executable", "project")] + ["COMMIT;"]
+                                       "parametervalue", "parameterset", "repository", "dependency", "executable", "project")] + ["COMMIT;"]
         from django.db import connection
+        from . import search
+        search.clear(using=self._db_label)
         cur = connection.cursor()
         for cmd in cmds:
             cur.execute(cmd)
@@ -337,6 +481,7 @@ class DjangoRecordStore(RecordStore):
         Dump the database contents to a JSON-encoded string
         """
         import sys
+        from django.core import management
         data = StringIO()
         sys.stdout = data
         management.call_command('dumpdata', 'django_store', indent=indent)
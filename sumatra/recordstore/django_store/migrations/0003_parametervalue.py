@@ -0,0 +1,25 @@
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_store', '0002_tag_taggeditem'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ParameterValue',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255)),
+                ('value_text', models.TextField()),
+                ('value_number', models.FloatField(null=True)),
+                ('parameter_set', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='values', to='django_store.parameterset')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['name', 'value_number'], name='parametervalue_name_number')],
+            },
+        ),
+    ]
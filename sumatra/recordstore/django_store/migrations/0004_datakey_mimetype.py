@@ -0,0 +1,43 @@
+import ast
+import json
+from django.db import migrations, models
+
+
+def copy_mimetypes(apps, schema_editor):
+    """Fill the new mimetype column from the metadata of existing data keys."""
+    DataKey = apps.get_model('django_store', 'DataKey')
+    db_alias = schema_editor.connection.alias
+    data_keys = DataKey.objects.using(db_alias).filter(metadata__contains='mimetype').only('id', 'metadata')
+    changed = []
+    for data_key in data_keys.iterator(chunk_size=1000):
+        try:
+            metadata = json.loads(data_key.metadata)
+        except ValueError:  # metadata stored by older versions of Sumatra
+            try:
+                metadata = ast.literal_eval(data_key.metadata)
+            except (ValueError, SyntaxError):
+                continue
+        data_key.mimetype = metadata.get('mimetype') or ''
+        if data_key.mimetype:
+            changed.append(data_key)
+    DataKey.objects.using(db_alias).bulk_update(changed, ['mimetype'], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_store', '0003_parametervalue'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='datakey',
+            name='mimetype',
+            field=models.CharField(blank=True, default='', max_length=100),
+        ),
+        migrations.AddIndex(
+            model_name='datakey',
+            index=models.Index(fields=['mimetype', 'creation'], name='datakey_mimetype_creation'),
+        ),
+        migrations.RunPython(copy_mimetypes, migrations.RunPython.noop),
+    ]
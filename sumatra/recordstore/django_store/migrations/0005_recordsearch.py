@@ -0,0 +1,42 @@
+from django.db import migrations
+
+
+def build_search_index(apps, schema_editor):
+    """Create the full-text search index (see search.py), and add the existing records to it."""
+    from sumatra.recordstore.django_store import search
+    from sumatra.recordstore.django_store.parameter_index import parameter_set_from_content
+    connection = schema_editor.connection
+    if not search.create_index(connection):
+        return
+    Record = apps.get_model('django_store', 'Record')
+    parameter_sets = {}  # records often share a parameter set, so each is parsed only once
+    documents = []
+    for db_record in Record.objects.using(connection.alias).select_related('parameters').iterator(chunk_size=1000):
+        db_parameter_set = db_record.parameters
+        if db_parameter_set.pk not in parameter_sets:
+            try:
+                parameter_sets[db_parameter_set.pk] = parameter_set_from_content(db_parameter_set.type,
+                                                                                 db_parameter_set.content)
+            except Exception:  # parameters are not searchable, but the rest of the record is
+                parameter_sets[db_parameter_set.pk] = {}
+        documents.append((db_record.db_id, search.document(db_record, parameter_sets[db_parameter_set.pk])))
+        if len(documents) == 1000:
+            search.index_records(documents, using=connection.alias)
+            documents = []
+    search.index_records(documents, using=connection.alias)
+
+
+def drop_search_index(apps, schema_editor):
+    from sumatra.recordstore.django_store import search
+    search.drop_index(schema_editor.connection)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_store', '0004_datakey_mimetype'),
+    ]
+
+    operations = [
+        migrations.RunPython(build_search_index, drop_search_index),
+    ]
@@ -0,0 +1,44 @@
+from django.db import migrations
+
+
+def add_missing_tagged_items(apps, schema_editor):
+    """
+    Tag queries use the TaggedItem table, so make sure that it contains every
+    tag in the tag string stored with each record. (Records stored in a
+    database other than the default one used to have their tags written to
+    the default database.)
+    """
+    from sumatra.recordstore.django_store.tagging_utils import parse_tag_input
+    db_alias = schema_editor.connection.alias
+    Record = apps.get_model('django_store', 'Record')
+    Tag = apps.get_model('django_store', 'Tag')
+    TaggedItem = apps.get_model('django_store', 'TaggedItem')
+    ContentType = apps.get_model('contenttypes', 'ContentType')
+    tagged_records = Record.objects.using(db_alias).exclude(tags='').values_list('db_id', 'tags')
+    if not tagged_records.exists():
+        return
+    content_type, created = ContentType.objects.using(db_alias).get_or_create(app_label='django_store',
+                                                                              model='record')
+    existing = set(TaggedItem.objects.using(db_alias).filter(content_type=content_type)
+                   .values_list('object_id', 'tag__name'))
+    missing = [(db_id, name) for db_id, tags in tagged_records.iterator()
+               for name in parse_tag_input(tags) if (db_id, name) not in existing]
+    tag_ids = {}
+    for name in set(name for db_id, name in missing):
+        tag_ids[name] = Tag.objects.using(db_alias).get_or_create(name=name)[0].pk
+    TaggedItem.objects.using(db_alias).bulk_create(
+        [TaggedItem(tag_id=tag_ids[name], content_type=content_type, object_id=db_id)
+         for db_id, name in missing],
+        batch_size=500, ignore_conflicts=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('django_store', '0005_recordsearch'),
+    ]
+
+    operations = [
+        migrations.RunPython(add_missing_tagged_items, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 5.2.18 on 2026-10-19 09:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_store', '0006_record_tagged_items'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='datakey',
+            index=models.Index(fields=['path', 'digest', 'creation'], name='datakey_path_digest_creation'),
+        ),
+        migrations.AddIndex(
+            model_name='record',
+            index=models.Index(fields=['project', 'label'], name='record_project_label'),
+        ),
+        migrations.AddIndex(
+            model_name='record',
+            index=models.Index(fields=['project', '-timestamp'], name='record_project_timestamp'),
+        ),
+    ]
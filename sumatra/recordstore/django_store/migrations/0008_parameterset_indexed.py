@@ -0,0 +1,30 @@
+from django.db import migrations, models
+
+
+def index_parameter_sets(apps, schema_editor):
+    """
+    Store the values of the parameter sets saved by older versions of Sumatra
+    in the ParameterValue table. Parameter sets saved since then were indexed
+    when they were saved, but could not be distinguished from those without
+    any parameters, so they are indexed again.
+    """
+    from sumatra.recordstore.django_store.parameter_index import index_parameter_sets
+    index_parameter_sets(apps.get_model('django_store', 'ParameterSet'),
+                         apps.get_model('django_store', 'ParameterValue'),
+                         using=schema_editor.connection.alias)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_store', '0007_lookup_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='parameterset',
+            name='indexed',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.RunPython(index_parameter_sets, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,23 @@
+from django.db import migrations
+
+
+def clear_inexact_numbers(apps, schema_editor):
+    """
+    Integers too large to be represented exactly as floats used to be stored
+    as approximate numbers, so that equality tests on them could match the
+    wrong records. They are now compared as text.
+    """
+    from sumatra.recordstore.django_store.parameter_index import clear_inexact_numbers
+    clear_inexact_numbers(apps.get_model('django_store', 'ParameterValue'),
+                          using=schema_editor.connection.alias)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_store', '0008_parameterset_indexed'),
+    ]
+
+    operations = [
+        migrations.RunPython(clear_inexact_numbers, migrations.RunPython.noop),
+    ]
@@ -8,9 +8,11 @@ Definition of database tables and object retrieval for the DjangoRecordStore.
 
 from datetime import datetime
 import json
+import math
 
 from packaging.version import parse as parse_version
-from django.db import models
+from django.db import models, transaction
+from django.contrib.contenttypes.models import ContentType
 import django
 
 from sumatra import programs, launch, datastore, records, versioncontrol, parameters, dependency_finder
@@ -18,6 +20,7 @@ from sumatra.datastore import get_data_store
 from sumatra.core import get_registered_components
 
 from .tagging import TagField, Tag, TaggedItem, TagManager
+from . import search, parameter_index
 
 
 class SumatraObjectsManager(models.Manager):
@@ -28,13 +31,16 @@ class SumatraObjectsManager(models.Manager):
         # want to store in a single table in the database.
         # might be better to specify the list of field names explicitly
         # as an argument to the Manager __init__().
-        excluded_fields = ('id', 'record', 'input_to_records', 'output_from_record', 'output_from_record_id')
+        excluded_fields = ('id', 'record', 'input_to_records', 'output_from_record', 'output_from_record_id', 'values',
+                           'indexed')
         field_names = set([f.name for f in self.model._meta.get_fields()]).difference(excluded_fields)
         attributes = {}
         for name in field_names:
             if name == 'metadata':
                 assert isinstance(obj.metadata, dict)
                 attributes[name] = json.dumps(obj.metadata, sort_keys=True)  # DataKey
+            elif name == 'mimetype':
+                attributes[name] = obj.metadata.get('mimetype') or ''  # DataKey
             else:
                 try:
                     attributes[name] = getattr(obj, name)
@@ -147,17 +153,68 @@ class Repository(BaseModel):
 class ParameterSet(BaseModel):
     type = models.CharField(max_length=100)
     content = models.TextField()
+    indexed = models.BooleanField(default=False)  # have the values been stored in the ParameterValue table?
 
     def to_sumatra(self):
-        if hasattr(parameters, self.type):
-            ps = getattr(parameters, self.type)(self.content)
-        elif self.content == 'None':
-            ps = None
-        elif self.content == '{}':
-            ps = {}
+        return parameter_index.parameter_set_from_content(self.type, self.content)
+
+    def index(self, parameter_set=None, using='default'):
+        """
+        Store the flattened values of the parameter set in the ParameterValue
+        table. If the parameter set is not given, it is rebuilt from the
+        stored content.
+        """
+        if parameter_set is None:
+            parameter_set = self.to_sumatra()
+        ParameterValue.objects.using(using).bulk_create(
+            ParameterValue(parameter_set=self, name=name, value_text=value_text, value_number=value_number)
+            for name, value_text, value_number in parameter_index.parameter_values(parameter_set)
+        )
+        self.indexed = True
+        self.save(using=using, update_fields=['indexed'])
+
+
+class ParameterValue(models.Model):
+    """
+    A single value from a parameter set, with the names of nested parameters
+    flattened, e.g. "a.b", so that records can be queried by parameter value.
+    Numerical (and boolean) values are also stored as numbers, for range
+    queries.
+    """
+    parameter_set = models.ForeignKey(ParameterSet, related_name='values', on_delete=models.CASCADE)
+    name = models.CharField(max_length=255)
+    value_text = models.TextField()
+    value_number = models.FloatField(null=True)
+
+    lookups = {"=": "", "<": "__lt", "<=": "__lte", ">": "__gt", ">=": "__gte"}
+
+    class Meta(object):
+        indexes = [models.Index(fields=['name', 'value_number'], name='parametervalue_name_number')]
+
+    index_values = staticmethod(parameter_index.index_values)
+
+    @classmethod
+    def filter_arguments(cls, name, operator, value, prefix='parameters__values__'):
+        """
+        Return the keyword arguments for filtering records by the predicate
+        (name, operator, value).
+
+        Integers too large to be stored exactly as numbers are compared as
+        text for equality, and approximately for the other operators. In the
+        latter case, stored values that are themselves too large are not
+        matched.
+        """
+        value_text, value_number = cls.index_values(value)
+        if value_number is None and operator != "=" and isinstance(value, int):
+            try:
+                value_number = float(value)
+            except OverflowError:
+                value_number = math.copysign(math.inf, value)
+        if value_number is None:
+            field, value = 'value_text', value_text
         else:
-            ps = self.content
-        return ps
+            field, value = 'value_number', value_number
+        return {prefix + 'name': name, prefix + field + cls.lookups[operator]: value}
 
 
 class LaunchMode(BaseModel):
@@ -197,11 +254,14 @@ class DataKey(BaseModel):
     digest = models.CharField(max_length=40)
     creation = models.DateTimeField(null=True, blank=True)
     metadata = models.TextField(blank=True)
+    mimetype = models.CharField(max_length=100, blank=True, default='')  # copied from metadata, for querying
     output_from_record = models.ForeignKey('Record', related_name='output_data',
                                            null=True, on_delete=models.CASCADE)
 
     class Meta(object):
         ordering = ('path',)
+        indexes = [models.Index(fields=['mimetype', 'creation'], name='datakey_mimetype_creation'),
+                   models.Index(fields=['path', 'digest', 'creation'], name='datakey_path_digest_creation')]
 
     def get_metadata(self):
         try:
@@ -266,11 +326,27 @@ class Record(BaseModel):
     stdout_stderr = models.TextField(blank=True)
     repeats = models.CharField(max_length=100, null=True, blank=True)
 
-    # parameters which will be used in the fulltext search (see sumatra.web.services fulltext_search)
-    params_search = ('label', 'reason', 'duration', 'main_file', 'outcome', 'user', 'tags')
+    # fields indexed for full-text search: see search.FIELDS
+    params_search = ('label', 'reason', 'outcome', 'tags', 'main_file', 'version')
 
     class Meta(object):
         ordering = ('-timestamp',)
+        # labels should be unique within a project, but this is not enforced by the database,
+        # since record stores created by older versions of Sumatra may contain duplicates
+        indexes = [models.Index(fields=['project', 'label'], name='record_project_label'),
+                   models.Index(fields=['project', '-timestamp'], name='record_project_timestamp')]
+
+    def update_search_index(self, parameter_set=None, using=None):
+        """
+        Add the record to the full-text search index, or update its entry. If
+        the parsed parameter set is not given, it is obtained from the record.
+        """
+        search.index_records([(self.db_id, search.document(self, parameter_set))],
+                             using=using or self._state.db)
+
+    def delete(self, using=None, keep_parents=False):
+        """Delete the record, together with its output data keys and tags (see :func:`delete_records`)."""
+        delete_records(Record.objects.using(using or self._state.db).filter(db_id=self.db_id))
 
     def to_sumatra(self):
         record = records.Record(
@@ -310,3 +386,60 @@ class Record(BaseModel):
 
     def working_directory(self):
         return self.launch_mode.get_parameters().get('working_directory', None)
+
+
+def filter_by_tags(db_records, tags, require_all=True):
+    """
+    Return the records from the queryset `db_records` that are tagged with
+    all of the given tags or, if `require_all` is False, with any of them.
+    Tag names must match exactly. The lookup uses the indexes of the Tag and
+    TaggedItem tables, rather than the tag string stored with each record.
+    """
+    if isinstance(tags, str):
+        tags = [tags]
+    if not tags:
+        return db_records
+    using = db_records.db
+    content_type = ContentType.objects.db_manager(using).get_for_model(Record)
+    items = TaggedItem.objects.using(using).filter(content_type=content_type)
+    if require_all:
+        for tag in set(tags):
+            db_records = db_records.filter(db_id__in=items.filter(tag__name=tag).values('object_id'))
+    else:
+        db_records = db_records.filter(db_id__in=items.filter(tag__name__in=tags).values('object_id'))
+    return db_records
+
+
+def delete_records(db_records, chunk_size=500):
+    """
+    Delete the records in the queryset `db_records` in a single transaction,
+    together with their output data keys, their tags and their entries in the
+    search index. Records are deleted `chunk_size` at a time, with a fixed
+    number of queries per chunk. Input data keys and tags that are no longer
+    used by any record are then deleted. Return the labels of the deleted
+    records.
+    """
+    using = db_records.db
+    with transaction.atomic(using=using):
+        rows = list(db_records.values_list('db_id', 'label'))
+        content_type = ContentType.objects.db_manager(using).get_for_model(Record)
+        input_keys = set()
+        tags = set()
+        for i in range(0, len(rows), chunk_size):
+            ids = [db_id for db_id, label in rows[i:i + chunk_size]]
+            tagged_items = TaggedItem.objects.using(using).filter(content_type=content_type, object_id__in=ids)
+            tags.update(tagged_items.values_list('tag_id', flat=True))
+            tagged_items.delete()
+            input_keys.update(Record.input_data.through.objects.using(using)
+                              .filter(record_id__in=ids).values_list('datakey_id', flat=True))
+            Record.objects.using(using).filter(db_id__in=ids).delete()  # also deletes the output data keys
+            search.remove_records(ids, using=using)
+        input_keys = list(input_keys)
+        for i in range(0, len(input_keys), chunk_size):
+            DataKey.objects.using(using).filter(id__in=input_keys[i:i + chunk_size],
+                                                output_from_record__isnull=True,
+                                                input_to_records__isnull=True).delete()
+        tags = list(tags)
+        for i in range(0, len(tags), chunk_size):
+            Tag.objects.using(using).filter(id__in=tags[i:i + chunk_size], items__isnull=True).delete()
+    return [label for db_id, label in rows]
@@ -0,0 +1,98 @@
+"""
+Functions for storing the values of parameter sets in the ParameterValue
+table, so that records can be queried by parameter value. They are kept
+separate from the models so that data migrations can use them.
+
+
+:copyright: Copyright 2006-2020, 2024 by the Sumatra team, see doc/authors.txt
+:license: BSD 2-clause, see LICENSE for details.
+"""
+
+from django.db import models
+from sumatra import parameters
+
+
+def parameter_set_from_content(type, content):
+    """Rebuild a parameter set from the type and content stored in the ParameterSet table."""
+    if hasattr(parameters, type):
+        return getattr(parameters, type)(content)
+    elif content == 'None':
+        return None
+    elif content == '{}':
+        return {}
+    else:
+        return content
+
+
+def exact_float(value):
+    """
+    Return the value as a float, or None if it is not a number or cannot be
+    represented exactly as a float, e.g. an integer larger than 2**53.
+    """
+    if isinstance(value, (bool, int, float)) and value == value:  # excludes NaN
+        try:
+            number = float(value)
+        except OverflowError:
+            return None
+        if isinstance(value, float) or int(number) == value:
+            return number
+    return None
+
+
+def index_values(value):
+    """
+    Return the text and numerical values under which a parameter value is
+    stored. Values that cannot be stored exactly as a number are stored only
+    as text, so that equality tests on them are exact.
+    """
+    return str(value), exact_float(value)
+
+
+def parameter_values(parameter_set):
+    """
+    Return a list of (name, value_text, value_number) tuples, one per value
+    in the parameter set, with the names of nested parameters flattened.
+    """
+    return [(name,) + index_values(value)
+            for name, value in parameters.flatten(parameter_set).items()]
+
+
+def index_parameter_sets(ParameterSet, ParameterValue, using='default'):
+    """
+    Store the values of all the parameter sets that have not yet been indexed.
+    The model classes are passed in, so that migrations can use their
+    historical versions.
+    """
+    unindexed = ParameterSet.objects.using(using).filter(indexed=False)
+    for db_parameter_set in unindexed.iterator(chunk_size=500):
+        try:
+            parameter_set = parameter_set_from_content(db_parameter_set.type, db_parameter_set.content)
+            values = parameter_values(parameter_set)
+        except Exception:  # the parameters cannot be queried, but the record remains usable
+            values = []
+        ParameterValue.objects.using(using).filter(parameter_set=db_parameter_set).delete()
+        ParameterValue.objects.using(using).bulk_create(
+            [ParameterValue(parameter_set=db_parameter_set, name=name, value_text=value_text,
+                            value_number=value_number)
+             for name, value_text, value_number in values],
+            batch_size=500)
+    unindexed.update(indexed=True)
+
+
+def clear_inexact_numbers(ParameterValue, using='default'):
+    """
+    Remove the numerical values of integers stored by earlier versions of
+    Sumatra that are too large to be represented exactly as floats.
+    """
+    inexact = []
+    large_values = ParameterValue.objects.using(using).filter(
+        models.Q(value_number__gte=2**53) | models.Q(value_number__lte=-2**53))
+    for pk, value_text in large_values.values_list('pk', 'value_text').iterator():
+        try:
+            value = int(value_text)
+        except ValueError:  # a float
+            continue
+        if exact_float(value) is None:
+            inexact.append(pk)
+    for i in range(0, len(inexact), 500):
+        ParameterValue.objects.using(using).filter(pk__in=inexact[i:i + 500]).update(value_number=None)
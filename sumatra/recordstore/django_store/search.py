@@ -0,0 +1,159 @@
+"""
+Full-text index of records, used by the web interface to search records.
+
+The label, reason, outcome, tags, main file, code version and (flattened)
+parameters of each record are indexed. With SQLite, the index is an FTS5
+virtual table; with PostgreSQL, it is a table of tsvector documents with a
+GIN index. Other databases have no index, and searching falls back to
+substring matching.
+
+The index is created by a migration, and kept up to date by
+:class:`DjangoRecordStore` and the web interface when records are saved or
+deleted.
+
+:copyright: Copyright 2006-2020, 2024 by the Sumatra team, see doc/authors.txt
+:license: BSD 2-clause, see LICENSE for details.
+"""
+
+import re
+from django.db import connections, transaction, DatabaseError
+from django.db.models import Q
+from django.db.models.signals import post_migrate
+from django.db.models.expressions import RawSQL
+from sumatra.parameters import flatten
+
+TABLE = "django_store_recordsearch"
+FIELDS = ("label", "reason", "outcome", "tags", "main_file", "version", "parameters")
+SEARCH_CONFIG = "simple"  # PostgreSQL text search configuration: no stemming or stop words
+
+_available = {}  # whether the index exists, for each database
+
+
+def _forget_availability(sender, using="default", **kwargs):
+    """Check again whether the index exists once migrations have been applied or reverted."""
+    _available.pop(using, None)
+
+
+post_migrate.connect(_forget_availability, dispatch_uid="sumatra.recordstore.django_store.search")
+
+
+def create_index(connection):
+    """Create the index table, if the database supports it."""
+    if connection.vendor == "sqlite":
+        sql = ["CREATE VIRTUAL TABLE %s USING fts5(%s)" % (TABLE, ", ".join(FIELDS))]
+    elif connection.vendor == "postgresql":
+        sql = ["CREATE TABLE %s (record_id integer PRIMARY KEY, document tsvector NOT NULL)" % TABLE,
+               "CREATE INDEX %s_document ON %s USING GIN (document)" % (TABLE, TABLE)]
+    else:
+        return False
+    try:
+        with transaction.atomic(using=connection.alias):
+            with connection.cursor() as cursor:
+                for statement in sql:
+                    cursor.execute(statement)
+    except DatabaseError:  # e.g. SQLite compiled without FTS5
+        return False
+    _available.pop(connection.alias, None)
+    return True
+
+
+def drop_index(connection):
+    if is_available(connection.alias):
+        with connection.cursor() as cursor:
+            cursor.execute("DROP TABLE %s" % TABLE)
+    _available.pop(connection.alias, None)
+
+
+def is_available(using="default"):
+    """Does the database contain the search index?"""
+    if using not in _available:
+        connection = connections[using]
+        _available[using] = (connection.vendor in ("sqlite", "postgresql")
+                             and TABLE in connection.introspection.table_names())
+    return _available[using]
+
+
+def document(db_record, parameter_set=None):
+    """
+    Return the text to be indexed for a record, as a tuple with one element
+    per name in FIELDS. If the parsed parameter set is not given, it is
+    obtained from the record.
+    """
+    if parameter_set is None:
+        parameter_set = db_record.parameters.to_sumatra()
+    parameters = " ".join("%s=%s" % item for item in flatten(parameter_set).items())
+    return (db_record.label, db_record.reason, db_record.outcome, db_record.tags,
+            db_record.main_file, db_record.version, parameters)
+
+
+def index_records(documents, using="default"):
+    """
+    Add or replace the index entries for the given records. `documents` is a
+    list of (db_id, document) pairs, where `document` is as returned by
+    :func:`document`.
+    """
+    if not documents or not is_available(using):
+        return
+    connection = connections[using]
+    ids = [db_id for db_id, doc in documents]
+    with connection.cursor() as cursor:
+        if connection.vendor == "sqlite":
+            cursor.execute("DELETE FROM %s WHERE rowid IN (%s)" % (TABLE, ", ".join(["%s"] * len(ids))), ids)
+            cursor.executemany(
+                "INSERT INTO %s (rowid, %s) VALUES (%s)" % (TABLE, ", ".join(FIELDS), ", ".join(["%s"] * (len(FIELDS) + 1))),
+                [(db_id,) + tuple(doc) for db_id, doc in documents])
+        else:
+            cursor.executemany(
+                "INSERT INTO %s (record_id, document) VALUES (%%s, to_tsvector('%s', %%s)) "
+                "ON CONFLICT (record_id) DO UPDATE SET document = EXCLUDED.document" % (TABLE, SEARCH_CONFIG),
+                [(db_id, " ".join(value or "" for value in doc)) for db_id, doc in documents])
+
+
+def remove_records(db_ids, using="default"):
+    """Remove the index entries for the records with the given ids."""
+    db_ids = list(db_ids)
+    if not db_ids or not is_available(using):
+        return
+    connection = connections[using]
+    column = connection.vendor == "sqlite" and "rowid" or "record_id"
+    with connection.cursor() as cursor:
+        cursor.execute("DELETE FROM %s WHERE %s IN (%s)" % (TABLE, column, ", ".join(["%s"] * len(db_ids))),
+                       db_ids)
+
+
+def clear(using="default"):
+    """Remove all entries from the index."""
+    if is_available(using):
+        with connections[using].cursor() as cursor:
+            cursor.execute("DELETE FROM %s" % TABLE)
+
+
+def search_terms(search_value):
+    """Split the text entered in a search box into words."""
+    return re.findall(r"\w+", search_value)
+
+
+def filter_records(db_records, search_value, using="default"):
+    """
+    Return the records from the `db_records` queryset that contain all the
+    words in `search_value`, each word matching the start of a word in the
+    record. Without a search index, each word may match anywhere in the
+    label, reason, outcome, main file, code version or tags.
+    """
+    terms = search_terms(search_value)
+    if not terms:
+        return db_records
+    if not is_available(using):
+        for term in terms:
+            db_records = db_records.filter(
+                Q(label__contains=term) | Q(reason__contains=term) | Q(outcome__contains=term) |
+                Q(main_file__contains=term) | Q(version__contains=term) | Q(tags__contains=term))
+        return db_records
+    if connections[using].vendor == "sqlite":
+        query = " ".join('"%s"*' % term for term in terms)
+        matches = RawSQL("SELECT rowid FROM %s WHERE %s MATCH %%s" % (TABLE, TABLE), [query])
+    else:
+        query = " & ".join("%s:*" % term for term in terms)
+        matches = RawSQL("SELECT record_id FROM %s WHERE document @@ to_tsquery('%s', %%s)"
+                         % (TABLE, SEARCH_CONFIG), [query])
+    return db_records.filter(db_id__in=matches)
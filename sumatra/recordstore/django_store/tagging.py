@@ -85,7 +85,7 @@ class TagField(CharField):
         """
         tags = self._get_instance_tag_cache(kwargs['instance'])
         if tags is not None:
-            Tag.objects.update_tags(kwargs['instance'], tags)
+            Tag.objects.db_manager(kwargs.get('using')).update_tags(kwargs['instance'], tags)
 
     def __delete__(self, instance):
         """
@@ -121,7 +121,7 @@ class TagManager(models.Manager):
         """
         Update tags associated with an object.
         """
-        ctype = ContentType.objects.get_for_model(obj)
+        ctype = ContentType.objects.db_manager(self.db).get_for_model(obj)
         current_tags = list(self.filter(items__content_type__pk=ctype.pk,
                                         items__object_id=obj.pk))
         updated_tag_names = parse_tag_input(tag_names)
@@ -130,7 +130,7 @@ class TagManager(models.Manager):
         tags_for_removal = [tag for tag in current_tags
                             if tag.name not in updated_tag_names]
         if len(tags_for_removal):
-            TaggedItem._default_manager.filter(
+            TaggedItem._default_manager.using(self.db).filter(
                 content_type__pk=ctype.pk,
                 object_id=obj.pk,
                 tag__in=tags_for_removal).delete()
@@ -139,7 +139,7 @@ class TagManager(models.Manager):
         for tag_name in updated_tag_names:
             if tag_name not in current_tag_names:
                 tag, created = self.get_or_create(name=tag_name)
-                TaggedItem._default_manager.get_or_create(
+                TaggedItem._default_manager.using(self.db).get_or_create(
                     content_type_id=ctype.pk,
                     object_id=obj.pk,
                     tag=tag,
@@ -150,9 +150,10 @@ class TagManager(models.Manager):
         Create a queryset matching all tags associated with the given
         object.
         """
-        ctype = ContentType.objects.get_for_model(obj)
-        return self.filter(items__content_type__pk=ctype.pk,
-                           items__object_id=obj.pk)
+        using = obj._state.db or self.db
+        ctype = ContentType.objects.db_manager(using).get_for_model(obj)
+        return self.using(using).filter(items__content_type__pk=ctype.pk,
+                                        items__object_id=obj.pk)
 
 
 class Tag(models.Model):
@@ -179,6 +179,10 @@ class HttpRecordStore(RecordStore):
         return self._get_record(url)
 
     def list(self, project_name, tags=None):
+        return list(self.iter_records(project_name, tags=tags))
+
+    def iter_records(self, project_name, tags=None):
+        """Iterate over the records for the given project, retrieving them one at a time."""
         project_url = "%s%s/" % (self.server_url, project_name)
         if tags:
             if not isinstance(tags, list):
@@ -187,11 +191,8 @@ class HttpRecordStore(RecordStore):
         response, content = self._get(project_url, 'project')
         if response.status != 200:
             raise RecordStoreAccessError("Could not access %s\n%s: %s" % (project_url, response.status, content))
-        record_urls = serialization.decode_project_data(content)["records"]
-        records = []
-        for record_url in record_urls:
-            records.append(self._get_record(record_url))
-        return records
+        for record_url in serialization.decode_project_data(content)["records"]:
+            yield self._get_record(record_url)
 
     def labels(self, project_name, tags=None):
         return [record.label for record in self.list(project_name, tags=tags)]  # probably inefficient
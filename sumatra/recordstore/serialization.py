@@ -1,5 +1,10 @@
 """
-Handles serialization/deserialization of record store contents to/from JSON.
+Handles serialization/deserialization of record store contents to/from JSON,
+or to/from the more compact msgpack binary format.
+
+JSON is encoded and decoded with the orjson package if it is installed, which
+is considerably faster than the json module from the standard library. The
+msgpack format requires the msgpack package.
 
 
 :copyright: Copyright 2006-2020, 2024 by the Sumatra team, see doc/authors.txt
@@ -12,12 +17,99 @@ from sumatra import programs, launch, datastore, versioncontrol, parameters, dep
 from sumatra.records import Record
 from ..core import get_registered_components
 from sumatra.formatting import record2json, record2dict
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# Version of the envelope {"schema_version": ..., "records": [...]} used for
+# collections of records in the msgpack format. Changes to the structure of
+# individual records are handled in build_record(), by checking for the
+# presence of fields.
+SCHEMA_VERSION = 1
+
+
+class JSONCodec(object):
+    """Encodes nested dicts as JSON, using orjson if it is available."""
+    name = "json"
+
+    def dumps(self, data):
+        if orjson is not None:
+            try:
+                return orjson.dumps(data).decode("utf-8")
+            except orjson.JSONEncodeError:  # e.g. integers too large for orjson
+                pass
+        return json.dumps(data)
+
+    def loads(self, content):
+        if orjson is not None:
+            try:
+                return orjson.loads(content)
+            except orjson.JSONDecodeError:  # e.g. NaN, which orjson does not accept
+                pass
+        return json.loads(content)
+
+
+class MsgpackCodec(object):
+    """Encodes nested dicts in the msgpack binary format."""
+    name = "msgpack"
+
+    def dumps(self, data):
+        return _require_msgpack().packb(data, use_bin_type=True)
+
+    def loads(self, content):
+        return _require_msgpack().unpackb(content, raw=False)
+
+
+def _require_msgpack():
+    if msgpack is None:
+        raise ImportError("The 'msgpack' package is needed for the msgpack format.")
+    return msgpack
+
+
+CODECS = {
+    "json": JSONCodec(),
+    "msgpack": MsgpackCodec(),
+}
+
+
+def get_codec(name):
+    """Return the codec with the given name ("json" or "msgpack")."""
+    try:
+        return CODECS[name]
+    except KeyError:
+        raise ValueError("Unknown format '%s'. Available formats are %s" % (name, ", ".join(sorted(CODECS))))
+
+
+def _detect_codec(content):
+    """Guess the codec used to encode `content`."""
+    if isinstance(content, bytes) and content.lstrip()[:1] not in (b"[", b"{"):
+        return CODECS["msgpack"]
+    return CODECS["json"]
 
 
 def encode_record(record, indent=None, with_timezones=True):
+    if indent is None:
+        return CODECS["json"].dumps(record2dict(record, with_timezones=with_timezones))
     return record2json(record, indent, with_timezones=with_timezones)
 
 
+def encode_records(records, format="json"):
+    """
+    Encode multiple Sumatra records. JSON is encoded as a list of records, as
+    produced by the "json" formatter, msgpack as a schema-versioned envelope.
+    """
+    codec = get_codec(format)
+    data = [record2dict(record) for record in records]
+    if codec.name != "json":
+        data = {"schema_version": SCHEMA_VERSION, "records": data}
+    return codec.dumps(data)
+
+
 def encode_project_info(long_name, description):
     """Encode a Sumatra project as JSON"""
     data = {}
@@ -51,39 +143,73 @@ def decode_project_data(content):
 
 
 def datestring_to_datetime(s):
-    """docstring"""
+    """
+    Convert a timestamp string, as produced by record2dict(), to a
+    timezone-aware datetime. Timestamps without a timezone are taken to be UTC.
+    """
     if s is None:
         return s
     if s.endswith(" 00:00"):
         # this is a hack to handle any timestamps that have not been urlencoded
         # (so that the '+' is interpreted as a space).
         s = s[:-6] + "+00:00"
+    try:
+        timestamp = datetime.fromisoformat(s)
+    except ValueError:
+        # before Python 3.11, fromisoformat() does not accept offsets such as "+0000"
+        timestamp = _parse_timestamp(s)
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.replace(tzinfo=timezone.utc)
+    return timestamp
+
+
+def _parse_timestamp(s):
     formats = ["%Y-%m-%d %H:%M:%S%z", "%Y-%m-%dT%H:%M:%S%z", "%Y-%m-%d %H:%M:%S", "%Y-%m-%dT%H:%M:%S"]
-    timestamp = None
     for format in formats:
         try:
-            timestamp = datetime.strptime(s, format)
+            return datetime.strptime(s, format)
         except ValueError:
             continue
-    if timestamp is None:
-        raise ValueError(f"Cannot parse timestamp '{s}'")
-    if timestamp.tzinfo is None:
-        timestamp = timestamp.replace(tzinfo=timezone.utc)
-    return timestamp
+    raise ValueError(f"Cannot parse timestamp '{s}'")
+
+
+# Classes looked up by name when building records, cached since the same few
+# classes are needed for every record
+_class_cache = {}
+
+
+def _lookup_class(kind, name, lookup):
+    """
+    Return the class found by `lookup(name)`, caching it under (kind, name).
+    Failed lookups, which return None, are not cached, since the class may be
+    registered later, e.g. by a plug-in.
+    """
+    key = (kind, name)
+    try:
+        return _class_cache[key]
+    except KeyError:
+        cls = lookup(name)
+        if cls is not None:
+            _class_cache[key] = cls
+        return cls
+
+
+def _find_repository_class(name):
+    for m in versioncontrol.vcs_list:
+        if hasattr(m, name):
+            return getattr(m, name)
+    return None
 
 
 def build_record(data):
     """Create a Sumatra record from a nested dictionary."""
     edata = data["executable"]
-    cls = get_registered_components(programs.Executable).get(edata["name"], programs.Executable)
-    executable = cls(edata["path"], edata["version"], edata.get("options", ""))
+    cls = _lookup_class("executable", edata["name"],
+                        lambda name: get_registered_components(programs.Executable).get(name))
+    executable = (cls or programs.Executable)(edata["path"], edata["version"], edata.get("options", ""))
     executable.name = edata["name"]
     rdata = data["repository"]
-    repos_cls = None
-    for m in versioncontrol.vcs_list:
-        if hasattr(m, rdata["type"]):
-            repos_cls = getattr(m, rdata["type"])
-            break
+    repos_cls = _lookup_class("repository", rdata["type"], _find_repository_class)
     if repos_cls is None:
         repos_cls = versioncontrol.base.Repository
     repository = repos_cls(rdata["url"])
@@ -93,18 +219,21 @@ def build_record(data):
         parameter_set = eval(pdata["content"])
         assert isinstance(parameter_set, dict)
     else:
-        parameter_set = getattr(parameters, pdata["type"])(pdata["content"])
+        parameter_set = _lookup_class("parameters", pdata["type"],
+                                      lambda name: getattr(parameters, name))(pdata["content"])
     ldata = data["launch_mode"]
     lm_parameters = ldata["parameters"]
     if isinstance(lm_parameters, str):  # prior to 0.3
         lm_parameters = eval(lm_parameters)
-    launch_mode = getattr(launch, ldata["type"])(**keys2str(lm_parameters))
+    launch_mode = _lookup_class("launch_mode", ldata["type"],
+                                lambda name: getattr(launch, name))(**keys2str(lm_parameters))
 
     def build_data_store(ddata):
         ds_parameters = ddata["parameters"]
         if isinstance(ds_parameters, str):  # prior to 0.3
             ds_parameters = eval(ds_parameters)
-        return getattr(datastore, ddata["type"])(**keys2str(ds_parameters))
+        return _lookup_class("datastore", ddata["type"],
+                             lambda name: getattr(datastore, name))(**keys2str(ds_parameters))
     data_store = build_data_store(data["datastore"])
     if "input_datastore" in data:  # 0.4 onwards
         input_datastore = build_data_store(data["input_datastore"])
@@ -154,7 +283,8 @@ def build_record(data):
                     depdata["diff"]]
         if "source" in depdata:  # 0.5 onwards
             dep_args.append(depdata["source"])
-        dep = getattr(dependency_finder, depdata["module"]).Dependency(*dep_args)
+        dep = _lookup_class("dependency", depdata["module"],
+                            lambda name: getattr(dependency_finder, name).Dependency)(*dep_args)
         record.dependencies.append(dep)
     record.repeats = data.get("repeats", None)
     return record
@@ -162,9 +292,30 @@ def build_record(data):
 
 def decode_record(content):
     """Create a Sumatra record from a JSON string."""
-    return build_record(json.loads(content))
+    return build_record(CODECS["json"].loads(content))
 
 
-def decode_records(content):
-    """Create multiple Sumatra records from a JSON string."""
-    return [build_record(data) for data in json.loads(content)]
+def iter_decode_ndjson(fp):
+    """
+    Create Sumatra records, one at a time, from a file containing
+    newline-delimited JSON (one record per line). Blank lines are ignored.
+    """
+    codec = CODECS["json"]
+    for line in fp:
+        if line.strip():
+            yield build_record(codec.loads(line))
+
+
+def decode_records(content, format=None):
+    """
+    Create multiple Sumatra records from a JSON string or from msgpack-encoded
+    bytes. If `format` is not given, it is determined from the content.
+    """
+    codec = _detect_codec(content) if format is None else get_codec(format)
+    data = codec.loads(content)
+    if isinstance(data, dict):  # schema-versioned envelope
+        if data.get("schema_version", 0) > SCHEMA_VERSION:
+            raise ValueError("These records were exported by a newer version of Sumatra, "
+                             "with schema version %s" % data["schema_version"])
+        data = data["records"]
+    return [build_record(record_data) for record_data in data]
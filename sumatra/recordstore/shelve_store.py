@@ -10,9 +10,13 @@ import os
 import shutil
 import shelve
 from datetime import datetime, timezone
-from sumatra.recordstore.base import RecordStore
+from sumatra.recordstore.base import RecordStore, parameter_predicates, match_parameters
+from ..parameters import flatten
 from ..core import component
 
+PARAMETER_INDEX_PREFIX = "__parameter_index__:"
+LABEL_LIST_PREFIX = "__labels__:"
+
 
 def check_name(f):
     """
@@ -65,19 +69,30 @@ class ShelveRecordStore(RecordStore):
         self.__init__(**state)
 
     def list_projects(self):
-        return [str(key) for key in self.shelf.keys()]
+        return [str(key) for key in self.shelf.keys()
+                if not key.startswith((PARAMETER_INDEX_PREFIX, LABEL_LIST_PREFIX))]
 
     def has_project(self, project_name):
         return project_name in self.shelf
 
     @check_name
     def save(self, project_name, record):
+        self.save_many(project_name, [record])
+
+    @check_name
+    def save_many(self, project_name, records):
+        """Store the given records, reading and writing the shelf only once."""
         if project_name in self.shelf:
-            records = self.shelf[project_name]
+            stored_records = self.shelf[project_name]
         else:
-            records = {}
-        records[record.label] = record
-        self.shelf[project_name] = records
+            stored_records = {}
+        index = self._parameter_index(project_name, stored_records)
+        for record in records:
+            stored_records[record.label] = record
+            index[record.label] = flatten(record.parameters)
+        self.shelf[project_name] = stored_records
+        self.shelf[PARAMETER_INDEX_PREFIX + project_name] = index
+        self.shelf[LABEL_LIST_PREFIX + project_name] = list(stored_records)
 
     @check_name
     def get(self, project_name, label):
@@ -97,22 +112,117 @@ class ShelveRecordStore(RecordStore):
             records = []
         return sorted(records, key=lambda rec: rec.timestamp, reverse=True)
 
+    def _parameter_index(self, project_name, records=None):
+        """
+        Return a dict containing the flattened parameter values of each
+        record, indexed by label. The index is checked against the list of
+        labels, and rebuilt if it is missing or out of date, e.g. if the
+        records were saved by an older version of Sumatra. `records` is the
+        dict of records, if it has already been loaded.
+        """
+        key = PARAMETER_INDEX_PREFIX + project_name
+        index = self.shelf.get(key, {})
+        if set(index) != set(self._label_list(project_name)):
+            if records is None:
+                records = self.shelf.get(project_name, {})
+            index = dict((label, flatten(record.parameters)) for label, record in records.items())
+            self.shelf[key] = index
+        return index
+
+    @check_name
+    def list_by_parameters(self, project_name, parameters, tags=None):
+        """
+        Return a list of records for the given project whose parameter values
+        match `parameters`. The index of parameter values is searched first,
+        and the records are loaded only if any of them match.
+        """
+        predicates = parameter_predicates(parameters)
+        index = self._parameter_index(project_name)
+        labels = [label for label, flat_parameters in index.items()
+                  if match_parameters(flat_parameters, predicates)]
+        if not labels:
+            return []
+        records = self.shelf[project_name]
+        matches = [records[label] for label in labels]
+        if tags:
+            if not isinstance(tags, list):
+                tags = [tags]
+            matches = [record for record in matches if any(tag in record.tags for tag in tags)]
+        return sorted(matches, key=lambda rec: rec.timestamp, reverse=True)
+
     @check_name
     def labels(self, project_name, tags=None):
         return [rec.label for rec in self.list(project_name, tags=tags)]
 
+    def _label_list(self, project_name):
+        """
+        Return the list of record labels, which is stored separately from the
+        records so that it can be read without unpickling them. The list is
+        rebuilt if it is missing, e.g. if the records were saved by an older
+        version of Sumatra.
+        """
+        key = LABEL_LIST_PREFIX + project_name
+        if key not in self.shelf:
+            if project_name not in self.shelf:
+                return []
+            self.shelf[key] = list(self.shelf[project_name])
+        return self.shelf[key]
+
+    @check_name
+    def labels_starting_with(self, project_name, prefix):
+        return [label for label in self._label_list(project_name) if label.startswith(prefix)]
+
     @check_name
     def delete(self, project_name, label):
         records = self.shelf[project_name]
+        index = self._parameter_index(project_name, records)
         records.pop(label)
+        index.pop(label)
         self.shelf[project_name] = records
+        self.shelf[PARAMETER_INDEX_PREFIX + project_name] = index
+        self.shelf[LABEL_LIST_PREFIX + project_name] = list(records)
+
+    @check_name
+    def delete_records(self, project_name, labels):
+        """Delete the records with the given labels, writing the shelf only once."""
+        if project_name not in self.shelf:
+            return []
+        records = self.shelf[project_name]
+        index = self._parameter_index(project_name, records)
+        deleted = []
+        for label in labels:
+            if label in records:
+                del records[label]
+                index.pop(label, None)
+                deleted.append(label)
+        if deleted:
+            self.shelf[project_name] = records
+            self.shelf[PARAMETER_INDEX_PREFIX + project_name] = index
+            self.shelf[LABEL_LIST_PREFIX + project_name] = list(records)
+        return deleted
 
     @check_name
     def delete_by_tag(self, project_name, tag):
-        for_deletion = [record for record in self.shelf[project_name].values() if tag in record.tags]
-        for record in for_deletion:
-            self.delete(project_name, record.label)
-        return len(for_deletion)
+        for_deletion = [record.label for record in self.shelf[project_name].values() if tag in record.tags]
+        return len(self.delete_records(project_name, for_deletion))
+
+    @check_name
+    def update(self, project_name, field, value, tags=None):
+        """Modify the records for a given project, writing the shelf only once."""
+        if project_name not in self.shelf:
+            return
+        records = self.shelf[project_name]
+        if tags and not isinstance(tags, list):
+            tags = [tags]
+        parts = field.split(".")
+        for record in records.values():
+            if tags and not any(tag in record.tags for tag in tags):
+                continue
+            obj = record
+            for part in parts[:-1]:
+                obj = getattr(obj, part)
+            setattr(obj, parts[-1], value)
+        self.shelf[project_name] = records
 
     @check_name
     def most_recent(self, project_name):
@@ -0,0 +1,164 @@
+"""
+Downscaled versions of image files, for the image views of the web interface,
+stored in a bounded on-disk cache.
+
+Thumbnails are keyed by the digest of the image and the thumbnail size, so a
+cached thumbnail never goes out of date. When the total size of the cache
+exceeds its limit, the least recently used thumbnails are removed.
+
+Generating thumbnails requires the Pillow package.
+
+
+:copyright: Copyright 2006-2020, 2024 by the Sumatra team, see doc/authors.txt
+:license: BSD 2-clause, see LICENSE for details.
+"""
+
+import io
+import os
+import tempfile
+import threading
+from ..datastore.base import IGNORE_DIGEST
+
+THUMBNAIL_SIZES = (128, 256, 512)
+DEFAULT_THUMBNAIL_SIZE = 256
+DEFAULT_CACHE_SIZE = 200 * 1024 * 1024  # bytes
+
+
+def thumbnail_format(mimetype):
+    """Return the image format and mimetype used for thumbnails of images of the given mimetype."""
+    if mimetype == "image/jpeg":
+        return "JPEG", "image/jpeg"
+    return "PNG", "image/png"
+
+
+def make_thumbnail(data_item, size, mimetype=None):
+    """
+    Return the content of a thumbnail of the image `data_item`, downscaled
+    (preserving the aspect ratio) so that neither side is longer than `size`.
+    """
+    try:
+        from PIL import Image
+    except ImportError:
+        raise ImportError("The Pillow package is needed to create thumbnails.")
+    image = Image.open(io.BytesIO(b"".join(data_item.iter_chunks())))
+    image.draft("RGB", (size, size))  # fast downscaling while decoding, for JPEGs
+    image.thumbnail((size, size))
+    format = thumbnail_format(mimetype)[0]
+    if format == "JPEG" and image.mode not in ("RGB", "L"):
+        image = image.convert("RGB")
+    content = io.BytesIO()
+    image.save(content, format)
+    return content.getvalue()
+
+
+class ThumbnailCache(object):
+    """
+    On-disk cache of thumbnails, in `directory`, holding at most `max_size`
+    bytes.
+    """
+
+    def __init__(self, directory, max_size=DEFAULT_CACHE_SIZE):
+        self.directory = directory
+        self.max_size = max_size
+        self._total_size = None  # calculated when first needed
+        self._lock = threading.Lock()
+
+    def path(self, digest, size):
+        return os.path.join(self.directory, digest[:2], "%s-%d" % (digest[2:], size))
+
+    def get(self, digest, size):
+        """Return the cached thumbnail, or None if it is not in the cache."""
+        path = self.path(digest, size)
+        try:
+            with open(path, "rb") as fp:
+                content = fp.read()
+        except IOError:
+            return None
+        os.utime(path)  # mark as recently used
+        return content
+
+    def put(self, digest, size, content):
+        """Add a thumbnail to the cache, removing old thumbnails if necessary."""
+        path = self.path(digest, size)
+        thumbnail_dir = os.path.dirname(path)
+        if not os.path.exists(thumbnail_dir):
+            os.makedirs(thumbnail_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=thumbnail_dir, suffix=".partial")
+        with os.fdopen(fd, "wb") as fp:
+            fp.write(content)
+        with self._lock:
+            if self._total_size is None:
+                self._total_size = self._disk_usage()
+            if os.path.exists(path):
+                self._total_size -= os.path.getsize(path)
+            os.replace(tmp_path, path)
+            self._total_size += len(content)
+            if self._total_size > self.max_size:
+                self._evict()
+
+    def _entries(self):
+        for dir_path, dir_names, file_names in os.walk(self.directory):
+            for file_name in file_names:
+                if not file_name.endswith(".partial"):
+                    path = os.path.join(dir_path, file_name)
+                    try:
+                        stats = os.stat(path)
+                    except OSError:  # removed by another process
+                        continue
+                    yield path, stats.st_size, stats.st_atime, stats.st_mtime
+
+    def _disk_usage(self):
+        return sum(entry[1] for entry in self._entries())
+
+    def _evict(self):
+        """Remove the least recently used thumbnails, until the cache is within 90% of its maximum size."""
+        entries = sorted(self._entries(), key=lambda entry: max(entry[2], entry[3]))
+        self._total_size = sum(entry[1] for entry in entries)
+        target = 0.9 * self.max_size
+        for path, file_size, atime, mtime in entries:
+            if self._total_size <= target:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            self._total_size -= file_size
+
+    def thumbnail(self, data_key, data_item, size):
+        """
+        Return the thumbnail of the given data item, creating it and adding it
+        to the cache if necessary. Data items whose digest has not yet been
+        calculated are not cached.
+        """
+        mimetype = data_key.metadata.get("mimetype")
+        cacheable = data_key.digest != IGNORE_DIGEST
+        content = cacheable and self.get(data_key.digest, size) or None
+        if content is None:
+            content = make_thumbnail(data_item, size, mimetype)
+            if cacheable:
+                self.put(data_key.digest, size, content)
+        return content
+
+
+def generate_thumbnails(cache, datastore, data_keys, sizes=(DEFAULT_THUMBNAIL_SIZE,)):
+    """
+    Create thumbnails of the given image data keys, in each of the given sizes,
+    unless they are already in the cache. Return the number of thumbnails
+    created. Images that are not available in the datastore are skipped.
+    """
+    n = 0
+    for data_key in data_keys:
+        if data_key.digest == IGNORE_DIGEST:
+            continue
+        missing = [size for size in sizes if not os.path.exists(cache.path(data_key.digest, size))]
+        if not missing:
+            continue
+        try:
+            data_item = datastore.get_data_item(data_key)
+        except (IOError, KeyError):
+            continue
+        for size in missing:
+            cache.put(data_key.digest, size,
+                      make_thumbnail(data_item, size, data_key.metadata.get("mimetype")))
+            n += 1
+    return n
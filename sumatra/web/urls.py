@@ -27,7 +27,8 @@ from sumatra.web.views import (
     datatable_record,
     datatable_data,
     datatable_image,
-    show_content
+    show_content,
+    show_thumbnail
 )
 
 P = {
@@ -55,6 +56,7 @@ urlpatterns = [
     re_path(r"^%(project)s/datatable/data$" % P, datatable_data),
     re_path(r"^%(project)s/datatable/image$" % P, datatable_image),
     re_path(r"^data/(?P<datastore_id>\d+)$", show_content),
+    re_path(r"^data/(?P<datastore_id>\d+)/thumbnail$", show_thumbnail),
 ]
 
 urlpatterns += staticfiles_urlpatterns()
@@ -5,13 +5,14 @@ Defines views for the Sumatra web interface.
 :license: BSD 2-clause, see LICENSE for details.
 """
 
-import parameters
+import ast
 import mimetypes
 import json
 import os
+from collections import defaultdict
 
 from django.conf import settings as django_settings
-from django.http import HttpResponse, Http404
+from django.http import HttpResponse, StreamingHttpResponse, Http404
 from django.shortcuts import render
 from django.views.generic.list import ListView
 try:
@@ -19,12 +20,21 @@ try:
 except ImportError:  # older versions of Django
     MonthArchiveView = object
 from django.views.generic import View, DetailView, TemplateView
-from django.db.models import Q
+from django.db.models import F, Q
+from django.utils.cache import patch_cache_control
 from sumatra.recordstore.serialization import datestring_to_datetime
-from sumatra.recordstore.django_store.models import Project, Record, DataKey, Datastore, Tag
+from sumatra.formatting.columnar import parameter_rows
+from sumatra.recordstore.django_store.models import Project, Record, DataKey, Datastore, Tag, filter_by_tags
+from sumatra.recordstore.django_store.models import delete_records as delete_db_records
+from sumatra.recordstore.django_store.tagging_utils import parse_tag_input
+from sumatra.recordstore.django_store import search
 from sumatra.records import RecordDifference
+from sumatra.datastore.base import IGNORE_DIGEST
+from sumatra.web.thumbnails import (ThumbnailCache, thumbnail_format, THUMBNAIL_SIZES,
+                                    DEFAULT_THUMBNAIL_SIZE, DEFAULT_CACHE_SIZE)
 
 DEFAULT_MAX_DISPLAY_LENGTH = 10 * 1024
+THUMBNAIL_MAX_AGE = 365 * 24 * 3600  # seconds
 global_conf_file = os.path.expanduser(os.path.join("~", ".smtrc"))
 mimetypes.init()
 
@@ -108,6 +118,7 @@ class RecordDetailView(DetailView):
             if value is not None:
                 setattr(record, attr, value)
         record.save()
+        record.update_search_index()
         return HttpResponse('OK')
 
 
@@ -217,7 +228,7 @@ class ImageListView(ListView):
     def get_queryset(self):
         return DataKey.objects \
             .filter(output_from_record__project_id=self.kwargs["project"]) \
-            .filter(metadata__contains='image')
+            .filter(mimetype__startswith='image/')
 
     def get_context_data(self, **kwargs):
         context = super(ImageListView, self).get_context_data(**kwargs)
@@ -229,39 +240,77 @@ class ImageListView(ListView):
 def is_ajax(request):
     return request.headers.get('x-requested-with') == 'XMLHttpRequest'
 
+def _thumbgrid_cursor(creation, pk):
+    """Encode the position of an image in the thumbnail grid, for keyset pagination."""
+    return "%s|%d" % (creation.isoformat() if creation else "", pk)
+
+
+def _after_cursor(cursor):
+    """
+    Return a filter selecting the images that come after the given cursor
+    in the thumbnail grid, which is ordered by decreasing creation time (with
+    images without a creation time last), then by decreasing id.
+    """
+    creation, pk = cursor.rsplit("|", 1)
+    pk = int(pk)
+    if not creation:
+        return Q(creation__isnull=True, id__lt=pk)
+    creation = datestring_to_datetime(creation)
+    return (Q(creation__lt=creation) | Q(creation=creation, id__lt=pk)
+            | Q(creation__isnull=True))
+
+
 def image_thumbgrid(request, project):
+    """
+    Render the thumbnail grid of images or, for Ajax requests, return a page
+    of images as JSON, together with the cursor to pass as `after` to get the
+    next page (null for the last page). A `limit` of -1 returns all images.
+    """
     project_obj = Project.objects.get(id=project)
     if is_ajax(request):
-        offset = int(request.GET.get('offset',0))
-        limit = int(request.GET.get('limit',8))
+        limit = int(request.GET.get('limit', 8))
+        after = request.GET.get('after')
         selected_tag = request.GET.get('selected_tag', 'None')
+        images = DataKey.objects.filter(output_from_record__project_id=project,
+                                        mimetype__startswith='image/')
         if selected_tag != 'None':
-            record_all = Record.objects.filter(project_id=project, tags__contains=selected_tag)
-        else:
-            record_all = Record.objects.filter(project_id=project)
-
-        data = []
-        for record in record_all:
-            tags = [tag.name for tag in record.tag_objects()]
-            for data_key in record.output_data.filter(metadata__contains='image'):
-                data.append({
-                    'project_name':     project_obj.id,
-                    'label':            record.label,
-                    'main_file':        record.main_file,
-                    'repos_url':        record.repository.url,
-                    'version':          record.version,
-                    'reason':           record.reason,
-                    'outcome':          record.outcome,
-                    'tags':             tags,
-                    'datastore_id':     data_key.output_from_record.datastore.id,
-                    'path':             data_key.path,
-                    'creation':         data_key.creation.strftime('%Y-%m-%d %H:%M:%S%z'),
-                    'digest':           data_key.digest
-                })
+            images = images.filter(output_from_record__in=filter_by_tags(Record.objects.all(), selected_tag))
+        if after:
+            try:
+                images = images.filter(_after_cursor(after))
+            except ValueError:
+                raise Http404
+        images = images.order_by(F('creation').desc(nulls_last=True), '-id')
         if limit != -1:
-            return HttpResponse(json.dumps(data[offset:offset+limit]), content_type='application/json')
-        else:
-            return HttpResponse(json.dumps(data), content_type='application/json')
+            images = images[:limit + 1]  # one extra, to know whether there is a next page
+        rows = list(images.values(
+            'id', 'path', 'digest', 'creation', 'output_from_record__label',
+            'output_from_record__main_file', 'output_from_record__repository__url',
+            'output_from_record__version', 'output_from_record__reason',
+            'output_from_record__outcome', 'output_from_record__tags',
+            'output_from_record__datastore_id'))
+        next_cursor = None
+        if limit != -1 and len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = _thumbgrid_cursor(rows[-1]['creation'], rows[-1]['id'])
+        data = []
+        for row in rows:
+            data.append({
+                'project_name':     project_obj.id,
+                'label':            row['output_from_record__label'],
+                'main_file':        row['output_from_record__main_file'],
+                'repos_url':        row['output_from_record__repository__url'],
+                'version':          row['output_from_record__version'],
+                'reason':           row['output_from_record__reason'],
+                'outcome':          row['output_from_record__outcome'],
+                'tags':             parse_tag_input(row['output_from_record__tags']),
+                'datastore_id':     row['output_from_record__datastore_id'],
+                'path':             row['path'],
+                'creation':         _format_date(row['creation'], '%Y-%m-%d %H:%M:%S%z'),
+                'digest':           row['digest']
+            })
+        return HttpResponse(json.dumps({'images': data, 'next': next_cursor}),
+                            content_type='application/json')
     else:
         tags = Tag.objects.all()
         return render(request, 'image_thumbgrid.html', {'project':project_obj, 'tags':tags})
@@ -271,21 +320,19 @@ def parameter_list(request, project):
     project_obj = Project.objects.get(id=project)
     main_file = request.GET.get('main_file', None)
     if main_file:
-        record_list = Record.objects.filter(project_id=project, main_file=main_file)
-        keys = []
-        for record in record_list:
-            try:
-                parameter_set = record.parameters.to_sumatra()
-                if hasattr(parameter_set, "as_dict"):
-                    parameter_set = parameter_set.as_dict()
-                parameter_set = parameters.nesteddictflatten(parameter_set)
-                for key in parameter_set.keys():            # only works with simple parameter set
-                    if key not in keys:
-                        keys.append(key)
-                keys.sort()
-            except:
-                return Http404
-        return render(request, 'parameter_list.html',{'project':project_obj, 'object_list':record_list, 'keys': keys, 'main_file':main_file})
+        record_list = list(Record.objects.filter(project_id=project, main_file=main_file).select_related('parameters'))
+        # records often share a parameter set, so each distinct set is parsed only once
+        parameter_sets = {}
+        try:
+            for record in record_list:
+                if record.parameters_id not in parameter_sets:
+                    parameter_sets[record.parameters_id] = record.parameters.to_sumatra()
+        except Exception:
+            raise Http404
+        keys, parameter_values = parameter_rows(parameter_sets[record.parameters_id] for record in record_list)
+        rows = [(record, [flat_parameters.get(key) for key in keys])
+                for record, flat_parameters in zip(record_list, parameter_values)]
+        return render(request, 'parameter_list.html',{'project':project_obj, 'rows': rows, 'keys': keys, 'main_file':main_file})
     else:
         return render(request, 'parameter_list.html',{'project':project_obj})
 
@@ -299,28 +346,72 @@ def delete_records(request, project):
         # Convert strings returned from Javascript function into Python bools
         delete_data = {'false': False, 'true': True}[delete_data]
     records = Record.objects.filter(label__in=records_to_delete, project__id=project)
-    if records:
-        for record in records:
-            if delete_data:
-                datastore = record.datastore.to_sumatra()
-                datastore.delete(*[data_key.to_sumatra()
-                                   for data_key in record.output_data.all()])
-            record.delete()
+    if delete_data:
+        data_keys = defaultdict(list)
+        for data_key in DataKey.objects.filter(output_from_record__in=records).select_related('output_from_record'):
+            data_keys[data_key.output_from_record.datastore_id].append(data_key.to_sumatra())
+        for datastore_id, keys in data_keys.items():
+            Datastore.objects.get(pk=datastore_id).to_sumatra().delete(*keys)
+    delete_db_records(records)
     return HttpResponse('OK')
 
 
-def show_content(request, datastore_id):
+def _requested_data(request, datastore_id):
+    """Return the data key and data item identified by the query parameters of the request."""
     datastore = Datastore.objects.get(pk=datastore_id).to_sumatra()
     attrs = dict(path=request.GET['path'],
                  digest=request.GET['digest'],
                  creation=datestring_to_datetime(request.GET['creation']))
     data_key = DataKey.objects.get(**attrs).to_sumatra()
-    mimetype = data_key.metadata["mimetype"]
     try:
-        content = datastore.get_content(data_key)
+        data_item = datastore.get_data_item(data_key)
     except (IOError, KeyError):
         raise Http404
-    return HttpResponse(content, content_type=mimetype or "application/unknown")
+    return data_key, data_item
+
+
+def show_content(request, datastore_id):
+    data_key, data_item = _requested_data(request, datastore_id)
+    mimetype = data_key.metadata["mimetype"]
+    return StreamingHttpResponse(data_item.iter_chunks(), content_type=mimetype or "application/unknown")
+
+
+_thumbnail_cache = None
+
+
+def get_thumbnail_cache():
+    global _thumbnail_cache
+    if _thumbnail_cache is None:
+        _thumbnail_cache = ThumbnailCache(
+            getattr(django_settings, 'THUMBNAIL_CACHE', os.path.join(".smt", "thumbnails")),
+            getattr(django_settings, 'THUMBNAIL_CACHE_SIZE', DEFAULT_CACHE_SIZE))
+    return _thumbnail_cache
+
+
+def show_thumbnail(request, datastore_id):
+    """
+    Return a downscaled version of an image, no larger than the `size` given
+    in the query (which must be one of THUMBNAIL_SIZES). Since thumbnails are
+    identified by the digest of the image, they may be cached indefinitely by
+    the browser. If the thumbnail cannot be created (e.g. Pillow is not
+    installed), the full image is returned.
+    """
+    try:
+        size = int(request.GET.get('size', DEFAULT_THUMBNAIL_SIZE))
+    except ValueError:
+        raise Http404
+    if size not in THUMBNAIL_SIZES:
+        raise Http404
+    data_key, data_item = _requested_data(request, datastore_id)
+    mimetype = data_key.metadata.get("mimetype")
+    try:
+        content = get_thumbnail_cache().thumbnail(data_key, data_item, size)
+    except (ImportError, IOError):
+        return StreamingHttpResponse(data_item.iter_chunks(), content_type=mimetype or "application/unknown")
+    response = HttpResponse(content, content_type=thumbnail_format(mimetype)[1])
+    if data_key.digest != IGNORE_DIGEST:
+        patch_cache_control(response, public=True, max_age=THUMBNAIL_MAX_AGE, immutable=True)
+    return response
 
 
 def show_script(request, project, label):
@@ -432,6 +523,49 @@ class DiffView(TemplateView):
 #
 # Ajax request for datatable
 #
+# Each request is answered with a fixed number of queries: one each to count
+# the total and filtered rows, one for the values of the rows in the
+# requested page, and, where needed, one for each many-valued column.
+
+DATATABLE_DATE_FORMAT = '%Y-%m-%d %H:%M:%S%z'
+DATAKEY_DATE_FORMAT = '%Y-%m-%dT%H:%M:%S%z'
+
+
+def _format_date(value, format=DATATABLE_DATE_FORMAT):
+    if value is None:
+        return None
+    return value.strftime(format)
+
+
+def _number_of_processes(launch_mode_parameters, cache):
+    """Return the number of processes from the stored launch mode parameters."""
+    if launch_mode_parameters not in cache:
+        try:
+            n = ast.literal_eval(launch_mode_parameters).get('n', 1)
+        except (ValueError, SyntaxError, AttributeError):
+            n = 1
+        cache[launch_mode_parameters] = n
+    return cache[launch_mode_parameters]
+
+
+def _data_keys_by_record(record_ids):
+    """
+    Return dicts mapping each of the given record ids to the input data
+    and to the output data of that record.
+    """
+    fields = ('path', 'digest', 'creation')
+    input_data = dict((record_id, []) for record_id in record_ids)
+    output_data = dict((record_id, []) for record_id in record_ids)
+    input_keys = Record.input_data.through.objects.filter(record_id__in=record_ids).values_list(
+        'record_id', *['datakey__' + field for field in fields])
+    output_keys = DataKey.objects.filter(output_from_record_id__in=record_ids).values_list(
+        'output_from_record_id', *fields)
+    for keys, target in ((input_keys, input_data), (output_keys, output_data)):
+        for record_id, path, digest, creation in keys:
+            target[record_id].append({'path': path, 'digest': digest,
+                                      'creation': _format_date(creation, DATAKEY_DATE_FORMAT)})
+    return input_data, output_data
+
 
 def datatable_record(request, project):
     columns = ['label', 'timestamp', 'reason', 'outcome', 'input_data', 'output_data',
@@ -445,56 +579,49 @@ def datatable_record(request, project):
     draw = int(request.GET['draw'])
 
     records = Record.objects.filter(project__id=project)
-    recordsTotal = len(records)
+    recordsTotal = records.count()
 
     # Filter by tag
     if selected_tag != '':
-        records = records.filter(tags__contains=selected_tag)
+        records = filter_by_tags(records, selected_tag)
 
-    # Filter by search queries
+    # Filter by search queries, using the full-text index if there is one
     if search_value != '':
-        search_queries = search_value.split(' ')
-        for sq in search_queries:
-            records = records.filter(
-                Q(label__contains=sq) |
-                Q(timestamp__contains=sq) |
-                Q(reason__contains=sq) |
-                Q(outcome__contains=sq) |
-                Q(duration__contains=sq) |
-                Q(main_file__contains=sq) |
-                Q(version__contains=sq) |
-                Q(tags__contains=sq)
-                )
+        records = search.filter_records(records, search_value)
+    recordsFiltered = records.count()
     records = records.order_by(order_dir+columns[order])                        # Ordering
 
+    rows = list(records[start:start+length].values(
+        'db_id', 'label', 'timestamp', 'reason', 'outcome', 'duration', 'main_file', 'diff',
+        'version', 'script_arguments', 'tags', 'executable__name', 'executable__version',
+        'launch_mode__parameters'))
+    input_data, output_data = _data_keys_by_record([row['db_id'] for row in rows])
+    n_processes = {}
     data = []
-    for rec in records[start:start+length]:
-        try:
-            data.append({
-                'DT_RowId':     rec.label,
-                'project':      project,
-                'label':        rec.label,
-                'date':         rec.timestamp.strftime('%Y-%m-%d %H:%M:%S%z'),
-                'reason':       rec.reason,
-                'outcome':      rec.outcome,
-                'input_data':   map(lambda x: {'path': x.path, 'digest': x.digest, 'creation': x.creation.strftime('%Y-%m-%dT%H:%M:%S%z')}, rec.input_data.all()),
-                'output_data':  map(lambda x: {'path': x.path, 'digest': x.digest, 'creation': x.creation.strftime('%Y-%m-%dT%H:%M:%S%z')}, rec.output_data.all()),
-                'duration':     rec.duration,
-                'processes':    rec.launch_mode.get_parameters().get('n',1),
-                'executable':   '%s %s' %(rec.executable.name,rec.executable.version),
-                'main_file':    rec.main_file,
-                'diff' :        rec.diff,
-                'version':      rec.version,
-                'arguments':    rec.script_arguments,
-                'tags':         [tag.name for tag in rec.tag_objects()],
-            })
-        except:
-            pass
+    for row in rows:
+        data.append({
+            'DT_RowId':     row['label'],
+            'project':      project,
+            'label':        row['label'],
+            'date':         _format_date(row['timestamp']),
+            'reason':       row['reason'],
+            'outcome':      row['outcome'],
+            'input_data':   input_data[row['db_id']],
+            'output_data':  output_data[row['db_id']],
+            'duration':     row['duration'],
+            'processes':    _number_of_processes(row['launch_mode__parameters'], n_processes),
+            'executable':   '%s %s' % (row['executable__name'], row['executable__version']),
+            'main_file':    row['main_file'],
+            'diff' :        row['diff'],
+            'version':      row['version'],
+            'arguments':    row['script_arguments'],
+            'tags':         parse_tag_input(row['tags']),
+        })
 
     response_json = json.dumps({
         "draw": draw,
         "recordsTotal": recordsTotal,
-        "recordsFiltered": len(records),
+        "recordsFiltered": recordsFiltered,
         "data": data
         })
 
@@ -511,7 +638,7 @@ def datatable_data(request, project):
     draw = int(request.GET['draw'])
 
     datakeys = DataKey.objects.filter(output_from_record__project_id=project)
-    datakeysTotal = len(datakeys)
+    datakeysTotal = datakeys.count()
 
     # Filter by search queries
     if search_value != '':
@@ -523,31 +650,34 @@ def datatable_data(request, project):
                 Q(creation__contains=sq) |
                 Q(metadata__contains=sq)
                 )
+    datakeysFiltered = datakeys.count()
     datakeys = datakeys.order_by(order_dir+columns[order])                        # Ordering
 
+    rows = list(datakeys[start:start+length].values(
+        'id', 'path', 'digest', 'metadata', 'creation', 'output_from_record__label'))
+    input_to_records = dict((row['id'], []) for row in rows)
+    for datakey_id, label in Record.input_data.through.objects.filter(
+            datakey_id__in=list(input_to_records)).values_list('datakey_id', 'record__label'):
+        input_to_records[datakey_id].append(label)
     data = []
-    for dk in datakeys[start:start+length]:
-        try:
-            data.append({
-                'DT_RowId':             dk.path,
-                'project':              project,
-                'path':                 dk.path,
-                'directory':            os.path.dirname(dk.path),
-                'filename':             os.path.basename(dk.path),
-                'digest':               dk.digest,
-                'size':                 dk.get_metadata()['size'],
-                # 'size':                 filters.filesizeformat(dk.get_metadata()['size']),
-                'creation':             dk.creation.strftime('%Y-%m-%d %H:%M:%S%z'),
-                'output_from_record':   dk.output_from_record.label,
-                'input_to_records':     map(lambda x: x.label, dk.input_to_records.all())
-            })
-        except:
-            pass
+    for row in rows:
+        data.append({
+            'DT_RowId':             row['path'],
+            'project':              project,
+            'path':                 row['path'],
+            'directory':            os.path.dirname(row['path']),
+            'filename':             os.path.basename(row['path']),
+            'digest':               row['digest'],
+            'size':                 DataKey(metadata=row['metadata']).get_metadata().get('size'),
+            'creation':             _format_date(row['creation']),
+            'output_from_record':   row['output_from_record__label'],
+            'input_to_records':     input_to_records[row['id']],
+        })
 
     response_json = json.dumps({
         "draw": draw,
         "recordsTotal": datakeysTotal,
-        "recordsFiltered": len(datakeys),
+        "recordsFiltered": datakeysFiltered,
         "data": data
         })
 
@@ -566,12 +696,12 @@ def datatable_image(request, project):
     start = int(request.GET['start'])
     draw = int(request.GET['draw'])
 
-    images = DataKey.objects.filter(output_from_record__project_id=project, metadata__contains='image')
-    imagesTotal = len(images)
+    images = DataKey.objects.filter(output_from_record__project_id=project, mimetype__startswith='image/')
+    imagesTotal = images.count()
 
     # Filter by tag
     if selected_tag != '':
-        images = images.filter(output_from_record__tags__contains=selected_tag)
+        images = images.filter(output_from_record__in=filter_by_tags(Record.objects.all(), selected_tag))
 
     # Filter by search queries
     if search_value != '':
@@ -586,32 +716,34 @@ def datatable_image(request, project):
                 Q(output_from_record__outcome__contains=sq) |
                 Q(output_from_record__tags__contains=sq)
                 )
+    imagesFiltered = images.count()
     images = images.order_by(order_dir+columns[order])                        # Ordering
 
+    rows = images[start:start+length].values(
+        'path', 'digest', 'creation', 'output_from_record__datastore_id',
+        'output_from_record__label', 'output_from_record__reason', 'output_from_record__outcome',
+        'output_from_record__parameters__content', 'output_from_record__tags')
     data = []
-    for im in images[start:start+length]:
-        try:
-            data.append({
-                'DT_RowId':     im.path,
-                'project':      project,
-                'date':         im.creation.strftime('%Y-%m-%d %H:%M:%S%z'),
-                'creation':     im.creation.strftime('%Y-%m-%dT%H:%M:%S%z'),
-                'path':         im.path,
-                'digest':       im.digest,
-                'datastore':    im.output_from_record.datastore.id,
-                'record':       im.output_from_record.label,
-                'reason':       im.output_from_record.reason,
-                'outcome':      im.output_from_record.outcome,
-                'parameters':   im.output_from_record.parameters.content.split('\n'),
-                'tags':         [tag.name for tag in im.output_from_record.tag_objects()],
-            })
-        except:
-            pass
+    for row in rows:
+        data.append({
+            'DT_RowId':     row['path'],
+            'project':      project,
+            'date':         _format_date(row['creation']),
+            'creation':     _format_date(row['creation'], DATAKEY_DATE_FORMAT),
+            'path':         row['path'],
+            'digest':       row['digest'],
+            'datastore':    row['output_from_record__datastore_id'],
+            'record':       row['output_from_record__label'],
+            'reason':       row['output_from_record__reason'],
+            'outcome':      row['output_from_record__outcome'],
+            'parameters':   row['output_from_record__parameters__content'].split('\n'),
+            'tags':         parse_tag_input(row['output_from_record__tags']),
+        })
 
     response_json = json.dumps({
         "draw": draw,
         "recordsTotal": imagesTotal,
-        "recordsFiltered": len(images),
+        "recordsFiltered": imagesFiltered,
         "data": data
         })
 
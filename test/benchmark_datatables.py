@@ -0,0 +1,75 @@
+"""
+Benchmark of the server-side datatable endpoints of smtweb: fills an SQLite
+record store with a large number of records, then times the first and a
+deep page of each endpoint, with and without a search term.
+
+Usage: python benchmark_datatables.py [NUMBER_OF_RECORDS]
+"""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+from datetime import datetime, timedelta, timezone
+from sumatra.records import Record
+from sumatra.recordstore import django_store
+from sumatra.programs import PythonExecutable
+from sumatra.launch import SerialLaunchMode, PlatformInformation
+from sumatra.datastore import FileSystemDataStore, DataKey
+from sumatra.parameters import SimpleParameterSet
+from sumatra.versioncontrol.base import Repository
+
+n_records = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+page_length = 50
+
+tmpdir = tempfile.mkdtemp()
+store = django_store.DjangoRecordStore(db_file=os.path.join(tmpdir, "records.db"))
+
+serial = SerialLaunchMode()
+executable = PythonExecutable(sys.executable, version="3.11")
+repos = Repository("https://example.com/repos")
+datastore = FileSystemDataStore(os.path.join(tmpdir, "Data"))
+platforms = [PlatformInformation(architecture_bits="64bit", architecture_linkage="ELF",
+                                 machine="x86_64", network_name="localhost", ip_addr="127.0.0.1",
+                                 processor="x86_64", release="6.1", system_name="Linux",
+                                 version="#1 SMP")]
+start = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+records = []
+for i in range(n_records):
+    timestamp = start + timedelta(seconds=i)
+    record = Record(executable=executable, repository=repos,
+                    main_file="main.py", version="99863a9dc5f",
+                    launch_mode=serial, datastore=datastore,
+                    parameters=SimpleParameterSet({'a': i % 100, 'b': 3.0}),
+                    input_data=[], script_arguments="<parameters>",
+                    label="record%06d" % i, reason="benchmarking", diff='',
+                    user='michaelpalin', timestamp=timestamp)
+    record.duration = 1.0
+    record.outcome = "lghsvdghsg zskjdcghnskdjgc ckdjshcgndsg"
+    record.output_data = [DataKey("record%06d/figure.png" % i, "0123456789abcdef0123456789abcdef01234567",
+                                  timestamp, size=1024, mimetype="image/png", encoding=None)]
+    record.tags = set(["even"] if i % 2 == 0 else [])
+    record.platforms = platforms
+    records.append(record)
+t0 = time.perf_counter()
+store.save_many("Benchmark", records)
+print("stored %d records in %.1f s" % (n_records, time.perf_counter() - t0))
+
+from django.test import RequestFactory
+from sumatra.web.views import datatable_record, datatable_data, datatable_image
+
+factory = RequestFactory()
+for view in (datatable_record, datatable_data, datatable_image):
+    for start_row, search in ((0, ""), (n_records // 2, ""), (0, "record0001")):
+        query = {'tag': '', 'search[value]': search, 'order[0][column]': '1', 'order[0][dir]': 'desc',
+                 'length': str(page_length), 'start': str(start_row), 'draw': '1'}
+        t0 = time.perf_counter()
+        response = view(factory.get('/Benchmark/datatable/', query), "Benchmark")
+        elapsed = time.perf_counter() - t0
+        assert response.status_code == 200
+        print("%-18s start=%-7d search=%-12r %7.1f ms"
+              % (view.__name__, start_row, search, elapsed * 1000))
+
+shutil.rmtree(tmpdir)
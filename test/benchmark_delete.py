@@ -0,0 +1,73 @@
+"""
+Benchmark of bulk deletion in an SQLite DjangoRecordStore: fills the store
+with tagged records (one input and one output file each), then times the
+deletion of all the records with a given tag.
+
+Usage: python benchmark_delete.py [NUMBER_OF_RECORDS]
+"""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+from datetime import datetime, timedelta, timezone
+from sumatra.recordstore import django_store
+
+n_records = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+batch_size = 10000
+
+tmpdir = tempfile.mkdtemp()
+store = django_store.DjangoRecordStore(db_file=os.path.join(tmpdir, "records.db"))
+models = store._get_models()
+
+from django.db import transaction
+from django.contrib.contenttypes.models import ContentType
+
+project = models.Project.objects.create(id="Benchmark")
+common = dict(
+    executable=models.Executable.objects.create(path=sys.executable, name="Python", version="3.11", options=""),
+    repository=models.Repository.objects.create(type="GitRepository", url="https://example.com/repos", upstream=""),
+    launch_mode=models.LaunchMode.objects.create(type="SerialLaunchMode", parameters="{}"),
+    datastore=models.Datastore.objects.create(type="FileSystemDataStore", parameters="{}"),
+    parameters=models.ParameterSet.objects.create(type="SimpleParameterSet", content="a = 1"),
+    main_file="main.py", version="99863a9dc5f", reason="benchmarking", user="michaelpalin",
+    tags="doomed")
+common["input_datastore"] = common["datastore"]
+start = datetime(2024, 1, 1, tzinfo=timezone.utc)
+digest = "0123456789abcdef0123456789abcdef01234567"
+tag = models.Tag.objects.create(name="doomed")
+content_type = ContentType.objects.get_for_model(models.Record)
+
+t0 = time.perf_counter()
+for first in range(0, n_records, batch_size):
+    with transaction.atomic():
+        indices = range(first, min(first + batch_size, n_records))
+        db_records = models.Record.objects.bulk_create(
+            models.Record(label="record%07d" % i, timestamp=start + timedelta(seconds=i), project=project, **common)
+            for i in indices)
+        models.DataKey.objects.bulk_create(
+            models.DataKey(path="record%07d/output.dat" % i, digest=digest,
+                           creation=start + timedelta(seconds=i), metadata='{"size": 1024}',
+                           output_from_record=db_record)
+            for i, db_record in zip(indices, db_records))
+        input_keys = models.DataKey.objects.bulk_create(
+            models.DataKey(path="inputs/input%07d.dat" % i, digest=digest,
+                           creation=start + timedelta(seconds=i), metadata='{"size": 1024}')
+            for i in indices)
+        models.Record.input_data.through.objects.bulk_create(
+            models.Record.input_data.through(record_id=db_record.db_id, datakey_id=input_key.id)
+            for db_record, input_key in zip(db_records, input_keys))
+        models.TaggedItem.objects.bulk_create(
+            models.TaggedItem(tag=tag, content_type=content_type, object_id=db_record.db_id)
+            for db_record in db_records)
+print("stored %d records in %.1f s" % (n_records, time.perf_counter() - t0))
+
+t0 = time.perf_counter()
+n = store.delete_by_tag(project.id, "doomed")
+print("deleted %d records in %.2f s" % (n, time.perf_counter() - t0))
+assert models.Record.objects.count() == 0
+assert models.DataKey.objects.count() == 0
+assert models.Tag.objects.count() == 0
+
+shutil.rmtree(tmpdir)
@@ -0,0 +1,82 @@
+"""
+Benchmark of record and data-key lookups in an SQLite DjangoRecordStore,
+with and without the indexes added by migration 0007: fills the store with
+a large number of records (one output file each), then times lookups of
+records by (project, label), of data keys by (path, digest, creation), and
+of the most recent records of a project.
+
+Usage: python benchmark_lookups.py [NUMBER_OF_RECORDS]
+"""
+
+import os
+import sys
+import time
+import random
+import shutil
+import tempfile
+from datetime import datetime, timedelta, timezone
+from sumatra.recordstore import django_store
+
+n_records = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+n_lookups = 1000
+batch_size = 10000
+
+tmpdir = tempfile.mkdtemp()
+store = django_store.DjangoRecordStore(db_file=os.path.join(tmpdir, "records.db"))
+models = store._get_models()
+
+from django.core import management
+from django.db import transaction
+
+project = models.Project.objects.create(id="Benchmark")
+other_project = models.Project.objects.create(id="Other")
+common = dict(
+    executable=models.Executable.objects.create(path=sys.executable, name="Python", version="3.11", options=""),
+    repository=models.Repository.objects.create(type="GitRepository", url="https://example.com/repos", upstream=""),
+    launch_mode=models.LaunchMode.objects.create(type="SerialLaunchMode", parameters="{}"),
+    datastore=models.Datastore.objects.create(type="FileSystemDataStore", parameters="{}"),
+    parameters=models.ParameterSet.objects.create(type="SimpleParameterSet", content="a = 1"),
+    main_file="main.py", version="99863a9dc5f", reason="benchmarking", user="michaelpalin")
+common["input_datastore"] = common["datastore"]
+start = datetime(2024, 1, 1, tzinfo=timezone.utc)
+digest = "0123456789abcdef0123456789abcdef01234567"
+
+t0 = time.perf_counter()
+for first in range(0, n_records, batch_size):
+    with transaction.atomic():
+        db_records = models.Record.objects.bulk_create(
+            models.Record(label="record%07d" % i, timestamp=start + timedelta(seconds=i),
+                          project=project if i % 2 else other_project, **common)
+            for i in range(first, min(first + batch_size, n_records)))
+        models.DataKey.objects.bulk_create(
+            models.DataKey(path="record%07d/output.dat" % i, digest=digest,
+                           creation=start + timedelta(seconds=i), metadata='{"size": 1024}',
+                           output_from_record=db_record)
+            for i, db_record in zip(range(first, n_records), db_records))
+print("stored %d records in %.1f s" % (n_records, time.perf_counter() - t0))
+
+labels = ["record%07d" % random.randrange(1, n_records, 2) for i in range(n_lookups)]
+
+
+def benchmark(description):
+    t0 = time.perf_counter()
+    for label in labels:
+        models.Record.objects.get(project=project, label=label)
+    t1 = time.perf_counter()
+    for label in labels:
+        i = int(label[len("record"):])
+        models.DataKey.objects.get(path=label + "/output.dat", digest=digest,
+                                   creation=start + timedelta(seconds=i))
+    t2 = time.perf_counter()
+    for i in range(10):
+        list(models.Record.objects.filter(project=project).values_list("label", flat=True)[:50])
+    t3 = time.perf_counter()
+    print("%-16s record by label %8.3f ms  data key %8.3f ms  most recent 50 %8.3f ms"
+          % (description, (t1 - t0) * 1000 / n_lookups, (t2 - t1) * 1000 / n_lookups, (t3 - t2) * 1000 / 10))
+
+
+benchmark("with indexes")
+management.call_command("migrate", "django_store", "0006", verbosity=0)
+benchmark("without indexes")
+
+shutil.rmtree(tmpdir)
@@ -0,0 +1,62 @@
+"""
+Benchmark of record serialization: encodes and decodes a large number of
+records with each of the available formats.
+
+Usage: python benchmark_serialization.py [NUMBER_OF_RECORDS]
+"""
+
+import os
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+from sumatra.records import Record
+from sumatra.recordstore import serialization
+from sumatra.programs import PythonExecutable
+from sumatra.launch import SerialLaunchMode, PlatformInformation
+from sumatra.datastore import FileSystemDataStore, DataKey
+from sumatra.parameters import SimpleParameterSet
+from sumatra.versioncontrol.base import Repository
+
+n_records = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+
+serial = SerialLaunchMode()
+executable = PythonExecutable(sys.executable, version="3.11")
+repos = Repository("https://example.com/repos")
+datastore = FileSystemDataStore(os.path.join(os.getcwd(), "Data"))
+platforms = [PlatformInformation(architecture_bits="64bit", architecture_linkage="ELF",
+                                 machine="x86_64", network_name="localhost", ip_addr="127.0.0.1",
+                                 processor="x86_64", release="6.1", system_name="Linux",
+                                 version="#1 SMP")]
+start = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+records = []
+for i in range(n_records):
+    timestamp = start + timedelta(seconds=i)
+    record = Record(executable=executable, repository=repos,
+                    main_file="main.py", version="99863a9dc5f",
+                    launch_mode=serial, datastore=datastore,
+                    parameters=SimpleParameterSet({'a': i, 'b': 3.0}),
+                    input_data=[], script_arguments="<parameters>",
+                    label="record%06d" % i, reason="benchmarking", diff='',
+                    user='michaelpalin', timestamp=timestamp)
+    record.duration = 1.0
+    record.outcome = "lghsvdghsg zskjdcghnskdjgc ckdjshcgndsg"
+    record.output_data = [DataKey("output%06d.dat" % i, "0123456789abcdef0123456789abcdef01234567",
+                                  timestamp, size=1024, mimetype="text/plain", encoding=None)]
+    record.dependencies = []
+    record.platforms = platforms
+    records.append(record)
+
+for format in sorted(serialization.CODECS):
+    try:
+        t0 = time.perf_counter()
+        content = serialization.encode_records(records, format)
+        t1 = time.perf_counter()
+        decoded = serialization.decode_records(content)
+        t2 = time.perf_counter()
+    except ImportError as err:
+        print("%-8s skipped (%s)" % (format, err))
+        continue
+    assert len(decoded) == n_records
+    print("%-8s encode %6.2f s  decode %6.2f s  size %7.1f MB"
+          % (format, t1 - t0, t2 - t1, len(content) / 1e6))
@@ -0,0 +1,60 @@
+"""
+Benchmark of RecordStore.update(), as used by 'smt migrate', in an SQLite
+DjangoRecordStore: fills the store with records, then times changing the
+root of their datastore, with DjangoRecordStore.update() and with the
+generic implementation, which re-saves each record (on a subset).
+
+Usage: python benchmark_update.py [NUMBER_OF_RECORDS]
+"""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+from datetime import datetime, timedelta, timezone
+from sumatra.recordstore import django_store
+from sumatra.recordstore.base import RecordStore
+
+n_records = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+n_generic = 1000
+batch_size = 10000
+
+tmpdir = tempfile.mkdtemp()
+store = django_store.DjangoRecordStore(db_file=os.path.join(tmpdir, "records.db"))
+models = store._get_models()
+
+from django.db import transaction
+
+projects = [models.Project.objects.create(id="Benchmark"), models.Project.objects.create(id="Generic")]
+datastore = models.Datastore.objects.create(type="FileSystemDataStore",
+                                            parameters=str({"root": os.path.join(tmpdir, "Data")}))
+common = dict(
+    executable=models.Executable.objects.create(path=sys.executable, name="Python", version="3.11", options=""),
+    repository=models.Repository.objects.create(type="GitRepository", url="https://example.com/repos", upstream=""),
+    launch_mode=models.LaunchMode.objects.create(type="SerialLaunchMode", parameters="{}"),
+    datastore=datastore, input_datastore=datastore,
+    parameters=models.ParameterSet.objects.create(type="SimpleParameterSet", content="a = 1"),
+    main_file="main.py", version="99863a9dc5f", reason="benchmarking", user="michaelpalin")
+start = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+t0 = time.perf_counter()
+for project, n in zip(projects, (n_records, n_generic)):
+    for first in range(0, n, batch_size):
+        with transaction.atomic():
+            models.Record.objects.bulk_create(
+                models.Record(label="record%07d" % i, timestamp=start + timedelta(seconds=i),
+                              project=project, **common)
+                for i in range(first, min(first + batch_size, n)))
+print("stored %d records in %.1f s" % (n_records + n_generic, time.perf_counter() - t0))
+
+t0 = time.perf_counter()
+store.update("Benchmark", "datastore.root", os.path.join(tmpdir, "Moved"))
+print("DjangoRecordStore.update() of %d records: %.3f s" % (n_records, time.perf_counter() - t0))
+assert models.Record.objects.filter(project__id="Benchmark").exclude(datastore=datastore).count() == n_records
+
+t0 = time.perf_counter()
+RecordStore.update(store, "Generic", "datastore.root", os.path.join(tmpdir, "Moved"))
+print("RecordStore.update() of %d records: %.3f s" % (n_generic, time.perf_counter() - t0))
+
+shutil.rmtree(tmpdir)
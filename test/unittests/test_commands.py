@@ -4,6 +4,8 @@ Unit tests for the sumatra.commands module
 
 import unittest
 import os
+import sys
+import subprocess
 import hashlib
 import shutil
 import tempfile
@@ -110,6 +112,7 @@ class MockProject(object):
     data_label = "pluck from the ether"
     allow_command_line_parameters = True
     ignore_parameters = False
+    lazy_digests = False
     record_store = MockRecordStore("default")
     saved = False
     info_called = False
@@ -133,14 +136,24 @@ class MockProject(object):
                                 script_args=script_args)
     def format_records(self, format='text', mode='short', tags=None, reverse=False):
         self.format_args = {"tags": tags, "mode": mode, "format": format, "reverse": reverse}
+    def write_records(self, stream, format='text', mode='short', tags=None, reverse=False):
+        self.format_records(format, mode, tags, reverse)
+    def rebuild_label_cache(self):
+        self.label_cache_rebuilt = True
     def delete_record(self, label, delete_data=False):
         if "nota" in label:
             raise KeyError  # or just emit a warning?
         else:
             self._records_deleted.append(label)
-    def delete_by_tag(self, tag, delete_data=False):
+    def delete_records(self, labels, delete_data=False, verify_digests=True):
+        deleted = [label for label in labels if "nota" not in label]
+        self._records_deleted.extend(deleted)
+        return deleted
+    def delete_by_tag(self, tag, delete_data=False, verify_digests=True):
         self._records_deleted.append("records_tagged_with_%s" % tag)
-    def export(self): self.exported = True
+    def export(self, format="ndjson"): self.exported = format
+    def export_columnar(self, path, format="parquet", tags=None):
+        self.exported = (path, format, tags)
     def most_recent(self):
         return MockRecord("most_recent")
     def add_comment(self, label, comment, replace=False):
@@ -163,6 +176,9 @@ class MockProject(object):
         return (new_label or "repeated", original_label)
     def change_record_store(self, new_store):
         self.record_store = new_store
+    def calculate_digests(self, labels=None):
+        self.digests_calculated = labels
+        return 0
 
 
 def no_project():
@@ -286,6 +302,13 @@ class InitCommandTests(unittest.TestCase):
         if os.path.exists(some_path):
             os.rmdir(some_path)
 
+    def test_archive_format_option(self):
+        commands.load_project = no_project
+        commands.Project = MockProject
+        commands.init(["NewProject", "--archive", "true", "--archive-format", "zip"])
+        prj = MockProject.instances[-1]
+        self.assertEqual(prj.data_store.archive_format, "zip")
+
     def test_store_option_should_get_record_store(self):
         commands.load_project = no_project
         commands.Project = MockProject
@@ -384,6 +407,24 @@ class ConfigureCommandTests(unittest.TestCase):
             os.rmdir(some_path)
         self.prj.data_store = MockDataStore("/path/to/root")
 
+    def test_archive_format_option(self):
+        commands.configure(["--archive", "true", "--archive-format", "tar"])
+        self.assertEqual(self.prj.data_store.archive_format, "tar")
+        commands.configure(["--archive-format", "zip"])
+        self.assertEqual(self.prj.data_store.archive_format, "zip")
+        self.prj.data_store = MockDataStore("/path/to/root")
+
+    def test_archive_format_option_without_archiving(self):
+        self.assertRaises(SystemExit, commands.configure, ["--archive-format", "zip"])
+
+    def test_dedup_option(self):
+        commands.configure(["--dedup", "true"])
+        self.assertIsInstance(self.prj.data_store, datastore.ContentAddressedDataStore)
+        self.assertEqual(self.prj.data_store.blob_store, os.path.abspath(".smt/blobs"))
+        commands.configure(["--dedup", "some/blobs"])
+        self.assertEqual(self.prj.data_store.blob_store, os.path.abspath("some/blobs"))
+        self.prj.data_store = MockDataStore("/path/to/root")
+
     def test_archive_option_set_to_false(self):
         commands.configure(["--archive", "true"])
         self.assertIsInstance(self.prj.data_store, datastore.ArchivingFileSystemDataStore)
@@ -396,6 +437,14 @@ class ConfigureCommandTests(unittest.TestCase):
         commands.configure(["--store", new_store_path])
         self.assertEqual(self.prj.record_store.path, new_store_path)
 
+    def test_lazy_digests_option(self):
+        commands.configure(["--lazy-digests"])
+        self.assertTrue(self.prj.lazy_digests)
+        commands.configure(["--plain"])
+        self.assertTrue(self.prj.lazy_digests)
+        commands.configure(["--eager-digests"])
+        self.assertFalse(self.prj.lazy_digests)
+
 
 class InfoCommandTests(unittest.TestCase):
 
@@ -606,6 +655,16 @@ class ListCommandTests(unittest.TestCase):
         # need some assertion about self.prj.format_args
 
 
+class ParseParameterFiltersTests(unittest.TestCase):
+
+    def test_equality_and_range_conditions(self):
+        self.assertEqual(commands._parse_parameter_filters("a=1,b.c >= 0.5,d:foo,e<2"),
+                         [("a", "=", 1), ("b.c", ">=", 0.5), ("d", "=", "foo"), ("e", "<", 2)])
+
+    def test_invalid_condition_should_raise(self):
+        self.assertRaises(ValueError, commands._parse_parameter_filters, "a")
+
+
 class DeleteCommandTests(unittest.TestCase):
 
     def setUp(self):
@@ -759,7 +818,17 @@ class ExportCommandTests(unittest.TestCase):
 
     def test_project_exported(self):
         commands.export([])
-        assert self.prj.exported
+        self.assertEqual(self.prj.exported, "ndjson")
+
+    def test_format_option(self):
+        commands.export(["--format", "msgpack"])
+        self.assertEqual(self.prj.exported, "msgpack")
+
+    def test_columnar_format(self):
+        commands.export(["--format", "parquet"])
+        self.assertEqual(self.prj.exported, ("records_export.parquet", "parquet", None))
+        commands.export(["--format", "hdf5", "--output", "runs.h5", "--tags", "foo"])
+        self.assertEqual(self.prj.exported, ("runs.h5", "hdf5", ["foo"]))
 
     def test_with_args(self):
         self.assertRaises(SystemExit, commands.export, ['foo'])
@@ -776,6 +845,7 @@ class SyncCommandTests(unittest.TestCase):
 
     def test_with_single_path(self):
         commands.sync(["/path/to/store"])
+        self.assertTrue(self.prj.label_cache_rebuilt)
 
     def test_with_two_paths(self):
         commands.sync(["/path/to/store1", "/path/to/store2"])
@@ -792,6 +862,21 @@ class MigrateCommandTests(unittest.TestCase):
         self.assertEqual(self.prj.record_store.updated, ("datastore.root", "/new/data/path"))
 
 
+class DigestCommandTests(unittest.TestCase):
+
+    def setUp(self):
+        self.prj = MockProject()
+        commands.load_project = lambda: self.prj
+
+    def test_all_records(self):
+        commands.digest([])
+        self.assertEqual(self.prj.digests_calculated, None)
+
+    def test_with_labels(self):
+        commands.digest(["foo", "bar"])
+        self.assertEqual(self.prj.digests_calculated, ["foo", "bar"])
+
+
 class ArgumentParsingTests(unittest.TestCase):
 
     def setUp(self):
@@ -888,6 +973,16 @@ class ArgumentParsingTests(unittest.TestCase):
             self.assertEqual(result, {'save': 'Data/result.uwsize=48.setsize=1'})
 
 
+class ImportTests(unittest.TestCase):
+
+    def test_importing_commands_should_not_import_django(self):
+        # run in a new interpreter, as other tests may already have imported Django
+        code = "import sys, sumatra.commands; print('django' in sys.modules)"
+        output = subprocess.check_output([sys.executable, "-c", code],
+                                         cwd=os.path.dirname(os.path.dirname(commands.__file__)))
+        self.assertEqual(output.strip(), b"False")
+
+
 if __name__ == '__main__':
     setup()
     unittest.main()
@@ -7,8 +7,19 @@ import shutil
 import os
 from datetime import datetime, timezone, timedelta
 import hashlib
+import io
+import json
+import threading
+import warnings
+from unittest import mock
+from http.server import BaseHTTPRequestHandler, HTTPServer
 from sumatra.datastore import FileSystemDataStore, ArchivingFileSystemDataStore, get_data_store, DataKey
-from sumatra.datastore.base import DataStore
+from sumatra.datastore.archivingfs import ARCHIVE_FORMATS, zstandard
+from sumatra.datastore import ContentAddressedDataStore, MirroredFileSystemDataStore
+from sumatra.datastore.cache import DataCache
+from sumatra.datastore.davfs import DavFsDataStore
+from sumatra.datastore.segmented import SegmentedUploader, SegmentedFile, read_manifest
+from sumatra.datastore.base import DataStore, IGNORE_DIGEST
 from sumatra.datastore.filesystem import DataFile
 from sumatra.core import TIMESTAMP_FORMAT
 
@@ -77,6 +88,42 @@ class TestFileSystemDataStore(unittest.TestCase):
         self.ds.delete(*keys)
         self.assertTrue(not os.path.exists(os.path.join(self.root_dir, 'test_file1')))
 
+    def test__delete__without_digest_check(self):
+        keys = [DataKey(path, "0" * 40, creation=None) for path in self.test_files]
+        self.ds.delete(*keys, verify_digests=False)
+        self.assertFalse(os.path.exists(os.path.join(self.root_dir, 'test_file1')))
+
+    def test__find_new_data_deferred__should_return_digest_pending_keys(self):
+        keys = self.ds.find_new_data_deferred(self.now)
+        self.assertEqual(set(key.path for key in keys), self.test_files)
+        for key in keys:
+            self.assertTrue(key.digest_pending)
+            self.assertEqual(key.digest, IGNORE_DIGEST)
+            self.assertEqual(key.metadata["size"], len(self.test_data))
+        # a pending key still retrieves the data
+        self.assertEqual(self.ds.get_content(keys[0]), self.test_data)
+
+    def test__calculate_digests__should_complete_pending_keys(self):
+        keys = self.ds.find_new_data_deferred(self.now)
+        completed = self.ds.calculate_digests(*keys)
+        self.assertEqual(len(completed), len(self.test_files))
+        digest = hashlib.sha1(self.test_data).hexdigest()
+        for key in keys:
+            self.assertFalse(key.digest_pending)
+            self.assertEqual(key.digest, digest)
+            self.assertNotIn("mtime", key.metadata)
+        self.assertEqual(self.ds.calculate_digests(*keys), [])
+
+    def test__calculate_digests__should_skip_changed_files(self):
+        keys = dict((key.path, key) for key in self.ds.find_new_data_deferred(self.now))
+        with open(os.path.join(self.root_dir, 'test_file1'), 'ab') as f:
+            f.write(b'more data')
+        with warnings.catch_warnings(record=True):
+            warnings.simplefilter("always")
+            completed = self.ds.calculate_digests(*keys.values())
+        self.assertEqual(len(completed), len(self.test_files) - 1)
+        self.assertTrue(keys['test_file1'].digest_pending)
+
 
 class TestArchivingFileSystemDataStore(unittest.TestCase):
 
@@ -114,6 +161,16 @@ class TestArchivingFileSystemDataStore(unittest.TestCase):
         self.assertEqual(self.ds.__getstate__(),
                          {'root': self.root_dir, 'archive': self.archive_dir})
 
+    def test__get_state__should_include_non_default_archive_format(self):
+        ds = ArchivingFileSystemDataStore(self.root_dir, self.archive_dir, archive_format="zip")
+        self.assertEqual(ds.__getstate__(),
+                         {'root': self.root_dir, 'archive': self.archive_dir,
+                          'archive_format': 'zip'})
+
+    def test__init__with_unknown_archive_format__should_raise_ValueError(self):
+        self.assertRaises(ValueError, ArchivingFileSystemDataStore,
+                          self.root_dir, self.archive_dir, archive_format="rar")
+
     def test__find_new_data__should_return_list_of_keys_matching_new_files(self):
         self.assertEqual(set("/".join(key.path.split("/")[1:]) for key in self.ds.find_new_data(self.now)),
                          self.test_files)
@@ -128,6 +185,28 @@ class TestArchivingFileSystemDataStore(unittest.TestCase):
         self.assertTrue(os.path.exists(os.path.join(self.archive_dir, 'test.tar.gz')))
         self.assertTrue(not os.path.exists(os.path.join(self.root_dir, 'test.tar.gz')))
 
+    def test__archive__should_not_leave_temporary_files(self):
+        self.ds._archive('test', self.test_files)
+        self.assertEqual(sorted(os.listdir(self.archive_dir)),
+                         ['test.index.json', 'test.tar.gz'])
+
+    def test__get_content__with_each_archive_format(self):
+        label = self.now.strftime(TIMESTAMP_FORMAT)
+        digest = hashlib.sha1(self.test_data).hexdigest()
+        for archive_format in ARCHIVE_FORMATS:
+            if archive_format == "tar.zst" and zstandard is None:
+                continue
+            ds = ArchivingFileSystemDataStore(self.root_dir, self.archive_dir, archive_format)
+            archive_paths = ds._archive(label, self.test_files, delete_originals=False)
+            self.assertTrue(os.path.exists(os.path.join(self.archive_dir,
+                                                        "%s.%s" % (label, archive_format))))
+            ds = ArchivingFileSystemDataStore(self.root_dir, self.archive_dir)  # format should be taken from the index
+            for path in archive_paths:
+                key = DataKey(path, digest, creation=None)
+                self.assertEqual(ds.get_content(key), self.test_data)
+                self.assertEqual(ds.get_content(key, max_length=10), self.test_data[:10])
+            shutil.rmtree(self.archive_dir)
+
     def test__archive__should_delete_original_files_if_requested(self):
         assert os.path.exists(os.path.join(self.root_dir, 'test_file1'))
         self.ds._archive('test', self.test_files, delete_originals=True)
@@ -150,6 +229,567 @@ class TestArchivingFileSystemDataStore(unittest.TestCase):
         content = self.ds.get_content(key, max_length=10)
         self.assertEqual(content, self.test_data[:10])
 
+    def test__archive__should_write_an_index(self):
+        self.ds._archive('test', self.test_files)
+        index_path = os.path.join(self.archive_dir, 'test.index.json')
+        self.assertTrue(os.path.exists(index_path))
+        with open(index_path) as fp:
+            index = json.load(fp)
+        self.assertEqual(set(index["members"]),
+                         set("test/%s" % path for path in self.test_files))
+        for entry in index["members"].values():
+            self.assertEqual(entry["size"], len(self.test_data))
+            self.assertEqual(entry["digest"], hashlib.sha1(self.test_data).hexdigest())
+
+    def test__get_content__should_use_index_offsets(self):
+        with open(os.path.join(self.root_dir, 'test_file4'), 'wb') as f:
+            f.write(b"x" * 1000)
+        keys = dict((key.path, key) for key in self.ds.find_new_data(self.now))
+        label = self.now.strftime(TIMESTAMP_FORMAT)
+        self.assertEqual(self.ds.get_content(keys["%s/test_file4" % label]), b"x" * 1000)
+        self.assertEqual(self.ds.get_content(keys["%s/test_file1" % label]), self.test_data)
+
+    def test__get_data_item__should_detect_corrupted_archive_member(self):
+        self.ds.archive_format = "tar"  # uncompressed, so the member can be modified in place
+        keys = dict((key.path, key) for key in self.ds.find_new_data(self.now))
+        label = self.now.strftime(TIMESTAMP_FORMAT)
+        key = keys["%s/test_file1" % label]
+        self.assertEqual(key.digest, hashlib.sha1(self.test_data).hexdigest())
+        entry = self.ds._get_archive_index(label)["members"][key.path]
+        with open(os.path.join(self.archive_dir, "%s.tar" % label), 'r+b') as fp:
+            fp.seek(entry["offset"])
+            fp.write(b"X")
+        self.assertRaises(KeyError, self.ds.get_data_item, key)
+        self.assertEqual(self.ds.get_data_item(keys["%s/test_file2" % label]).get_content(), self.test_data)
+
+    def test__get_content__should_work_without_an_index(self):
+        self.ds.find_new_data(self.now)
+        label = self.now.strftime(TIMESTAMP_FORMAT)
+        os.remove(os.path.join(self.archive_dir, "%s.index.json" % label))
+        ds = ArchivingFileSystemDataStore(self.root_dir, self.archive_dir)
+        digest = hashlib.sha1(self.test_data).hexdigest()
+        key = DataKey('%s/test_file1' % label, digest, creation=self.now)
+        self.assertEqual(ds.get_content(key), self.test_data)
+
+    def test__get_content__without_an_index_with_each_archive_format(self):
+        label = self.now.strftime(TIMESTAMP_FORMAT)
+        digest = hashlib.sha1(self.test_data).hexdigest()
+        for archive_format in ARCHIVE_FORMATS:
+            if archive_format == "tar.zst" and zstandard is None:
+                continue
+            ds = ArchivingFileSystemDataStore(self.root_dir, self.archive_dir, archive_format)
+            archive_paths = ds._archive(label, self.test_files, delete_originals=False)
+            os.remove(os.path.join(self.archive_dir, "%s.index.json" % label))
+            ds = ArchivingFileSystemDataStore(self.root_dir, self.archive_dir)  # format should be taken from the extension
+            for path in archive_paths:
+                key = DataKey(path, digest, creation=None)
+                self.assertEqual(ds.get_content(key), self.test_data)
+                self.assertEqual(ds.get_data_item(key).size, len(self.test_data))
+            shutil.rmtree(self.archive_dir)
+
+    def test__save_copy__should_extract_archived_file(self):
+        self.ds.find_new_data(self.now)
+        digest = hashlib.sha1(self.test_data).hexdigest()
+        key = DataKey('%s/test_file1' % self.now.strftime(TIMESTAMP_FORMAT),
+                      digest, creation=self.now)
+        copy_path = os.path.join(self.root_dir, "copy_of_test_file1")
+        self.assertEqual(self.ds.get_data_item(key).save_copy(copy_path), copy_path)
+        with open(copy_path, 'rb') as f:
+            self.assertEqual(f.read(), self.test_data)
+
+    def test__iter_chunks__should_stream_archived_file(self):
+        self.ds.find_new_data(self.now)
+        digest = hashlib.sha1(self.test_data).hexdigest()
+        key = DataKey('%s/test_file1' % self.now.strftime(TIMESTAMP_FORMAT),
+                      digest, creation=self.now)
+        chunks = list(self.ds.get_data_item(key).iter_chunks(chunk_size=10))
+        self.assertEqual(len(chunks), 4)
+        self.assertEqual(b"".join(chunks), self.test_data)
+
+
+class TestContentAddressedDataStore(unittest.TestCase):
+
+    def setUp(self):
+        self.root_dir = os.path.abspath('yusehgcfscuzhfqizuchgsireugvcsi')
+        self.blob_dir = os.path.abspath("test_blobs")
+        for path in (self.root_dir, self.blob_dir):
+            if os.path.exists(path):
+                shutil.rmtree(path)
+        self.ds = ContentAddressedDataStore(self.root_dir, self.blob_dir)
+        self.now = datetime.now(timezone.utc)
+        self.label = self.now.strftime(TIMESTAMP_FORMAT)
+        os.mkdir(os.path.join(self.root_dir, 'test_dir'))
+        self.test_files = set(['test_file1', 'test_file2', 'test_dir/test_file3'])
+        self.test_data = b'licgsnireugcsenrigucsic\ncrgqgjch,kgch'
+        self.digest = hashlib.sha1(self.test_data).hexdigest()
+        for filename in self.test_files:
+            with open(os.path.join(self.root_dir, filename), 'wb') as f:
+                f.write(self.test_data)
+
+    def tearDown(self):
+        for path in (self.root_dir, self.blob_dir):
+            if os.path.exists(path):
+                shutil.rmtree(path)
+
+    def test__get_state__should_return_dict_containing_root_and_blob_store(self):
+        self.assertEqual(self.ds.__getstate__(),
+                         {'root': self.root_dir, 'blobs': self.blob_dir})
+
+    def test__find_new_data__should_return_keys_with_correct_digests(self):
+        keys = self.ds.find_new_data(self.now)
+        self.assertEqual(set(key.path for key in keys),
+                         set("%s/%s" % (self.label, path) for path in self.test_files))
+        for key in keys:
+            self.assertEqual(key.digest, self.digest)
+            self.assertEqual(key.metadata["size"], len(self.test_data))
+
+    def test__find_new_data__should_store_identical_files_once(self):
+        self.ds.find_new_data(self.now)
+        objects = []
+        for root, dirs, files in os.walk(os.path.join(self.blob_dir, "objects")):
+            objects.extend(files)
+        self.assertEqual(objects, [self.digest[2:]])
+        self.assertFalse(os.path.exists(os.path.join(self.root_dir, 'test_file1')))
+
+    def test__get_content__should_return_file_content(self):
+        self.ds.find_new_data(self.now)
+        key = DataKey('%s/test_file1' % self.label, self.digest, creation=None)
+        self.assertEqual(self.ds.get_content(key), self.test_data)
+        self.assertEqual(self.ds.get_content(key, max_length=10), self.test_data[:10])
+        ds = ContentAddressedDataStore(self.root_dir, self.blob_dir)
+        self.assertEqual(ds.get_content(key), self.test_data)
+
+    def test__get_data_item__should_detect_corrupted_content(self):
+        keys = self.ds.find_new_data(self.now)
+        blob_path = self.ds._blob_path(self.digest)
+        os.chmod(blob_path, 0o644)
+        with open(blob_path, 'r+b') as fp:
+            fp.truncate(10)
+        for key in keys:
+            self.assertRaises(KeyError, self.ds.get_data_item, key)
+
+    def test__contains_path(self):
+        self.ds.find_new_data(self.now)
+        self.assertTrue(self.ds.contains_path('%s/test_file1' % self.label))
+        self.assertFalse(self.ds.contains_path('%s/test_file4' % self.label))
+
+    def test__delete__should_keep_shared_content_until_last_reference_removed(self):
+        keys = self.ds.find_new_data(self.now)
+        blob_path = self.ds._blob_path(self.digest)
+        self.ds.delete(*keys[:2])
+        self.assertTrue(os.path.exists(blob_path))
+        self.assertRaises(KeyError, self.ds.get_data_item, keys[0])
+        self.ds.delete(keys[2])
+        self.assertFalse(os.path.exists(blob_path))
+
+    def test__delete__should_not_read_other_manifests(self):
+        keys = self.ds.find_new_data(self.now)
+        with open(os.path.join(self.root_dir, 'test_file4'), 'wb') as f:
+            f.write(self.test_data)
+        self.assertEqual(len(self.ds.find_new_data(self.now - timedelta(seconds=1))), 1)
+        ds = ContentAddressedDataStore(self.root_dir, self.blob_dir)
+        with mock.patch.object(ds, "_get_manifest", wraps=ds._get_manifest) as get_manifest:
+            ds.delete(*keys)
+        self.assertEqual(set(call.args[0] for call in get_manifest.call_args_list), set([self.label]))
+        self.assertTrue(os.path.exists(ds._blob_path(self.digest)))
+
+    def test__delete__should_create_references_for_older_stores(self):
+        keys = self.ds.find_new_data(self.now)
+        shutil.rmtree(os.path.join(self.blob_dir, "refs"))
+        ds = ContentAddressedDataStore(self.root_dir, self.blob_dir)
+        ds.delete(*keys[:2])
+        self.assertTrue(os.path.exists(ds._blob_path(self.digest)))
+        ds.delete(keys[2])
+        self.assertFalse(os.path.exists(ds._blob_path(self.digest)))
+
+
+class TestDataCache(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_dir = os.path.abspath("test_cache")
+        self.cache = DataCache(self.cache_dir, max_size=100)
+        self.opened = 0
+
+    def tearDown(self):
+        if os.path.exists(self.cache_dir):
+            shutil.rmtree(self.cache_dir)
+
+    def opener(self, data):
+        def open_data():
+            self.opened += 1
+            return io.BytesIO(data)
+        return open_data
+
+    def test_fetch_should_download_only_once(self):
+        data = b"abcdefghij"
+        digest = hashlib.sha1(data).hexdigest()
+        path1 = self.cache.fetch("http://example.com/a", digest, self.opener(data))
+        path2 = self.cache.fetch("http://example.com/a", digest, self.opener(data))
+        self.assertEqual(path1, path2)
+        self.assertEqual(self.opened, 1)
+        with open(path1, 'rb') as f:
+            self.assertEqual(f.read(), data)
+
+    def test_fetch_should_check_digest(self):
+        self.assertRaises(KeyError, self.cache.fetch, "http://example.com/a", "f" * 40,
+                          self.opener(b"abcdefghij"))
+        self.assertEqual(os.listdir(self.cache_dir), [])
+
+    def test_fetch_should_refuse_unknown_digest(self):
+        for digest in (IGNORE_DIGEST, None):
+            self.assertRaises(ValueError, self.cache.fetch, "http://example.com/a", digest,
+                              self.opener(b"abcdefghij"))
+            self.assertEqual(self.cache.get("http://example.com/a", digest), None)
+        self.assertEqual(self.opened, 0)
+
+    def test_fetch_should_evict_least_recently_used(self):
+        paths = []
+        for i in range(2):
+            data = bytes([i]) * 40
+            paths.append(self.cache.fetch("http://example.com/%d" % i,
+                                          hashlib.sha1(data).hexdigest(), self.opener(data)))
+            os.utime(paths[-1], (i, i))
+        self.cache.get("http://example.com/0", hashlib.sha1(bytes([0]) * 40).hexdigest())
+        data = b"x" * 40
+        path = self.cache.fetch("http://example.com/2", hashlib.sha1(data).hexdigest(), self.opener(data))
+        self.assertTrue(os.path.exists(paths[0]))
+        self.assertFalse(os.path.exists(paths[1]))
+        self.assertTrue(os.path.exists(path))
+        self.assertEqual(self.cache.size(), 80)
+
+
+class TestMirroredFileSystemDataStore(unittest.TestCase):
+
+    def setUp(self):
+        self.root_dir = os.path.abspath('xusehgcfscuzhfqizuchgsireugvcsi')
+        self.mirror_dir = os.path.abspath('test_mirror')
+        self.cache_dir = os.path.abspath("test_cache")
+        self.test_data = b'licgsnireugcsenrigucsic\ncrgqgjch,kgch'
+        os.makedirs(self.mirror_dir)
+        with open(os.path.join(self.mirror_dir, 'test_file1'), 'wb') as f:
+            f.write(self.test_data)
+        self.ds = MirroredFileSystemDataStore(self.root_dir, "file://%s/" % self.mirror_dir)
+        self.orig_environ = dict(os.environ)
+        os.environ["SMT_CACHE_DIR"] = self.cache_dir
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self.orig_environ)
+        for path in (self.root_dir, self.mirror_dir, self.cache_dir):
+            if os.path.exists(path):
+                shutil.rmtree(path)
+
+    def test__get_content__should_use_cached_copy(self):
+        key = DataKey('test_file1', hashlib.sha1(self.test_data).hexdigest(), creation=None)
+        self.assertEqual(self.ds.get_content(key), self.test_data)
+        os.remove(os.path.join(self.mirror_dir, 'test_file1'))
+        self.assertEqual(self.ds.get_content(key), self.test_data)
+        self.assertEqual(len(os.listdir(self.cache_dir)), 1)
+
+    def test__get_data_item__with_wrong_digest__should_raise_KeyError(self):
+        key = DataKey('test_file1', "f" * 40, creation=None)
+        self.assertRaises(KeyError, self.ds.get_data_item, key)
+
+    def test__get_content__with_digest_pending_key__should_not_cache(self):
+        key = DataKey('test_file1', IGNORE_DIGEST, creation=None, digest_pending=True)
+        self.assertEqual(self.ds.get_content(key), self.test_data)
+        with open(os.path.join(self.mirror_dir, 'test_file1'), 'wb') as f:
+            f.write(b"changed")
+        self.assertEqual(self.ds.get_content(key), b"changed")
+        self.assertFalse(os.path.exists(self.cache_dir))
+
+    def test__get_content__with_caching_disabled(self):
+        os.environ["SMT_CACHE_SIZE"] = "0"
+        key = DataKey('test_file1', hashlib.sha1(self.test_data).hexdigest(), creation=None)
+        self.assertEqual(self.ds.get_content(key), self.test_data)
+        self.assertFalse(os.path.exists(self.cache_dir))
+
+
+class RangeRequestHandler(BaseHTTPRequestHandler):
+    """Serves files from a directory, honouring simple Range headers."""
+    directory = None
+    requests = []
+
+    def do_GET(self):
+        with open(os.path.join(self.directory, self.path.lstrip("/")), 'rb') as f:
+            data = f.read()
+        range_header = self.headers.get("Range")
+        self.requests.append(range_header)
+        if range_header:
+            start, end = range_header.split("=")[1].split("-")
+            data = data[int(start):int(end) + 1]
+            self.send_response(206)
+        else:
+            self.send_response(200)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestMirroredFileSystemDataStoreRangeRequests(unittest.TestCase):
+
+    def setUp(self):
+        self.root_dir = os.path.abspath('wusehgcfscuzhfqizuchgsireugvcsi')
+        self.mirror_dir = os.path.abspath('test_mirror')
+        self.cache_dir = os.path.abspath("test_cache")
+        self.test_data = b'0123456789' * 1000
+        os.makedirs(self.mirror_dir)
+        with open(os.path.join(self.mirror_dir, 'test_file1'), 'wb') as f:
+            f.write(self.test_data)
+        RangeRequestHandler.directory = self.mirror_dir
+        RangeRequestHandler.requests = []
+        self.server = HTTPServer(("127.0.0.1", 0), RangeRequestHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.ds = MirroredFileSystemDataStore(self.root_dir,
+                                              "http://127.0.0.1:%d/" % self.server.server_address[1])
+        self.orig_environ = dict(os.environ)
+        os.environ["SMT_CACHE_DIR"] = self.cache_dir
+        self.key = DataKey('test_file1', hashlib.sha1(self.test_data).hexdigest(), creation=None)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        os.environ.clear()
+        os.environ.update(self.orig_environ)
+        for path in (self.root_dir, self.mirror_dir, self.cache_dir):
+            if os.path.exists(path):
+                shutil.rmtree(path)
+
+    def test__get_content__with_max_length__should_use_range_request(self):
+        self.assertEqual(self.ds.get_content(self.key, max_length=100), self.test_data[:100])
+        self.assertEqual(RangeRequestHandler.requests, ["bytes=0-99"])
+        self.assertFalse(os.path.exists(self.cache_dir))
+
+    def test__get_content__with_max_length__should_use_cache_if_available(self):
+        self.assertEqual(self.ds.get_content(self.key), self.test_data)
+        self.assertEqual(self.ds.get_content(self.key, max_length=100), self.test_data[:100])
+        self.assertEqual(RangeRequestHandler.requests, [None])
+
+
+class CountingFile(object):
+    """Wraps a file object, adding the number of bytes read to `counter.bytes_read`."""
+
+    def __init__(self, fileobj, counter):
+        self._fileobj = fileobj
+        self._counter = counter
+
+    def read(self, size=-1):
+        data = self._fileobj.read(size)
+        self._counter.bytes_read += len(data)
+        return data
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        return self._fileobj.seek(offset, whence)
+
+    def close(self):
+        self._fileobj.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class LocalFS(object):
+    """
+    Minimal stand-in for a PyFilesystem filesystem, rooted in a local directory.
+    The number of bytes read from uploaded segments is counted in `bytes_read`.
+    """
+
+    def __init__(self, root, failures=0, failing_paths=()):
+        self.root = root
+        self.failures = failures  # number of segment writes that should fail
+        self.failing_paths = failing_paths  # writes to paths ending with these always fail
+        self.bytes_read = 0
+        self.written = []
+
+    def open(self, path, mode='r'):
+        if "w" in mode and ".part" in path:
+            if self.failures > 0 or path.endswith(tuple(self.failing_paths)):
+                self.failures = max(self.failures - 1, 0)
+                raise IOError("simulated network failure")
+            self.written.append(path)
+        fileobj = open(os.path.join(self.root, path), mode)
+        if mode == 'rb' and ".part" in path:
+            return CountingFile(fileobj, self)
+        return fileobj
+
+    def exists(self, path):
+        return os.path.exists(os.path.join(self.root, path))
+
+    def getsize(self, path):
+        return os.path.getsize(os.path.join(self.root, path))
+
+    def isdir(self, path):
+        return os.path.isdir(os.path.join(self.root, path))
+
+    def makedir(self, path, recursive=False):
+        os.makedirs(os.path.join(self.root, path))
+
+
+class TestSegmentedUpload(unittest.TestCase):
+
+    def setUp(self):
+        self.remote_dir = os.path.abspath("test_remote")
+        os.mkdir(self.remote_dir)
+        self.local_path = os.path.abspath("test_upload_file")
+        self.test_data = os.urandom(10000)
+        with open(self.local_path, 'wb') as f:
+            f.write(self.test_data)
+        self.fs = LocalFS(self.remote_dir)
+        self.progress = []
+
+    def tearDown(self):
+        shutil.rmtree(self.remote_dir)
+        os.remove(self.local_path)
+
+    def uploader(self, fs, **kwargs):
+        return SegmentedUploader(lambda: fs, segment_size=3000, retry_delay=0,
+                                 progress_callback=lambda done, total: self.progress.append((done, total)),
+                                 **kwargs)
+
+    def test_upload_and_read_back(self):
+        self.uploader(self.fs, threads=3).upload(self.local_path, "archive.tar")
+        manifest = read_manifest(self.fs, "archive.tar")
+        self.assertTrue(manifest["complete"])
+        self.assertEqual([s["size"] for s in manifest["segments"]], [3000, 3000, 3000, 1000])
+        self.assertEqual(self.progress[-1], (10000, 10000))
+        with SegmentedFile(self.fs, "archive.tar", manifest) as f:
+            self.assertEqual(f.read(), self.test_data)
+            f.seek(2500)
+            self.assertEqual(f.read(1000), self.test_data[2500:3500])
+            f.seek(-10, os.SEEK_END)
+            self.assertEqual(f.read(), self.test_data[-10:])
+            self.assertEqual(f.tell(), 10000)
+
+    def test_upload_should_retry_failed_segments(self):
+        self.uploader(LocalFS(self.remote_dir, failures=2), threads=3).upload(self.local_path, "archive.tar")
+        with SegmentedFile(self.fs, "archive.tar", read_manifest(self.fs, "archive.tar")) as f:
+            self.assertEqual(f.read(), self.test_data)
+
+    def test_interrupted_upload_should_resume(self):
+        failing_uploader = self.uploader(LocalFS(self.remote_dir, failures=2), threads=1, max_retries=0)
+        self.assertRaises(IOError, failing_uploader.upload, self.local_path, "archive.tar")
+        manifest = read_manifest(self.fs, "archive.tar")
+        self.assertFalse(manifest["complete"])
+        self.assertRaises(IOError, SegmentedFile, self.fs, "archive.tar", manifest)
+        self.progress = []
+        self.uploader(self.fs, threads=1).upload(self.local_path, "archive.tar")
+        self.assertEqual(self.progress, [(4000, 10000), (7000, 10000), (10000, 10000)])
+        with SegmentedFile(self.fs, "archive.tar", read_manifest(self.fs, "archive.tar")) as f:
+            self.assertEqual(f.read(), self.test_data)
+
+
+class LocalDavFsDataStore(DavFsDataStore):
+    """DavFsDataStore whose WebDAV server is replaced by a LocalFS."""
+    remote_root = None
+    failing_paths = ()
+    connections = []
+
+    def _connect(self):
+        fs = LocalFS(self.remote_root, failing_paths=self.failing_paths)
+        self.connections.append(fs)
+        return fs
+
+
+class TestDavFsDataStore(unittest.TestCase):
+
+    def setUp(self):
+        self.root_dir = os.path.abspath("test_dav_root")
+        self.remote_dir = os.path.abspath("test_dav_remote")
+        for path in (self.root_dir, self.remote_dir):
+            if os.path.exists(path):
+                shutil.rmtree(path)
+        os.mkdir(self.remote_dir)
+        self.pending_dir = os.path.abspath("test_dav_pending")
+        LocalDavFsDataStore.remote_root = self.remote_dir
+        LocalDavFsDataStore.failing_paths = ()
+        LocalDavFsDataStore.connections = []
+        self.ds = LocalDavFsDataStore(self.root_dir, "http://dav.example.com/data")
+        self.ds.pending_dir = self.pending_dir
+        self.now = datetime.now(timezone.utc)
+        self.label = self.now.strftime(TIMESTAMP_FORMAT)
+        self.test_data = os.urandom(100000)
+        with open(os.path.join(self.root_dir, "big_file"), 'wb') as f:
+            f.write(self.test_data)
+
+    def tearDown(self):
+        for path in (self.root_dir, self.remote_dir, self.pending_dir):
+            if os.path.exists(path):
+                shutil.rmtree(path)
+
+    def test__get_state__should_omit_default_archive_format(self):
+        self.assertEqual(self.ds.__getstate__(),
+                         {'root': self.root_dir, 'dav_url': "http://dav.example.com/data",
+                          'dav_user': None, 'dav_pw': None})
+
+    def test__get_state__should_round_trip_archive_format(self):
+        ds = LocalDavFsDataStore(self.root_dir, "http://dav.example.com/data", archive_format="zip")
+        self.assertEqual(ds.__getstate__()["archive_format"], "zip")
+        self.assertEqual(ds.copy().archive_format, "zip")
+        self.ds.archive_format = "tar.bz2"  # as set by 'smt configure --archive-format'
+        self.assertEqual(self.ds.copy().archive_format, "tar.bz2")
+
+    def segments_written(self):
+        return sorted(path.rsplit(".", 1)[1] for fs in LocalDavFsDataStore.connections for path in fs.written)
+
+    def test__find_new_data__should_upload_archive_and_remove_local_copy(self):
+        key, = self.ds.find_new_data(self.now)
+        self.assertEqual(os.listdir(self.pending_dir), [])
+        with mock.patch.dict(os.environ, {"SMT_CACHE_SIZE": "0"}):
+            ds = LocalDavFsDataStore(self.root_dir, "http://dav.example.com/data")
+            self.assertEqual(ds.get_content(key), self.test_data)
+
+    def test__interrupted_upload__should_be_resumed_later(self):
+        self.ds.segment_size = 30000
+        self.ds.upload_threads = 1
+        self.ds.max_retries = 0
+        LocalDavFsDataStore.failing_paths = (".part00002",)
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter("always")
+            key, = self.ds.find_new_data(self.now)
+        self.assertEqual(len(caught), 1)
+        self.assertEqual(self.segments_written(), ["part00000", "part00001", "part00003"])
+        self.assertEqual(sorted(os.listdir(self.pending_dir)),
+                         ["%s.index.json" % self.label, "%s.tar.gz" % self.label])
+        with mock.patch.dict(os.environ, {"SMT_CACHE_SIZE": "0"}):
+            self.assertEqual(self.ds.get_content(key), self.test_data)  # from the local copy
+
+        LocalDavFsDataStore.failing_paths = ()
+        LocalDavFsDataStore.connections = []
+        ds = LocalDavFsDataStore(self.root_dir, "http://dav.example.com/data")
+        ds.pending_dir = self.pending_dir
+        ds.segment_size = 30000
+        self.assertEqual(ds.upload_pending(), [])
+        self.assertEqual(self.segments_written(), ["part00002"])
+        self.assertEqual(os.listdir(self.pending_dir), [])
+        with mock.patch.dict(os.environ, {"SMT_CACHE_SIZE": "0"}):
+            ds = LocalDavFsDataStore(self.root_dir, "http://dav.example.com/data")
+            self.assertEqual(ds.get_content(key), self.test_data)
+
+    def bytes_read(self):
+        return sum(fs.bytes_read for fs in LocalDavFsDataStore.connections)
+
+    def test__get_content__with_max_length__should_read_only_the_requested_bytes(self):
+        self.ds.archive_format = "tar"
+        key, = self.ds.find_new_data(self.now)
+        cache_dir = os.path.abspath("test_dav_cache")
+        for environ in ({"SMT_CACHE_SIZE": "0"}, {"SMT_CACHE_DIR": cache_dir}):
+            with mock.patch.dict(os.environ, environ):
+                before = self.bytes_read()
+                self.assertEqual(self.ds.get_content(key, max_length=100), self.test_data[:100])
+                self.assertEqual(self.bytes_read() - before, 100)
+        self.assertFalse(os.path.exists(cache_dir))
+        with mock.patch.dict(os.environ, {"SMT_CACHE_SIZE": "0"}):
+            before = self.bytes_read()
+            self.assertEqual(self.ds.get_content(key), self.test_data)
+            self.assertGreaterEqual(self.bytes_read() - before, len(self.test_data))
+
+
 
 class MockDataStore(object):
         root = os.getcwd()
@@ -178,7 +818,42 @@ class TestDataFile(unittest.TestCase):
     def test_sorted_content(self):
         self.assertEqual(self.data_file.sorted_content,
                          b'crgqgjch,kgch\nlicgsnireugcsenrigucsic')
-        os.remove("%s,sorted" % self.test_file)
+        self.assertFalse(os.path.exists("%s,sorted" % self.test_file))
+
+    def test_iter_sorted_lines_with_small_buffer(self):
+        with open("test_file4", "wb") as f:
+            f.write(b"delta\nalpha\necho\ncharlie\nbravo\n")
+        data_file = DataFile("test_file4", MockDataStore())
+        self.assertEqual(list(data_file.iter_sorted_lines(buffer_size=8)),
+                         [b"alpha\n", b"bravo\n", b"charlie\n", b"delta\n", b"echo\n"])
+        os.remove("test_file4")
+
+    def test_unordered_digest(self):
+        with open("test_file2", 'wb') as f:
+            f.write(b'crgqgjch,kgch\nlicgsnireugcsenrigucsic')
+        sorted_data_file = DataFile("test_file2", MockDataStore())
+        self.assertEqual(self.data_file.unordered_digest, sorted_data_file.unordered_digest)
+        self.assertNotEqual(self.data_file.digest, sorted_data_file.digest)
+        os.remove("test_file2")
+
+    def test_open(self):
+        with self.data_file.open() as f:
+            self.assertEqual(f.read(), self.test_data)
+
+    def test_iter_chunks(self):
+        chunks = list(self.data_file.iter_chunks(chunk_size=16))
+        self.assertEqual([len(chunk) for chunk in chunks], [16, 16, 5])
+        self.assertEqual(b"".join(chunks), self.test_data)
+
+    def test_save_copy_to_directory(self):
+        os.mkdir("test_copy_dir")
+        try:
+            full_path = self.data_file.save_copy("test_copy_dir")
+            self.assertEqual(full_path, os.path.join("test_copy_dir", self.test_file))
+            with open(full_path, 'rb') as f:
+                self.assertEqual(f.read(), self.test_data)
+        finally:
+            shutil.rmtree("test_copy_dir")
 
     def test_eq(self):
         same_data_file = DataFile(self.test_file, MockDataStore())
@@ -188,7 +863,15 @@ class TestDataFile(unittest.TestCase):
         sorted_data_file = DataFile("test_file2", MockDataStore())
         self.assertEqual(self.data_file, sorted_data_file)
         os.remove("test_file2")
-        os.remove("test_file2,sorted")
+
+    def test_ne_if_only_final_newline_differs(self):
+        # the same lines in a different order, but with a final newline
+        with open("test_file2", 'wb') as f:
+            f.write(b'crgqgjch,kgch\nlicgsnireugcsenrigucsic\n')
+        other_data_file = DataFile("test_file2", MockDataStore())
+        self.assertEqual(self.data_file.unordered_digest, other_data_file.unordered_digest)
+        self.assertNotEqual(self.data_file, other_data_file)
+        os.remove("test_file2")
 
     def test_ne(self):
         with open("test_file3", "w") as f:
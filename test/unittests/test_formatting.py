@@ -4,6 +4,9 @@ Unit tests for the sumatra.formatting module
 """
 
 import unittest
+from unittest import mock
+import sys
+import io
 import tempfile
 from datetime import datetime, timezone
 import os
@@ -14,7 +17,8 @@ from xml.etree import ElementTree
 from sumatra.records import Record
 from sumatra.formatting import (Formatter, TextFormatter, HTMLFormatter,
                                 TextDiffFormatter, get_formatter,
-                                ShellFormatter, LaTeXFormatter)
+                                ShellFormatter, LaTeXFormatter, TextTable)
+from sumatra.formatting import columnar
 from sumatra.core import run, TIMESTAMP_FORMAT
 from sumatra.programs import get_executable
 
@@ -54,6 +58,8 @@ class MockLaunchMode(object):
 class MockDataItem(object):
     def __init__(self, path):
         self.path = path
+        self.digest = "0" * 40
+        self.creation = None
         self.metadata = {'size': 1024}
     def __repr__(self):
         return self.path
@@ -150,6 +156,43 @@ class TestTextFormatter(unittest.TestCase):
         for l in lengths:
             assert l == lengths[0]
 
+    def test__parameter_table__should_have_one_column_per_parameter(self):
+        self.record_list[0].parameters = {'a': 2, 'b': {'c': 3}}
+        self.record_list[1].parameters = {'d': "x"}
+        tf1 = TextFormatter(self.record_list)
+        lines = tf1.parameter_table().split("\n")[:-1]
+        self.assertEqual([cell.strip() for cell in lines[0].split("|")[1:-1]],
+                         ["label", "version", "main_file", "a", "b.c", "d"])
+        self.assertEqual([cell.strip() for cell in lines[2].split("|")[4:-1]], ["", "", "x"])
+        self.assertEqual(len(set(len(line) for line in lines)), 1)
+
+    def test__table__should_use_column_widths_from_sample(self):
+        self.record_list[1].label = "a_much_longer_label"
+        table = TextTable(["label", "version"], iter(self.record_list), sample_size=1)
+        output = io.StringIO()
+        table.write(output)
+        lines = output.getvalue().split("\n")[:-1]
+        self.assertEqual(len(lines), 3)
+        self.assertEqual(len(set(len(line) for line in lines)), 1)
+        label_width = len(self.record_list[0].label)
+        self.assertEqual(lines[2].split("|")[1].strip(), "a_much_longer_label"[:label_width])
+
+    def test__parameter_table__from_reiterable_records(self):
+        class Records(object):
+            def __init__(self, records):
+                self.records = records
+                self.passes = 0
+            def __iter__(self):
+                self.passes += 1
+                return iter(self.records)
+        self.record_list[0].parameters = {'a': 2}
+        self.record_list[1].parameters = {'b': 3}
+        records = Records(self.record_list)
+        output = io.StringIO()
+        TextFormatter(records).write(output, mode='parameter_table')
+        self.assertEqual(output.getvalue(), TextFormatter(self.record_list).parameter_table())
+        self.assertEqual(records.passes, 1)
+
     def test__long__with_non_ascii_username(self):
         self.record_list[0].user = "Paul Erdős <paul@elte.hu>"
         tf1 = TextFormatter(self.record_list)
@@ -253,6 +296,83 @@ class TestTextDiffFormatter(unittest.TestCase):
 
 
 
+class TestColumnarExport(unittest.TestCase):
+
+    def setUp(self):
+        self.records = [MockRecord("rec1"), MockRecord("rec2"), MockRecord("rec3")]
+        self.records[0].parameters = {'a': 2, 'b': {'c': True, 'd': "x"}}
+        self.records[1].parameters = {'a': 2.5, 'b': {'c': False, 'd': 3}}
+        self.records[2].parameters = {'e': 1}
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_column_type(self):
+        self.assertEqual(columnar.column_type([1, 2, None]), "int64")
+        self.assertEqual(columnar.column_type([1, 2.5]), "float64")
+        self.assertEqual(columnar.column_type([True, None]), "bool")
+        self.assertEqual(columnar.column_type([True, 1]), "string")
+        self.assertEqual(columnar.column_type(["x", 3]), "string")
+        self.assertEqual(columnar.column_type([None]), "string")
+
+    def test_parameter_rows(self):
+        names, rows = columnar.parameter_rows(r.parameters for r in self.records)
+        self.assertEqual(names, ["a", "b.c", "b.d", "e"])
+        self.assertEqual([row.get("b.d") for row in rows], ["x", 3, None])
+        self.assertEqual(rows[2], {"e": 1})
+
+    def test_parameters_table(self):
+        columns = dict((name, (dtype, values))
+                       for name, dtype, values in columnar.parameters_table(self.records))
+        self.assertEqual(sorted(columns), ["label", "parameters.a", "parameters.b.c",
+                                           "parameters.b.d", "parameters.e"])
+        self.assertEqual(columns["parameters.a"], ("float64", [2.0, 2.5, None]))
+        self.assertEqual(columns["parameters.b.c"], ("bool", [True, False, None]))
+        self.assertEqual(columns["parameters.b.d"], ("string", ["x", "3", None]))
+        self.assertEqual(columns["parameters.e"], ("int64", [None, None, 1]))
+
+    def test_parameters_table_with_parameter_named_label(self):
+        self.records[2].parameters = {'label': "foo"}
+        names = [name for name, dtype, values in columnar.parameters_table(self.records)]
+        self.assertEqual(len(names), len(set(names)))
+        columns = dict((name, values)
+                       for name, dtype, values in columnar.parameters_table(self.records))
+        self.assertEqual(columns["label"], ["rec1", "rec2", "rec3"])
+        self.assertEqual(columns["parameters.label"], [None, None, "foo"])
+
+    def test_build_tables_should_not_need_pyarrow_or_h5py(self):
+        with mock.patch.dict(sys.modules, {"pyarrow": None, "h5py": None}):
+            tables = columnar.build_tables(iter(self.records))
+        self.assertEqual(sorted(tables), sorted(columnar.TABLE_NAMES))
+        for table_name in columnar.TABLE_NAMES:
+            for name, dtype, values in tables[table_name]:
+                self.assertIn(dtype, ("bool", "int64", "float64", "string", "timestamp"))
+
+    def test_data_table(self):
+        columns = dict((name, values) for name, dtype, values in columnar.data_table(self.records))
+        self.assertEqual(columns["path"], ["somefile", "anotherfile"] * 3)
+        self.assertEqual(columns["direction"], ["input"] * 6)
+        self.assertEqual(columns["size"], [1024] * 6)
+
+    def test_all_columns_have_one_value_per_row(self):
+        tables = columnar.build_tables(self.records)
+        for name, dtype, values in tables["records"] + tables["parameters"]:
+            self.assertEqual(len(values), len(self.records))
+
+    def test_export_parquet(self):
+        try:
+            import pyarrow.parquet
+        except ImportError:
+            raise unittest.SkipTest("pyarrow not available")
+        columnar.export_records(self.records, self.tmpdir, "parquet")
+        table = pyarrow.parquet.read_table(os.path.join(self.tmpdir, "parameters.parquet"))
+        self.assertEqual(table.column("parameters.a").to_pylist(), [2.0, 2.5, None])
+
+    def test_export_with_unknown_format_should_raise(self):
+        self.assertRaises(ValueError, columnar.export_records, self.records, self.tmpdir, "csv")
+
+
 class TestModuleFunctions(unittest.TestCase):
 
     def test__get_formatter__should_return_Formatter_subclass(self):
@@ -8,9 +8,11 @@ import os
 import sys
 import tempfile
 import unittest
+import io
 import sumatra.projects
-from sumatra.projects import Project, load_project
+from sumatra.projects import Project, LabelCache, load_project
 from sumatra.core import SingletonType
+from sumatra.datastore import FileSystemDataStore
 
 
 class MockDiffFormatter(object):
@@ -181,6 +183,9 @@ class MockRecordStore(object):
     def delete(self, project_name, label):
         self.deleted = label
 
+    def delete_records(self, project_name, labels):
+        return [label for label in labels if label != "none_existent"]
+
     def delete_by_tag(self, project_name, tag):
         return "".join(reversed(tag))
 
@@ -197,6 +202,31 @@ class MockRecordStore(object):
         return [self.get(project_name, 'foo_label').label,
             self.get(project_name, 'bar_label').label]
 
+    def iter_records(self, project_name, tags=None):
+        return iter(self.list(project_name, tags=tags))
+
+
+class TestLabelCache(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix='sumatra-test-')
+        self.cache = LabelCache(os.path.join(self.dir, "labels"))
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_add_and_remove(self):
+        self.cache.write(["a", "b"])
+        self.cache.add("c")
+        self.cache.remove("a", "d")
+        self.assertEqual(self.cache.labels(), ["b", "c"])
+
+    def test_add_to_file_without_final_newline(self):
+        with open(self.cache.path, "w") as fp:
+            fp.write("a\nb")
+        self.cache.add("c")
+        self.assertEqual(self.cache.labels(), ["a", "b", "c"])
+
 
 class TestProject(unittest.TestCase):
 
@@ -289,6 +319,14 @@ class TestProject(unittest.TestCase):
         proj.format_records('shell')
         proj.format_records('json')
 
+    def test_write_records(self):
+        proj = Project("test_project",
+                       record_store=MockRecordStore())
+        for mode in ('short', 'table', 'parameter_table'):
+            output = io.StringIO()
+            proj.write_records(output, 'text', mode)
+            self.assertEqual(output.getvalue().rstrip("\n"), proj.format_records('text', mode).rstrip("\n"))
+
     def test__get_record__calls_get_on_the_record_store(self):
         proj = Project("test_project",
                        record_store=MockRecordStore())
@@ -305,6 +343,35 @@ class TestProject(unittest.TestCase):
                        record_store=MockRecordStore())
         self.assertEqual(proj.delete_by_tag("foo"), "oof")
 
+    def test__delete_record__should_update_the_label_cache(self):
+        proj = Project("test_project",
+                       record_store=MockRecordStore())
+        proj.rebuild_label_cache()
+        proj.delete_record("foo_labelfoo_label")
+        self.assertEqual(proj.label_cache.labels(), ["bar_labelbar_label"])
+
+    def test__delete_records__should_update_the_label_cache(self):
+        proj = Project("test_project",
+                       record_store=MockRecordStore())
+        proj.rebuild_label_cache()
+        self.assertEqual(proj.delete_records(["foo_labelfoo_label", "none_existent"]),
+                         ["foo_labelfoo_label"])
+        self.assertEqual(proj.label_cache.labels(), ["bar_labelbar_label"])
+
+    def test__add_record__should_append_to_the_label_cache(self):
+        proj = Project("test_project",
+                       record_store=MockRecordStore())
+        proj.rebuild_label_cache()
+        proj.add_record(MockRecord("baz"))
+        self.assertEqual(proj.label_cache.labels(),
+                         ["foo_labelfoo_label", "bar_labelbar_label", "baz"])
+
+    def test__add_record__should_create_a_missing_label_cache(self):
+        proj = Project("test_project",
+                       record_store=MockRecordStore())
+        proj.add_record(MockRecord("baz"))
+        self.assertEqual(proj.label_cache.labels(), ["foo_labelfoo_label", "bar_labelbar_label"])
+
     def test__add_comment__should_set_the_outcome_attribute_of_the_record(self):
         proj = Project("test_project",
                        record_store=MockRecordStore())
@@ -347,6 +414,22 @@ class TestProject(unittest.TestCase):
         shutil.copytree = orig_copytree
         assert "backup" in backup_dir
 
+    def test__calculate_digests__should_save_records_with_pending_digests(self):
+        data_store = FileSystemDataStore(os.path.join(self.dir, "Data"))
+        with open(os.path.join(data_store.root, "output.dat"), "w") as f:
+            f.write("42\n")
+        record = MockRecord("foo")
+        record.datastore = data_store
+        record.output_data = data_store.find_new_data_deferred(datetime(2000, 1, 1, tzinfo=timezone.utc))
+        saved = []
+        record_store = MockRecordStore()
+        record_store.get = lambda project_name, label: record
+        record_store.save = lambda project_name, record: saved.append(record)
+        proj = Project("test_project", record_store=record_store)
+        self.assertEqual(proj.calculate_digests(["foo"]), 1)
+        self.assertFalse(record.output_data[0].digest_pending)
+        self.assertEqual(saved, [record])
+
     def test__repeat(self):
         orig_gwc = sumatra.projects.get_working_copy
         sumatra.projects.get_working_copy = lambda: MockWorkingCopy(self.dir)
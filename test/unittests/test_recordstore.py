@@ -4,10 +4,13 @@ Unit tests for the sumatra.recordstore package
 """
 
 import unittest
+import io
 import os
 import sys
 import tempfile
 import shutil
+import shelve
+from unittest import mock
 from datetime import datetime, timedelta, timezone
 from glob import glob
 
@@ -15,6 +18,7 @@ from sumatra.records import Record
 from sumatra.programs import Executable
 from sumatra.recordstore import (shelve_store, django_store, http_store,
                                  serialization, get_record_store)
+from sumatra.recordstore.base import parameter_predicates, match_parameters
 from sumatra.versioncontrol import vcs_list
 import sumatra.launch
 import sumatra.datastore
@@ -204,6 +208,14 @@ class BaseTestRecordStore(object):
         self.store.save(self.project.name, r1)
         self.store.save(self.project.name, r3)
 
+    def add_some_parameterized_records(self):
+        now = datetime.now(timezone.utc)
+        for i, (a, c) in enumerate([(1, 0.5), (2, 1.5), (3, 2.5)]):
+            r = MockRecord("record%d" % a, timestamp=now - timedelta(seconds=3 - i))
+            r.parameters = sumatra.parameters.JSONParameterSet(
+                json.dumps({"a": a, "b": {"c": c}, "name": "run%d" % a}))
+            self.store.save(self.project.name, r)
+
     def test_create_record_store_should_not_produce_errors(self):
         pass
 
@@ -231,6 +243,22 @@ class BaseTestRecordStore(object):
         records = self.store.list(self.project.name, "tag1")
         self.assertEqual(len(records), 2)
 
+    def test_list_by_tags(self):
+        self.add_some_records()
+        self.add_some_tags()
+        r4 = MockRecord("record4", timestamp=datetime.now(timezone.utc) + timedelta(seconds=1))
+        r4.tags.add("tag")  # a prefix of the other tags, which must not match them
+        self.store.save(self.project.name, r4)
+
+        def labels(tags, **kwargs):
+            return sorted(r.label for r in self.store.list_by_tags(self.project.name, tags, **kwargs))
+        self.assertEqual(labels(["tag2"]), ["record1"])
+        self.assertEqual(labels(["tag"]), ["record4"])
+        self.assertEqual(labels("tag1"), ["record1", "record3"])
+        self.assertEqual(labels(["tag", "tag2"]), ["record1", "record4"])
+        self.assertEqual(labels(["tag1", "tag2"], require_all=True), ["record1"])
+        self.assertEqual(labels(["tag", "tag2"], require_all=True), [])
+
     def test_labels_without_tags_should_return_all_labels(self):
         self.add_some_records()
         labels = self.store.labels(self.project.name)
@@ -245,6 +273,13 @@ class BaseTestRecordStore(object):
         self.assertEqual(len(labels), 2)
         self.assertIsInstance(labels[0], str)
 
+    def test_labels_starting_with(self):
+        self.add_some_records()
+        self.assertEqual(sorted(self.store.labels_starting_with(self.project.name, "rec")),
+                         ["record1", "record2", "record3"])
+        self.assertEqual(self.store.labels_starting_with(self.project.name, "record2"), ["record2"])
+        self.assertEqual(self.store.labels_starting_with(self.project.name, "x"), [])
+
     def test_delete_removes_record(self):
         self.add_some_records()
         key = "record1"
@@ -262,6 +297,13 @@ class BaseTestRecordStore(object):
         self.assertEqual(len(self.store.list(self.project.name)), 1)
         self.assertRaises(KeyError, self.store.get, self.project.name, "record1")
 
+    def test_delete_records(self):
+        self.add_some_records()
+        deleted = self.store.delete_records(self.project.name, ["record1", "notarecord", "record3"])
+        self.assertEqual(sorted(deleted), ["record1", "record3"])
+        self.assertEqual(self.store.labels(self.project.name), ["record2"])
+        self.assertEqual(self.store.delete_records(self.project.name, []), [])
+
     def test_delete_nonexistent_label(self):
         self.add_some_records()
         self.assertRaises(Exception,  # could be KeyError or DoesNotExist
@@ -296,12 +338,61 @@ class BaseTestRecordStore(object):
         self.assertEqual(sorted(rec.label for rec in self.store.list(self.project.name)),
                          sorted(rec.label for rec in other_store.list(self.project.name)))
 
+    def test_list_by_parameters_with_dict(self):
+        self.add_some_parameterized_records()
+        records = self.store.list_by_parameters(self.project.name, {"b": {"c": 1.5}})
+        self.assertEqual([rec.label for rec in records], ["record2"])
+
+    def test_list_by_parameters_with_predicates(self):
+        self.add_some_parameterized_records()
+        records = self.store.list_by_parameters(self.project.name, [("a", ">=", 2), ("b.c", "<", 2.5)])
+        self.assertEqual([rec.label for rec in records], ["record2"])
+        records = self.store.list_by_parameters(self.project.name, [("name", "=", "run3")])
+        self.assertEqual([rec.label for rec in records], ["record3"])
+        records = self.store.list_by_parameters(self.project.name, [("a", ">", 0)])
+        self.assertEqual(sorted(rec.label for rec in records), ["record1", "record2", "record3"])
+
+    def test_list_by_parameters_with_missing_parameter(self):
+        self.add_some_parameterized_records()
+        self.assertEqual(self.store.list_by_parameters(self.project.name, [("d", "=", 1)]), [])
+
+    def test_list_by_parameters_after_delete(self):
+        self.add_some_parameterized_records()
+        self.store.delete(self.project.name, "record2")
+        records = self.store.list_by_parameters(self.project.name, [("a", "<=", 2)])
+        self.assertEqual([rec.label for rec in records], ["record1"])
+
+    def test_iter_records(self):
+        self.add_some_records()
+        self.assertEqual(sorted(rec.label for rec in self.store.iter_records(self.project.name)),
+                         ["record1", "record2", "record3"])
+
+    def test_export_import_ndjson(self):
+        self.add_some_records()
+        fp = io.StringIO()
+        self.assertEqual(self.store.export_ndjson(self.project.name, fp), 3)
+        self.assertEqual(len(fp.getvalue().splitlines()), 3)
+        fp.seek(0)
+        other_store = shelve_store.ShelveRecordStore(shelf_name="test_record_store2")
+        self.assertEqual(other_store.import_ndjson(self.project.name, fp, batch_size=2), 3)
+        self.assertEqual(sorted(rec.label for rec in other_store.list(self.project.name)),
+                         ["record1", "record2", "record3"])
+
     def test_update(self):
         self.add_some_records()
         self.store.update(self.project.name, "datastore.root", "/new/path/to/store")
         updated_value, = set(rec.datastore.root for rec in self.store.list(self.project.name))
         self.assertEqual(updated_value, "/new/path/to/store")
 
+    def test_update_with_tags(self):
+        self.add_some_records()
+        self.add_some_tags()
+        self.store.update(self.project.name, "input_datastore.root", "/new/path/to/inputs", tags=["tag2"])
+        roots = dict((rec.label, rec.input_datastore.root) for rec in self.store.list(self.project.name))
+        self.assertEqual(roots["record1"], "/new/path/to/inputs")
+        self.assertNotEqual(roots["record2"], "/new/path/to/inputs")
+        self.assertNotEqual(roots["record3"], "/new/path/to/inputs")
+
     def test_clear(self):
         self.add_some_records()
         self.store.clear()
@@ -326,6 +417,65 @@ class TestShelveRecordStore(unittest.TestCase, BaseTestRecordStore):
         self.store = pickle.loads(s)
         self.assertEqual(self.store._shelf_name, "test_record_store")
 
+    def test_list_projects_should_not_include_parameter_index(self):
+        self.add_some_parameterized_records()
+        self.assertEqual(self.store.list_projects(), [self.project.name])
+
+    def test_save_many_should_write_each_shelf_key_once(self):
+        now = datetime.now(timezone.utc)
+        records = [MockRecord("record%d" % i, timestamp=now - timedelta(seconds=i)) for i in range(5)]
+        with mock.patch.object(shelve.Shelf, "__setitem__", autospec=True,
+                               side_effect=shelve.Shelf.__setitem__) as setitem:
+            self.store.save_many(self.project.name, records)
+        keys = [call.args[1] for call in setitem.call_args_list]
+        self.assertEqual(sorted(keys), sorted(set(keys)))
+        self.assertIn(self.project.name, keys)
+        self.assertEqual(sorted(self.store.labels(self.project.name)),
+                         ["record0", "record1", "record2", "record3", "record4"])
+
+    def test_parameter_index_should_be_rebuilt_if_out_of_date(self):
+        self.add_some_parameterized_records()
+        del self.store.shelf[shelve_store.PARAMETER_INDEX_PREFIX + self.project.name]
+        records = self.store.list_by_parameters(self.project.name, {"a": 1})
+        self.assertEqual([rec.label for rec in records], ["record1"])
+
+
+    def test_list_by_parameters_should_load_records_only_if_any_match(self):
+        self.add_some_parameterized_records()
+        with mock.patch.object(shelve.Shelf, "__getitem__", autospec=True,
+                               side_effect=shelve.Shelf.__getitem__) as getitem:
+            self.assertEqual(self.store.list_by_parameters(self.project.name, {"a": 99}), [])
+        keys = set(call.args[1] for call in getitem.call_args_list)
+        self.assertNotIn(self.project.name, keys)
+        with mock.patch.object(shelve.Shelf, "__getitem__", autospec=True,
+                               side_effect=shelve.Shelf.__getitem__) as getitem:
+            records = self.store.list_by_parameters(self.project.name, {"a": 1})
+        self.assertEqual([rec.label for rec in records], ["record1"])
+        keys = set(call.args[1] for call in getitem.call_args_list)
+        self.assertIn(self.project.name, keys)
+
+    def test_labels_starting_with_should_not_load_records(self):
+        self.add_some_records()
+        with mock.patch.object(shelve.Shelf, "__getitem__", autospec=True,
+                               side_effect=shelve.Shelf.__getitem__) as getitem:
+            labels = self.store.labels_starting_with(self.project.name, "record")
+        self.assertEqual(sorted(labels), ["record1", "record2", "record3"])
+        keys = [call.args[1] for call in getitem.call_args_list]
+        self.assertEqual(keys, [shelve_store.LABEL_LIST_PREFIX + self.project.name])
+
+    def test_label_list_should_follow_deletions(self):
+        self.add_some_records()
+        self.store.delete(self.project.name, "record1")
+        self.store.delete_records(self.project.name, ["record3"])
+        self.assertEqual(self.store.labels_starting_with(self.project.name, "record"), ["record2"])
+        self.assertEqual(self.store.list_projects(), [self.project.name])
+
+    def test_label_list_should_be_rebuilt_if_missing(self):
+        self.add_some_records()
+        del self.store.shelf[shelve_store.LABEL_LIST_PREFIX + self.project.name]
+        self.assertEqual(sorted(self.store.labels_starting_with(self.project.name, "record")),
+                         ["record1", "record2", "record3"])
+
 
 class TestDjangoRecordStore(unittest.TestCase, BaseTestRecordStore):
 
@@ -352,6 +502,128 @@ class TestDjangoRecordStore(unittest.TestCase, BaseTestRecordStore):
         # because we use the same db for all tests, we can't clear it
         pass
 
+    def test_schema_is_current(self):
+        from django.db.migrations.recorder import MigrationRecorder
+        from django.db import connections
+        using = self.store._db_label
+        self.store._get_models()
+        self.assertTrue(django_store.db_config.schema_is_current(using))
+        recorder = MigrationRecorder(connections[using])
+        recorder.record_unapplied("django_store", "0001_initial")
+        try:
+            self.assertFalse(django_store.db_config.schema_is_current(using))
+        finally:
+            recorder.record_applied("django_store", "0001_initial")
+
+    def test_update_does_not_affect_other_projects(self):
+        self.add_some_records()
+        self.store.save("OtherProject", MockRecord("record1", timestamp=datetime.now(timezone.utc)))
+        self.store.update(self.project.name, "datastore.root", "/new/path/to/store")
+        self.assertEqual(self.store.get("OtherProject", "record1").datastore.root, "/tmp")
+        self.store.delete("OtherProject", "record1")
+
+    def test_save_should_replace_output_keys(self):
+        r = MockRecord("record1", timestamp=datetime.now(timezone.utc))
+        key = sumatra.datastore.DataKey("output.dat", sumatra.datastore.IGNORE_DIGEST, None,
+                                        size=3, digest_pending=True)
+        r.output_data = [key]
+        self.store.save(self.project.name, r)
+        key.digest = "d" * 40
+        del key.metadata["digest_pending"]
+        self.store.save(self.project.name, r)
+        output_data = self.store.get(self.project.name, "record1").output_data
+        self.assertEqual([(k.path, k.digest) for k in output_data], [("output.dat", "d" * 40)])
+
+    def test_search_index_follows_saves_and_deletes(self):
+        from django.db import connections
+        from sumatra.recordstore.django_store import search
+        using = self.store._db_label
+        if not search.is_available(using):
+            raise unittest.SkipTest("Database has no full-text search index")
+        self.add_some_records()
+        db_records = self.store._manager.filter(project__id=self.project.name)
+        self.assertEqual([r.label for r in search.filter_records(db_records, "record2", using)], ["record2"])
+        db_id = db_records.get(label="record2").db_id
+        self.store.delete(self.project.name, "record2")
+        with connections[using].cursor() as cursor:
+            cursor.execute("SELECT COUNT(*) FROM %s WHERE rowid = %%s" % search.TABLE, [db_id])
+            self.assertEqual(cursor.fetchone()[0], 0)
+
+    def test_search_index_availability_rechecked_after_migrate(self):
+        from django.core import management
+        from sumatra.recordstore.django_store import search
+        using = self.store._db_label
+        available = search.is_available(using)
+        search._available[using] = not available  # as if checked before the index was created or dropped
+        management.call_command('migrate', database=using, verbosity=0, interactive=False)
+        self.assertEqual(search.is_available(using), available)
+
+    def test_empty_parameter_set_should_be_indexed_only_once(self):
+        models = self.store._get_models()
+        r = MockRecord("record1", timestamp=datetime.now(timezone.utc))  # with an empty parameter set
+        self.store.save(self.project.name, r)
+        db_parameter_set = self.store._manager.get(project__id=self.project.name, label="record1").parameters
+        self.assertTrue(db_parameter_set.indexed)
+        self.assertFalse(db_parameter_set.values.exists())
+        with mock.patch.object(models.ParameterSet, "index") as index:
+            self.store.save(self.project.name, r)
+            self.store.list_by_parameters(self.project.name, {"a": 1})
+        self.assertFalse(index.called)
+
+    def test_index_parameter_sets_should_index_unindexed_sets_once(self):
+        from sumatra.recordstore.django_store.parameter_index import index_parameter_sets
+        models = self.store._get_models()
+        using = self.store._db_label
+        self.add_some_parameterized_records()
+        db_parameter_sets = models.ParameterSet.objects.using(using)
+        models.ParameterValue.objects.using(using).all().delete()
+        db_parameter_sets.update(indexed=False)  # as after adding the flag to an older database
+        index_parameter_sets(models.ParameterSet, models.ParameterValue, using=using)
+        self.assertFalse(db_parameter_sets.filter(indexed=False).exists())
+        records = self.store.list_by_parameters(self.project.name, [("a", ">=", 2)])
+        self.assertEqual(sorted(rec.label for rec in records), ["record2", "record3"])
+        n_values = models.ParameterValue.objects.using(using).count()
+        index_parameter_sets(models.ParameterSet, models.ParameterValue, using=using)
+        self.assertEqual(models.ParameterValue.objects.using(using).count(), n_values)
+
+    def test_list_by_parameters_with_large_integers(self):
+        now = datetime.now(timezone.utc)
+        for i, n in enumerate([2**53, 2**53 + 1, 10**400]):
+            r = MockRecord("record%d" % (i + 1), timestamp=now - timedelta(seconds=3 - i))
+            r.parameters = sumatra.parameters.JSONParameterSet(json.dumps({"n": n}))
+            self.store.save(self.project.name, r)
+        for predicates, expected in (({"n": 2**53}, ["record1"]), ({"n": 2**53 + 1}, ["record2"]),
+                                     ({"n": 10**400}, ["record3"]), ([("n", ">=", 2**53)], ["record1"]),
+                                     ([("n", ">", 0)], ["record1"])):
+            records = self.store.list_by_parameters(self.project.name, predicates)
+            self.assertEqual(sorted(rec.label for rec in records), expected)
+
+    def test_clear_inexact_numbers(self):
+        from sumatra.recordstore.django_store.parameter_index import clear_inexact_numbers
+        models = self.store._get_models()
+        using = self.store._db_label
+        self.add_some_parameterized_records()
+        values = models.ParameterValue.objects.using(using).filter(name="a")
+        values.filter(value_text="1").update(value_text=str(2**53 + 1), value_number=float(2**53))  # as stored before
+        values.filter(value_text="2").update(value_text=str(2**53), value_number=float(2**53))
+        clear_inexact_numbers(models.ParameterValue, using=using)
+        self.assertEqual(sorted(values.values_list("value_text", "value_number")),
+                         [("3", 3.0), (str(2**53), float(2**53)), (str(2**53 + 1), None)])
+
+    def test_delete_records_removes_orphan_tags_and_data_keys(self):
+        models = self.store._get_models()
+        using = self.store._db_label
+        self.add_some_records()
+        self.add_some_tags()
+        for label in ("record1", "record2"):
+            r = self.store.get(self.project.name, label)
+            r.input_data = [sumatra.datastore.DataKey("input_%s.dat" % label, "i" * 40, None)]
+            r.output_data = [sumatra.datastore.DataKey("output_%s.dat" % label, "o" * 40, None)]
+            self.store.save(self.project.name, r)
+        self.store.delete_records(self.project.name, ["record1", "record2"])
+        self.assertEqual(self.store.labels(self.project.name), ["record3"])
+        self.assertEqual(list(models.Tag.objects.using(using).values_list("name", flat=True)), ["tag1"])
+        self.assertFalse(models.DataKey.objects.using(using).filter(path__contains="record").exists())
 
 class MockResponse(object):
     def __init__(self, status):
@@ -504,6 +776,23 @@ class TestHttpRecordStore(unittest.TestCase, BaseTestRecordStore):
         pass  # override base class test to avoid UserWarning
 
 
+class TestParameterPredicates(unittest.TestCase):
+
+    def test_predicates_from_nested_dict(self):
+        self.assertEqual(parameter_predicates({"a": 1, "b": {"c": 2}}),
+                         [("a", "=", 1), ("b.c", "=", 2)])
+
+    def test_invalid_operator_should_raise(self):
+        self.assertRaises(ValueError, parameter_predicates, [("a", "!=", 1)])
+
+    def test_match_parameters(self):
+        flat_parameters = {"a": 1, "b.c": "x"}
+        self.assertTrue(match_parameters(flat_parameters, [("a", "<", 2), ("b.c", "=", "x")]))
+        self.assertFalse(match_parameters(flat_parameters, [("a", ">", 1)]))
+        self.assertFalse(match_parameters(flat_parameters, [("b.c", ">", 1)]))  # not comparable
+        self.assertFalse(match_parameters(flat_parameters, [("d", "=", 1)]))
+
+
 class TestSerialization(unittest.TestCase):
     maxDiff = None
 
@@ -542,6 +831,46 @@ class TestSerialization(unittest.TestCase):
     def test_encode_project_info(self):
         serialization.encode_project_info("foo", "description of foo")
 
+    def test_datestring_to_datetime(self):
+        expected = datetime(2024, 1, 2, 3, 4, 5, tzinfo=timezone.utc)
+        for s in ("2024-01-02 03:04:05+0000", "2024-01-02T03:04:05+00:00",
+                  "2024-01-02 03:04:05", "2024-01-02 03:04:05 00:00"):
+            self.assertEqual(serialization.datestring_to_datetime(s), expected)
+        self.assertRaises(ValueError, serialization.datestring_to_datetime, "yesterday")
+
+    def _example_records(self):
+        with open(os.path.join(this_directory, "example_0.7.json")) as fp:
+            return [serialization.build_record(json.load(fp))]
+
+    def test_encode_decode_records_json(self):
+        records = self._example_records()
+        content = serialization.encode_records(records)
+        self.assertIsInstance(json.loads(content), list)
+        decoded = serialization.decode_records(content)
+        self.assertEqual([r.label for r in decoded], [r.label for r in records])
+        self.assertEqual(decoded[0].parameters, records[0].parameters)
+
+    def test_encode_decode_records_msgpack(self):
+        if serialization.msgpack is None:
+            raise unittest.SkipTest("msgpack not available")
+        records = self._example_records()
+        content = serialization.encode_records(records, "msgpack")
+        self.assertIsInstance(content, bytes)
+        decoded = serialization.decode_records(content)
+        self.assertEqual([r.label for r in decoded], [r.label for r in records])
+
+    def test_decode_records_from_newer_schema_should_raise(self):
+        content = json.dumps({"schema_version": serialization.SCHEMA_VERSION + 1, "records": []})
+        self.assertRaises(ValueError, serialization.decode_records, content)
+
+    def test_json_codec_should_fall_back_to_json_module(self):
+        codec = serialization.get_codec("json")
+        self.assertEqual(json.loads(codec.dumps({"n": 2**70})), {"n": 2**70})
+        self.assertTrue(codec.loads('{"x": NaN}')["x"] != 0)
+
+    def test_get_codec_with_unknown_format_should_raise(self):
+        self.assertRaises(ValueError, serialization.get_codec, "xml")
+
 
 class TestModuleFunctions(unittest.TestCase):
 
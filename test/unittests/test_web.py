@@ -2,8 +2,12 @@
 Unit tests for the sumatra.web module
 """
 
+import os
+import shutil
+import tempfile
 import unittest
-from datetime import datetime
+import json
+from datetime import datetime, timedelta, timezone
 
 try:
     import django
@@ -44,6 +48,221 @@ class TestWebInterface(unittest.TestCase):
                          [b[1]])
 
 
+def make_record(label, timestamp, tags=()):
+    import sys
+    from sumatra.records import Record
+    from sumatra.programs import PythonExecutable
+    from sumatra.launch import SerialLaunchMode, PlatformInformation
+    from sumatra.datastore import FileSystemDataStore, DataKey
+    from sumatra.parameters import SimpleParameterSet
+    from sumatra.versioncontrol.base import Repository
+    record = Record(executable=PythonExecutable(sys.executable, version="3.11"),
+                    repository=Repository("https://example.com/repos"),
+                    main_file="main.py", version="99863a9dc5f",
+                    launch_mode=SerialLaunchMode(), datastore=FileSystemDataStore("/tmp"),
+                    parameters=SimpleParameterSet({'a': 1}), input_data=[],
+                    script_arguments="<parameters>", label=label, reason="testing",
+                    diff='', user='user', timestamp=timestamp)
+    record.output_data = [DataKey("%s/figure.png" % label, "0" * 40, timestamp,
+                                  size=1024, mimetype="image/png", encoding=None)]
+    record.tags = set(tags)
+    record.platforms = [PlatformInformation(architecture_bits="64bit", architecture_linkage="ELF",
+                                            machine="x86_64", network_name="localhost",
+                                            ip_addr="127.0.0.1", processor="x86_64", release="6.1",
+                                            system_name="Linux", version="#1 SMP")]
+    return record
+
+
+class TestDatatableViews(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        if not have_django:
+            raise unittest.SkipTest("Django required")
+        from django.conf import settings
+        from sumatra.recordstore import django_store
+        cls.tmpdir = tempfile.mkdtemp(prefix='sumatra-test-')
+        cls.configured_django = not settings.configured
+        if cls.configured_django:
+            cls.store = django_store.DjangoRecordStore(db_file=os.path.join(cls.tmpdir, "records.db"))
+            cls.store._get_models()
+        else:
+            cls.store = cls._reuse_configured_database()
+        cls.store.delete_all()
+        start = datetime(2024, 1, 1, tzinfo=timezone.utc)
+        records = [make_record("record%d" % i, start + timedelta(seconds=i), tags=["odd"] if i % 2 else [])
+                   for i in range(5)]
+        records[0].input_data = records[1].output_data
+        cls.store.save_many("TestProject", records)
+
+    @classmethod
+    def _reuse_configured_database(cls):
+        """
+        Django can only be configured once in a process, so if another test
+        module has already done so, use its default database.
+        """
+        from django.conf import settings
+        from django.core import management
+        from django.db import connections
+        from sumatra.recordstore import django_store
+        db_file = settings.DATABASES['default']['NAME']
+        connections.close_all()
+        # the database may have been removed by the other test module
+        if not os.path.exists(os.path.dirname(db_file)):
+            os.makedirs(os.path.dirname(db_file))
+        management.call_command('migrate', run_syncdb=True, database='default', verbosity=0, interactive=False)
+        # bypass the constructor, as the other test module may have reset the store configuration
+        store = django_store.DjangoRecordStore.__new__(django_store.DjangoRecordStore)
+        store._db_file = db_file
+        store._db_label = 'default'
+        return store
+
+    @classmethod
+    def tearDownClass(cls):
+        from django.db import connections
+        cls.store.delete_all()
+        connections.close_all()
+        if cls.configured_django:
+            # undo the configuration, so that test modules run later can configure Django themselves
+            from django.conf import settings
+            from django.utils.functional import empty
+            from sumatra.recordstore import django_store
+            settings._wrapped = empty
+            connections.__init__()
+            vars(connections).pop("settings", None)  # the cached DATABASES setting
+            django_store.db_config = django_store.DjangoConfiguration()
+        shutil.rmtree(cls.tmpdir)
+
+    def get(self, view, length=10, **params):
+        from django.test import RequestFactory
+        query = {'tag': '', 'search[value]': '', 'order[0][column]': '0', 'order[0][dir]': 'asc',
+                 'length': str(length), 'start': '0', 'draw': '1'}
+        query.update(params)
+        response = view(RequestFactory().get('/TestProject/datatable/', query), "TestProject")
+        return json.loads(response.content)
+
+    def test_datatable_record(self):
+        from sumatra.web.views import datatable_record
+        content = self.get(datatable_record, length=2, tag='odd')
+        self.assertEqual((content["recordsTotal"], content["recordsFiltered"]), (5, 2))
+        self.assertEqual([row["label"] for row in content["data"]], ["record1", "record3"])
+        row = content["data"][0]
+        self.assertEqual(row["tags"], ["odd"])
+        self.assertEqual(row["processes"], 1)
+        self.assertEqual([key["path"] for key in row["output_data"]], ["record1/figure.png"])
+        row = self.get(datatable_record, length=1)["data"][0]
+        self.assertEqual([key["path"] for key in row["input_data"]], ["record1/figure.png"])
+
+    def test_datatable_record_search(self):
+        from sumatra.recordstore.django_store import search
+        from sumatra.web.views import datatable_record
+        self.assertTrue(search.is_available())
+        for search_value, expected in (("record3", ["record3"]), ("rec", ["record%d" % i for i in range(5)]),
+                                       ("odd testing", ["record1", "record3"]), ("a=1 main", ["record%d" % i for i in range(5)]),
+                                       ("nomatch", []), ("- !", ["record%d" % i for i in range(5)])):
+            content = self.get(datatable_record, **{'search[value]': search_value})
+            self.assertEqual([row["label"] for row in content["data"]], expected)
+
+    def test_datatable_data(self):
+        from sumatra.web.views import datatable_data
+        content = self.get(datatable_data, length=2)
+        self.assertEqual((content["recordsTotal"], content["recordsFiltered"]), (5, 5))
+        self.assertEqual([(row["filename"], row["size"]) for row in content["data"]],
+                         [("figure.png", 1024)] * 2)
+        self.assertEqual(content["data"][0]["input_to_records"], [])
+        self.assertEqual(content["data"][1]["input_to_records"], ["record0"])
+
+    def test_datatable_image(self):
+        from sumatra.web.views import datatable_image
+        content = self.get(datatable_image, tag='odd', **{'order[0][column]': '2'})
+        self.assertEqual(content["recordsFiltered"], 2)
+        self.assertEqual([row["record"] for row in content["data"]], ["record1", "record3"])
+        self.assertEqual(content["data"][0]["parameters"], ["a = 1"])
+
+    def test_image_thumbgrid_pages(self):
+        from django.test import RequestFactory
+        from sumatra.web.views import image_thumbgrid
+        factory = RequestFactory()
+        labels = []
+        query = {'limit': '2'}
+        while True:
+            request = factory.get('/TestProject/image/thumbgrid', query, HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+            content = json.loads(image_thumbgrid(request, "TestProject").content)
+            labels.extend(image["label"] for image in content["images"])
+            if content["next"] is None:
+                break
+            query["after"] = content["next"]
+        self.assertEqual(labels, ["record4", "record3", "record2", "record1", "record0"])
+        request = factory.get('/TestProject/image/thumbgrid', {'limit': '-1', 'selected_tag': 'odd'},
+                              HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        content = json.loads(image_thumbgrid(request, "TestProject").content)
+        self.assertEqual([image["label"] for image in content["images"]], ["record3", "record1"])
+        self.assertIsNone(content["next"])
+
+    def test_number_of_queries_does_not_depend_on_page_length(self):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        from sumatra.web.views import datatable_record, datatable_data, datatable_image
+        for view in datatable_record, datatable_data, datatable_image:
+            with CaptureQueriesContext(connection) as one_row:
+                self.get(view, length=1)
+            with CaptureQueriesContext(connection) as all_rows:
+                self.get(view, length=5)
+            self.assertEqual(len(one_row), len(all_rows))
+
+
+class MockDataItem(object):
+
+    def __init__(self, content):
+        self.content = content
+
+    def iter_chunks(self):
+        yield self.content
+
+
+class TestThumbnailCache(unittest.TestCase):
+
+    def setUp(self):
+        import tempfile
+        from sumatra.web.thumbnails import ThumbnailCache
+        self.tmpdir = tempfile.mkdtemp()
+        self.cache = ThumbnailCache(self.tmpdir, max_size=1300)
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.tmpdir)
+
+    def test_get_returns_what_was_put(self):
+        self.assertIsNone(self.cache.get("ab" * 20, 256))
+        self.cache.put("ab" * 20, 256, b"thumbnail")
+        self.assertEqual(self.cache.get("ab" * 20, 256), b"thumbnail")
+        self.assertIsNone(self.cache.get("ab" * 20, 128))
+
+    def test_least_recently_used_thumbnails_are_removed(self):
+        for i, digest in enumerate(("a" * 40, "b" * 40, "c" * 40)):
+            self.cache.put(digest, 256, b"x" * 400)
+            os.utime(self.cache.path(digest, 256), (i, i))
+        self.cache.get("a" * 40, 256)  # "b" is now the least recently used
+        self.cache.put("d" * 40, 256, b"x" * 400)
+        self.assertEqual([digest for digest in ("a", "b", "c", "d")
+                          if self.cache.get(digest * 40, 256) is not None],
+                         ["a", "d"])
+
+    def test_thumbnail_is_cached(self):
+        try:
+            from PIL import Image
+        except ImportError:
+            raise unittest.SkipTest("Pillow not available")
+        import io
+        from sumatra.datastore import DataKey
+        image = io.BytesIO()
+        Image.new("RGB", (1000, 500)).save(image, "PNG")
+        key = DataKey("figure.png", "ab" * 20, None, mimetype="image/png")
+        content = self.cache.thumbnail(key, MockDataItem(image.getvalue()), 128)
+        self.assertEqual(Image.open(io.BytesIO(content)).size, (128, 64))
+        self.assertEqual(self.cache.get("ab" * 20, 128), content)
+
+
 class TestFilters(unittest.TestCase):
 
     @unittest.skipUnless(have_django, "Django required")